@@ -0,0 +1,118 @@
+# Measure compression ratio, encode and decode throughput for a matrix of codecs on the example data.
+# Run this script from the 'single_image' folder via 'python -m benchmarks.benchmark_codecs'.
+import argparse
+import json
+import os
+import time
+from glob import glob
+
+import h5py
+import numcodecs
+import numpy as np
+
+from prototypes.v03 import _get_blocks
+
+SHUFFLES = {
+    "noshuffle": numcodecs.Blosc.NOSHUFFLE,
+    "shuffle": numcodecs.Blosc.SHUFFLE,
+    "bitshuffle": numcodecs.Blosc.BITSHUFFLE,
+}
+
+
+def get_codec_matrix(dtype, blosc_levels=(1, 5, 9), zstd_levels=(1, 3, 9), gzip_levels=(1, 5)):
+    """Get the (name, compressor, filters) combinations to benchmark.
+    """
+    matrix = []
+    for cname in ("lz4", "zstd", "blosclz"):
+        for clevel in blosc_levels:
+            for shuffle_name, shuffle in SHUFFLES.items():
+                matrix.append(
+                    (f"blosc-{cname}-{clevel}-{shuffle_name}",
+                     numcodecs.Blosc(cname=cname, clevel=clevel, shuffle=shuffle), None)
+                )
+    matrix.extend([(f"zstd-{level}", numcodecs.Zstd(level=level), None) for level in zstd_levels])
+    matrix.extend([(f"gzip-{level}", numcodecs.GZip(level=level), None) for level in gzip_levels])
+    # the delta filter is useful for label data, where neighboring values are often identical
+    if np.issubdtype(dtype, np.integer):
+        delta = numcodecs.Delta(dtype=dtype)
+        matrix.extend([
+            ("delta-blosc-zstd-5-shuffle",
+             numcodecs.Blosc(cname="zstd", clevel=5, shuffle=numcodecs.Blosc.SHUFFLE), [delta]),
+            ("delta-zstd-3", numcodecs.Zstd(level=3), [delta]),
+        ])
+    return matrix
+
+
+def load_chunks(path, chunk_shape, max_chunks, rng):
+    with h5py.File(path, "r") as f:
+        ds = f["data"]
+        chunk_shape = chunk_shape[-ds.ndim:]
+        chunk_shape = (1,) * (ds.ndim - len(chunk_shape)) + tuple(chunk_shape)
+        blocks = list(_get_blocks(ds.shape, chunk_shape))
+        if len(blocks) > max_chunks:
+            block_ids = rng.choice(len(blocks), size=max_chunks, replace=False)
+            blocks = [blocks[block_id] for block_id in sorted(block_ids)]
+        return [np.ascontiguousarray(ds[bb]) for bb in blocks]
+
+
+def benchmark_codec(chunks, compressor, filters):
+    n_bytes = sum(chunk.nbytes for chunk in chunks)
+
+    t0 = time.perf_counter()
+    encoded_chunks = []
+    for chunk in chunks:
+        encoded = chunk
+        for filt in (filters or []):
+            encoded = filt.encode(encoded)
+        encoded_chunks.append(compressor.encode(encoded))
+    t_encode = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for encoded in encoded_chunks:
+        decoded = compressor.decode(encoded)
+        for filt in reversed(filters or []):
+            decoded = filt.decode(decoded)
+    t_decode = time.perf_counter() - t0
+
+    n_encoded = sum(len(encoded) for encoded in encoded_chunks)
+    mb = n_bytes / 1e6
+    return {
+        "compression_ratio": n_bytes / n_encoded,
+        "encode_mb_per_s": mb / t_encode,
+        "decode_mb_per_s": mb / t_decode,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inputs", default="./example_data/*.h5", help="Glob pattern for the input h5 files")
+    parser.add_argument("-c", "--chunks", type=int, nargs="+", default=[64, 64, 64],
+                        help="Chunk shape, the last axes of the data are chunked with it")
+    parser.add_argument("-m", "--max_chunks", type=int, default=64,
+                        help="Maximal number of chunks that are sampled per dataset")
+    parser.add_argument("-o", "--output", default=None, help="Save the results as json")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    for path in sorted(glob(args.inputs)):
+        name = os.path.basename(path)
+        chunks = load_chunks(path, args.chunks, args.max_chunks, rng)
+        dtype = chunks[0].dtype
+        print(f"{name} ({dtype}, {len(chunks)} chunks of shape {chunks[0].shape}):")
+        print(f"  {'codec':<32} {'ratio':>8} {'encode MB/s':>12} {'decode MB/s':>12}")
+        results[name] = {}
+        for codec_name, compressor, filters in get_codec_matrix(dtype):
+            res = benchmark_codec(chunks, compressor, filters)
+            results[name][codec_name] = res
+            print(f"  {codec_name:<32} {res['compression_ratio']:>8.2f}",
+                  f"{res['encode_mb_per_s']:>12.1f} {res['decode_mb_per_s']:>12.1f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Compare the number of requests and the time for opening the multiscale images with and without
+# consolidated metadata. The data is served by a local http server, which counts the requests.
+# Run this script from the 'single_image' folder via 'python -m benchmarks.benchmark_consolidated'.
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections.abc import Mapping
+from functools import partial
+from glob import glob
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import zarr
+
+from prototypes.reader import open_multiscales
+
+METADATA_FILES = (".zattrs", ".zarray", ".zgroup")
+
+
+class _CountingHandler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.n_requests += 1
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPStore(Mapping):
+    """Minimal read-only mapping for data served over http, it is passed to zarr via KVStore.
+
+    A plain http server can't list its files, so the store appears empty when iterated;
+    opening the images only needs to read keys, not to list them.
+    """
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def __getitem__(self, key):
+        try:
+            with urllib.request.urlopen(f"{self.url}/{key}") as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise KeyError(key)
+            raise
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+
+def _copy_metadata(path, out_path):
+    # only the metadata is needed to open the images, so the chunks are not copied
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name in METADATA_FILES:
+                out_root = os.path.join(out_path, os.path.relpath(root, path))
+                os.makedirs(out_root, exist_ok=True)
+                shutil.copyfile(os.path.join(root, name), os.path.join(out_root, name))
+
+
+def _get_names(path):
+    with open(os.path.join(path, ".zattrs")) as f:
+        return [ms["name"] for ms in json.load(f)["multiscales"]]
+
+
+def benchmark_open(server, url, names, consolidated, n_repeats):
+    n_requests, times = [], []
+    for _ in range(n_repeats):
+        server.n_requests = 0
+        t0 = time.perf_counter()
+        # open all images in the container (a single image or multiple images)
+        store = zarr.storage.KVStore(HTTPStore(url))
+        container = zarr.open_consolidated(store, mode="r") if consolidated else zarr.open(store, mode="r")
+        for name in names:
+            with open_multiscales(container, name=name, n_prefetch=0) as image:
+                [level.shape for level in image.levels]
+        times.append(time.perf_counter() - t0)
+        n_requests.append(server.n_requests)
+    return {"requests": int(np.median(n_requests)), "open_ms": float(np.median(times) * 1000)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--root", default="v0.4", help="The folder with the ome.zarr data")
+    parser.add_argument("-n", "--n_repeats", type=int, default=5)
+    parser.add_argument("-o", "--output", default=None, help="Save the results as json")
+    args = parser.parse_args()
+
+    paths = sorted(glob(os.path.join(args.root, "*.ome.zarr")))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path in paths:
+            out_path = os.path.join(tmp_dir, os.path.basename(path))
+            _copy_metadata(path, out_path)
+            zarr.consolidate_metadata(out_path)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(_CountingHandler, directory=tmp_dir))
+        server.lock, server.n_requests = threading.Lock(), 0
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            print(f"{'image':<24} {'requests':>8} {'open [ms]':>10} {'requests (cons.)':>17} {'open [ms] (cons.)':>18}")
+            for path in paths:
+                name = os.path.basename(path)
+                url = f"http://127.0.0.1:{server.server_port}/{name}"
+                names = _get_names(path)
+                res = {
+                    "plain": benchmark_open(server, url, names, False, args.n_repeats),
+                    "consolidated": benchmark_open(server, url, names, True, args.n_repeats),
+                }
+                results[name] = res
+                print(f"{name:<24} {res['plain']['requests']:>8} {res['plain']['open_ms']:>10.1f}",
+                      f"{res['consolidated']['requests']:>17} {res['consolidated']['open_ms']:>18.1f}")
+        finally:
+            server.shutdown()
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Compare the number of files, the size on disk and the write time of label data written
+# with and without the chunks that only contain background (write_empty_chunks=False / True).
+# Run this script from the 'single_image' folder via 'python -m benchmarks.benchmark_empty_chunks'.
+# By default a sparse segmentation is derived from the example volume, other segmentations can be passed
+# via '-i', e.g. the cells / nuclei labels of the spatial transcriptomics example (ome.tif)
+# or the MoBIE segmentation (n5, with '-k setup0/timepoint0/s0').
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+import skimage.measure
+import tifffile
+import zarr
+
+from prototypes.v04 import write_ome_zarr
+
+
+def _get_size(path):
+    n_files, n_bytes = 0, 0
+    for root, _, files in os.walk(path):
+        n_files += len(files)
+        n_bytes += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return n_files, n_bytes
+
+
+def load_segmentation(path, key=None):
+    if path.endswith(".h5"):
+        with h5py.File(path, "r") as f:
+            return f["data" if key is None else key][:]
+    if path.endswith((".tif", ".tiff")):
+        return tifffile.imread(path)
+    f = zarr.open(zarr.N5Store(path) if path.endswith(".n5") else path, mode="r")
+    return f[key][:]
+
+
+def create_example_segmentation(path="./example_data/volume.h5", percentile=99.0):
+    # label the connected components of the brightest voxels of the example volume
+    with h5py.File(path, "r") as f:
+        data = f["data"][:]
+    return skimage.measure.label(data > np.percentile(data, percentile)).astype("uint32")
+
+
+def benchmark_write(segmentation, write_empty_chunks, n_scales, n_workers, tmp_dir):
+    out_path = os.path.join(tmp_dir, f"labels-{write_empty_chunks}.ome.zarr")
+    axes_names = tuple("zyx"[-segmentation.ndim:])
+    t0 = time.perf_counter()
+    write_ome_zarr(segmentation, out_path, axes_names, "labels", n_scales,
+                   downscaler="nearest", kwargs={"scale": (0.5,) * segmentation.ndim},
+                   n_workers=n_workers, write_empty_chunks=write_empty_chunks)
+    t_write = time.perf_counter() - t0
+    n_files, n_bytes = _get_size(out_path)
+    return {"files": n_files, "bytes": n_bytes, "write_s": t_write}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inputs", nargs="+", default=None, help="The segmentations (h5, tif, zarr or n5)")
+    parser.add_argument("-k", "--key", default=None, help="The key of the segmentation for h5, zarr or n5 inputs")
+    parser.add_argument("-s", "--n_scales", type=int, default=4)
+    parser.add_argument("-n", "--n_workers", type=int, default=4)
+    parser.add_argument("-o", "--output", default=None, help="Save the results as json")
+    args = parser.parse_args()
+
+    if args.inputs is None:
+        segmentations = {"volume-segmentation": create_example_segmentation()}
+    else:
+        segmentations = {os.path.basename(path): load_segmentation(path, args.key) for path in args.inputs}
+
+    results = {}
+    print(f"{'segmentation':<28} {'background':>10} {'files':>14} {'size [MB]':>18} {'write [s]':>14}")
+    for name, segmentation in segmentations.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            res = {
+                "background_fraction": float(np.mean(segmentation == 0)),
+                "all_chunks": benchmark_write(segmentation, True, args.n_scales, args.n_workers, tmp_dir),
+                "skip_empty": benchmark_write(segmentation, False, args.n_scales, args.n_workers, tmp_dir),
+            }
+        results[name] = res
+        full, skip = res["all_chunks"], res["skip_empty"]
+        print(f"{name:<28} {res['background_fraction']:>10.2f}",
+              f"{full['files']:>6} -> {skip['files']:<6}",
+              f"{full['bytes'] / 1e6:>8.2f} -> {skip['bytes'] / 1e6:<8.2f}",
+              f"{full['write_s']:>5.2f} -> {skip['write_s']:<5.2f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# Measure the read latency and throughput of the example data for typical access patterns:
+# random 2d yx slices, 3d zyx block crops and per-pixel time series along t, for each scale level,
+# with a cold and with a warm (os) page cache.
+# Create the example data first via 'python create_ome_ngff_examples.py -v <VERSION>'
+# and then run this script from the 'single_image' folder via 'python -m benchmarks.benchmark_reads'.
+import argparse
+import json
+import os
+import time
+from glob import glob
+
+import numpy as np
+import zarr
+
+from prototypes.reader import _parse_axes
+
+PATTERNS = ("yx-slice", "zyx-block", "t-series")
+# the files can only be dropped from the page cache via posix_fadvise, which is not available on all platforms
+CAN_EVICT = hasattr(os, "posix_fadvise")
+
+
+def _evict(path):
+    # drop the files from the page cache, so that the next read of them is served from disk
+    for root, _, files in os.walk(path):
+        for name in files:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def _has_axis(axes_names, shape, axis):
+    # the axes of size 1 in the 5d data of versions 0.1 and 0.2 are not really there
+    return axis in axes_names and shape[axes_names.index(axis)] > 1
+
+
+def get_selections(pattern, shape, axes_names, n_reads, block_size, rng):
+    """Get random selections for the access pattern, returns None if the pattern does not apply to the data.
+    """
+    required = {"yx-slice": ("y", "x"), "zyx-block": ("z", "y", "x"), "t-series": ("t",)}[pattern]
+    if not all(_has_axis(axes_names, shape, ax) for ax in required):
+        return None
+
+    def _get_selection():
+        selection = []
+        for ax, sh in zip(axes_names, shape):
+            if pattern == "yx-slice" and ax in "yx" or pattern == "t-series" and ax == "t":
+                selection.append(slice(None))
+            elif pattern == "zyx-block" and ax in "zyx":
+                bs = min(block_size, sh)
+                start = int(rng.integers(0, sh - bs + 1))
+                selection.append(slice(start, start + bs))
+            else:
+                selection.append(int(rng.integers(0, sh)))
+        return tuple(selection)
+
+    return [_get_selection() for _ in range(n_reads)]
+
+
+def _summarize(times, n_bytes):
+    times = np.array(times)
+    return {
+        "n_reads": len(times),
+        "mean_ms": 1e3 * float(times.mean()),
+        "p50_ms": 1e3 * float(np.percentile(times, 50)),
+        "p90_ms": 1e3 * float(np.percentile(times, 90)),
+        "p99_ms": 1e3 * float(np.percentile(times, 99)),
+        "mb_per_s": n_bytes / 1e6 / float(times.sum()),
+        # the time series are small, so their throughput is better expressed in reads per second
+        "reads_per_s": len(times) / float(times.sum()),
+    }
+
+
+def benchmark_reads(array_path, selections):
+    """Time the reads of the selections with a cold and with a warm page cache.
+    """
+    cold_times, n_bytes = [], 0
+    for selection in selections:
+        if CAN_EVICT:
+            _evict(array_path)
+        # the array is opened for each cold read, so that the metadata is read as well
+        t0 = time.perf_counter()
+        data = zarr.open(array_path, mode="r")[selection]
+        cold_times.append(time.perf_counter() - t0)
+        n_bytes += data.nbytes
+
+    array = zarr.open(array_path, mode="r")
+    for selection in selections:
+        array[selection]
+    warm_times = []
+    for selection in selections:
+        t0 = time.perf_counter()
+        array[selection]
+        warm_times.append(time.perf_counter() - t0)
+    return {"cold": _summarize(cold_times, n_bytes), "warm": _summarize(warm_times, n_bytes)}
+
+
+def benchmark_store(path, n_reads, block_size, rng):
+    with open(os.path.join(path, ".zattrs")) as f:
+        multiscales = json.load(f)["multiscales"]
+    results = {}
+    for ms_entry in multiscales:
+        axes_names, _ = _parse_axes(ms_entry)
+        image_results = {}
+        for ds in ms_entry["datasets"]:
+            array_path = os.path.join(path, ds["path"])
+            array = zarr.open(array_path, mode="r")
+            level_results = {"shape": list(array.shape), "chunks": list(array.chunks)}
+            for pattern in PATTERNS:
+                selections = get_selections(pattern, array.shape, axes_names, n_reads, block_size, rng)
+                if selections is not None:
+                    level_results[pattern] = benchmark_reads(array_path, selections)
+            image_results[ds["path"]] = level_results
+        results[ms_entry.get("name", "image")] = image_results
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--roots", nargs="+", default=None,
+                        help="The folders with the ome.zarr data, by default all of v0.1 - v0.4 that exist")
+    parser.add_argument("-n", "--n_reads", type=int, default=50)
+    parser.add_argument("-b", "--block_size", type=int, default=64, help="The size of the zyx block crops")
+    parser.add_argument("-o", "--output", default=None, help="Save the results as json")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    roots = args.roots
+    if roots is None:
+        roots = [root for root in ("v0.1", "v0.2", "v0.3", "v0.4") if os.path.exists(root)]
+    if not CAN_EVICT:
+        print("The page cache can't be dropped on this platform, the cold reads only open the arrays again")
+
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    print(f"{'store':<36} {'level':<12} {'pattern':<10} {'cache':<5}",
+          f"{'p50 [ms]':>9} {'p90 [ms]':>9} {'p99 [ms]':>9} {'MB/s':>8} {'reads/s':>8}")
+    for root in roots:
+        for path in sorted(glob(os.path.join(root, "*.ome.zarr"))):
+            name = os.path.relpath(path)
+            results[name] = benchmark_store(path, args.n_reads, args.block_size, rng)
+            for image_results in results[name].values():
+                for level, level_results in image_results.items():
+                    for pattern in PATTERNS:
+                        for cache, res in level_results.get(pattern, {}).items():
+                            print(f"{name:<36} {level:<12} {pattern:<10} {cache:<5}",
+                                  f"{res['p50_ms']:>9.3f} {res['p90_ms']:>9.3f} {res['p99_ms']:>9.3f}",
+                                  f"{res['mb_per_s']:>8.1f} {res['reads_per_s']:>8.0f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
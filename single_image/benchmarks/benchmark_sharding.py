@@ -0,0 +1,88 @@
+# Compare random chunk access for the unsharded (v0.4) and sharded (v0.5) example data.
+# Create the example data first via 'python create_ome_ngff_examples.py -v 0.4' and '... -v 0.5'
+# and then run this script from the 'single_image' folder via 'python -m benchmarks.benchmark_sharding'.
+import argparse
+import json
+import os
+import time
+from glob import glob
+
+import numpy as np
+import zarr
+
+from prototypes.v05 import ShardedArray
+
+
+def _count_files(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def _time_random_reads(read_chunk, chunk_grid, n_reads, rng):
+    chunk_ids = [tuple(int(rng.integers(0, n)) for n in chunk_grid) for _ in range(n_reads)]
+    times = []
+    for chunk_id in chunk_ids:
+        t0 = time.perf_counter()
+        read_chunk(chunk_id)
+        times.append(time.perf_counter() - t0)
+    return np.array(times)
+
+
+def _summarize(times):
+    return {
+        "mean_ms": 1e3 * float(np.mean(times)),
+        "median_ms": 1e3 * float(np.median(times)),
+        "p95_ms": 1e3 * float(np.percentile(times, 95)),
+        "chunks_per_s": float(len(times) / np.sum(times)),
+    }
+
+
+def benchmark_image(unsharded_path, sharded_path, n_reads, rng):
+    results = {
+        "unsharded_files": _count_files(unsharded_path),
+        "sharded_files": _count_files(sharded_path),
+        "levels": {},
+    }
+    for level_path in sorted(glob(os.path.join(sharded_path, "**", "s[0-9]*"), recursive=True)):
+        level = os.path.relpath(level_path, sharded_path)
+        sharded = ShardedArray(level_path)
+        unsharded = zarr.open(os.path.join(unsharded_path, level), mode="r")
+        assert sharded.inner_chunks == unsharded.chunks, f"{sharded.inner_chunks}, {unsharded.chunks}"
+        chunk_grid = unsharded.cdata_shape
+        results["levels"][level] = {
+            "unsharded": _summarize(_time_random_reads(lambda cid: unsharded.blocks[cid], chunk_grid, n_reads, rng)),
+            "sharded": _summarize(_time_random_reads(sharded.read_chunk, chunk_grid, n_reads, rng)),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unsharded_root", default="v0.4")
+    parser.add_argument("--sharded_root", default="v0.5")
+    parser.add_argument("-n", "--n_reads", type=int, default=100)
+    parser.add_argument("-o", "--output", default=None, help="Save the results as json")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    for sharded_path in sorted(glob(os.path.join(args.sharded_root, "*.ome.zarr"))):
+        name = os.path.basename(sharded_path)
+        unsharded_path = os.path.join(args.unsharded_root, name)
+        if not os.path.exists(unsharded_path):
+            continue
+        res = benchmark_image(unsharded_path, sharded_path, args.n_reads, rng)
+        results[name] = res
+        print(name, ": number of files unsharded:", res["unsharded_files"], "sharded:", res["sharded_files"])
+        for level, level_res in res["levels"].items():
+            unsharded, sharded = level_res["unsharded"], level_res["sharded"]
+            print(f"  {level}: mean chunk read unsharded: {unsharded['mean_ms']:.3f} ms,",
+                  f"sharded: {sharded['mean_ms']:.3f} ms")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
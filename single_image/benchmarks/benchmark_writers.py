@@ -0,0 +1,194 @@
+# Benchmark write_ome_zarr for the versions 0.1 - 0.4 on synthetic data for all axes combinations of the examples.
+# Run this script from the 'single_image' folder via 'python -m benchmarks.benchmark_writers'.
+# The results can be saved with '-o results.json' and compared to the results of a previous commit
+# with '--compare previous.json', which reports the cases that became slower.
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from shutil import rmtree
+
+import numpy as np
+import skimage.filters
+import zarr
+
+VERSIONS = {
+    "0.1": ("v02", {"dimension_separator": "."}),
+    "0.2": ("v02", {}),
+    "0.3": ("v03", {}),
+    "0.4": ("v04", {}),
+}
+# the axes combinations of the examples in create_ome_ngff_examples.py
+AXES = ("yx", "cyx", "zyx", "tyx", "tcyx", "czyx", "tczyx")
+
+
+def make_data(axes, sizes, dtype, seed=0):
+    """Create smooth random data, which compresses similar to microscopy data (unlike white noise).
+    """
+    shape = tuple(sizes[ax] for ax in axes)
+    noise = np.random.default_rng(seed).standard_normal(shape)
+    data = skimage.filters.gaussian(noise, sigma=[2.0 if ax in "zyx" else 0.0 for ax in axes], preserve_range=True)
+    data = (data - data.min()) / (data.max() - data.min())
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        data = data * np.iinfo(dtype).max
+    return data.astype(dtype)
+
+
+def _get_kwargs(axes):
+    n_spatial = sum(ax in "zyx" for ax in axes)
+    return {"scale": (0.5,) * n_spatial, "order": 0, "preserve_range": True}
+
+
+def _get_size(path):
+    n_files, n_bytes = 0, 0
+    for root, _, files in os.walk(path):
+        n_files += len(files)
+        n_bytes += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return n_files, n_bytes
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and in bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def run_case(version, axes, sizes, dtype, n_scales, n_workers, n_repeats, tmp_dir):
+    """Benchmark the writer of one version for one axes combination (in a separate process, see main).
+
+    The default writer computes s0 and all scale levels in a single pass over tiles, so the stages can't be
+    timed separately. Instead the data is written with 1, ..., n_scales scale levels: the time for one level
+    minus the metadata time is the s0 write and the time difference to the previous run is the time for
+    downscaling and writing the next level.
+    """
+    module_name, version_kwargs = VERSIONS[version]
+    module = importlib.import_module(f"prototypes.{module_name}")
+
+    # time the metadata creation by wrapping the function that is called by write_ome_zarr
+    metadata_times = []
+    create_ngff_metadata = module.create_ngff_metadata
+
+    def timed_create_ngff_metadata(*args, **kwargs):
+        t0 = time.perf_counter()
+        create_ngff_metadata(*args, **kwargs)
+        metadata_times.append(time.perf_counter() - t0)
+
+    module.create_ngff_metadata = timed_create_ngff_metadata
+
+    data = make_data(axes, sizes, dtype)
+    rss_before = _peak_rss_mb()
+    out_path = os.path.join(tmp_dir, f"{version}-{axes}-{dtype}.ome.zarr")
+    times = {}
+    for scales in range(1, n_scales + 1):
+        run_times, run_metadata_times = [], []
+        for _ in range(n_repeats):
+            if os.path.exists(out_path):
+                rmtree(out_path)
+            metadata_times.clear()
+            t0 = time.perf_counter()
+            module.write_ome_zarr(data, out_path, tuple(axes), axes, scales,
+                                  kwargs=_get_kwargs(axes), n_workers=n_workers, **version_kwargs)
+            run_times.append(time.perf_counter() - t0)
+            run_metadata_times.append(sum(metadata_times))
+        times[scales] = (float(np.median(run_times)), float(np.median(run_metadata_times)))
+    n_files, n_bytes = _get_size(out_path)
+    rmtree(out_path)
+
+    total, metadata = times[n_scales]
+    return {
+        "version": version, "axes": axes, "dtype": dtype,
+        "shape": list(data.shape), "input_mb": data.nbytes / 1e6,
+        "total_s": total,
+        "s0_write_s": times[1][0] - times[1][1],
+        # downscaling and writing s1, ..., sN
+        "levels_s": [max(times[scales][0] - times[scales - 1][0], 0.0) for scales in range(2, n_scales + 1)],
+        "metadata_s": metadata,
+        "throughput_mb_per_s": data.nbytes / 1e6 / total,
+        "bytes_written": n_bytes, "files": n_files,
+        "peak_rss_mb": _peak_rss_mb(), "peak_rss_increase_mb": _peak_rss_mb() - rss_before,
+    }
+
+
+def _get_environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None, "python": platform.python_version(),
+            "numpy": np.__version__, "zarr": zarr.__version__, "machine": platform.machine()}
+
+
+def compare(results, previous_results, threshold):
+    """Print the cases whose total time increased by more than threshold compared to the previous results.
+    """
+    previous = {(res["version"], res["axes"], res["dtype"]): res for res in previous_results["results"]}
+    n_slower = 0
+    for res in results["results"]:
+        prev = previous.get((res["version"], res["axes"], res["dtype"]))
+        if prev is None:
+            continue
+        change = res["total_s"] / prev["total_s"] - 1.0
+        if change > threshold:
+            n_slower += 1
+            print(f"slower: v{res['version']} {res['axes']} {res['dtype']}:",
+                  f"{prev['total_s']:.3f} s -> {res['total_s']:.3f} s ({100 * change:+.0f} %)")
+    print(f"{n_slower} cases are more than {100 * threshold:.0f} % slower than in commit",
+          previous_results["environment"].get("commit"))
+    return n_slower
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--versions", nargs="+", default=list(VERSIONS), choices=list(VERSIONS))
+    parser.add_argument("-a", "--axes", nargs="+", default=list(AXES), choices=list(AXES))
+    parser.add_argument("-d", "--dtypes", nargs="+", default=["uint8", "uint16", "float32"])
+    parser.add_argument("--size_yx", type=int, default=512)
+    parser.add_argument("--size_z", type=int, default=64)
+    parser.add_argument("--size_c", type=int, default=2)
+    parser.add_argument("--size_t", type=int, default=4)
+    parser.add_argument("-s", "--n_scales", type=int, default=3)
+    parser.add_argument("-n", "--n_workers", type=int, default=1)
+    parser.add_argument("-r", "--n_repeats", type=int, default=3)
+    parser.add_argument("-o", "--output", default=None, help="Save the results as json")
+    parser.add_argument("--compare", default=None, help="Compare to results saved by a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown that is reported")
+    args = parser.parse_args()
+    sizes = {"t": args.size_t, "c": args.size_c, "z": args.size_z, "y": args.size_yx, "x": args.size_yx}
+
+    results = []
+    print(f"{'version':<8} {'axes':<6} {'dtype':<8} {'total [s]':>9} {'s0 [s]':>7} {'levels [s]':>18}",
+          f"{'meta [s]':>8} {'MB/s':>7} {'files':>6} {'MB':>7} {'peak RSS [MB]':>13}")
+    # each case runs in a new process, so that the peak memory is measured per case
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for version in args.versions:
+            for axes in args.axes:
+                for dtype in args.dtypes:
+                    with context.Pool(1, maxtasksperchild=1) as pool:
+                        res = pool.apply(run_case, (version, axes, sizes, dtype, args.n_scales,
+                                                    args.n_workers, args.n_repeats, tmp_dir))
+                    results.append(res)
+                    levels = " ".join(f"{t:.3f}" for t in res["levels_s"])
+                    print(f"{version:<8} {axes:<6} {dtype:<8} {res['total_s']:>9.3f} {res['s0_write_s']:>7.3f}",
+                          f"{levels:>18} {res['metadata_s']:>8.4f} {res['throughput_mb_per_s']:>7.1f}",
+                          f"{res['files']:>6} {res['bytes_written'] / 1e6:>7.2f} {res['peak_rss_mb']:>13.1f}")
+
+    results = {"environment": _get_environment(), "args": vars(args), "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f), args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,21 @@ def _kwargs_3d():
     return {"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True}
 
 
-def _create_examples(writer, root):
+def _configure_writer(writer, downscaler=None, access_pattern=None, consolidate=False):
+    if consolidate:
+        writer = partial(writer, consolidate=True)
+    if downscaler is not None:
+        writer = partial(writer, downscaler=downscaler)
+    # plan the chunks for each scale level for the given access pattern instead of using the default chunks
+    if access_pattern is not None:
+        writer = partial(writer, chunks="auto", access_pattern=access_pattern)
+    return writer
+
+
+def _create_examples(writer, root, n_workers=1, downscaler=None, access_pattern=None, consolidate=False,
+                     multi_image_writer=None):
     os.makedirs(root, exist_ok=True)
+    writer = _configure_writer(writer, downscaler, access_pattern, consolidate)
 
     with open("./example_data/voxel_sizes.json") as f:
         voxel_sizes = json.load(f)
@@ -34,6 +47,10 @@ def _create_examples(writer, root):
         with h5py.File(path, "r") as f:
             data = f["data"][bb]
         assert data.ndim == len(axes)
+        if access_pattern is not None:
+            from prototypes.chunks import format_chunk_plan, plan_chunks
+            plan = plan_chunks(data.shape, data.dtype, axes, access_pattern)
+            print("Planned layout for s0:", format_chunk_plan(plan))
         kwargs = _kwargs_3d() if axes[-3:] == ("z", "y", "x") else _kwargs_2d()
         if unit is None and time_unit is None:
             units = None
@@ -49,7 +66,7 @@ def _create_examples(writer, root):
         writer(
             data, out_path, axes, ax_name,
             n_scales=3, kwargs=kwargs, scale=voxel_size, units=units, time_scale=time_scale,
-            prefix=prefix
+            prefix=prefix, n_workers=n_workers
         )
 
     # yx example data
@@ -77,55 +94,85 @@ def _create_examples(writer, root):
     create("./example_data/timeseries_with_channels.h5", ("t", "c", "z", "y", "x"),
            unit=unit, voxel_size=voxel_size, time_unit="second", time_scale=10)
 
-    # multi image currently only implemented for 0.4
-    if "0.4" in root:
+    # multi image currently only implemented for 0.4 and 0.5
+    if "0.4" in root or "0.5" in root:
         # create example with multiple images
         path = "./example_data/image_with_channels.h5"
-        with h5py.File(path, "r") as f:
-            n_channels = f["data"].shape[0]
         out_path = os.path.join(root, "multi-image.ome.zarr")
-        for chan in range(n_channels):
-            name = f"image-{chan}"
-            create(path, ("y", "x"), np.s_[chan], ax_name=name, out_path=out_path, prefix=name)
+        if multi_image_writer is None:
+            with h5py.File(path, "r") as f:
+                n_channels = f["data"].shape[0]
+            for chan in range(n_channels):
+                name = f"image-{chan}"
+                create(path, ("y", "x"), np.s_[chan], ax_name=name, out_path=out_path, prefix=name)
+        elif os.path.exists(out_path):
+            print("Example data at", out_path, "is already present")
+        else:
+            # read the data once and write all channels as separate images with a single metadata write
+            print("Create", out_path)
+            with h5py.File(path, "r") as f:
+                data = f["data"][:]
+            multi_image_writer = _configure_writer(multi_image_writer, downscaler, access_pattern, consolidate)
+            multi_image_writer(data, out_path, ("y", "x"), [f"image-{chan}" for chan in range(data.shape[0])],
+                               n_scales=3, kwargs=_kwargs_2d(), n_workers=n_workers)
 
 
-def create_v01():
+def create_v01(**kwargs):
     from prototypes.v02 import write_ome_zarr
     root = "v0.1"
-    _create_examples(partial(write_ome_zarr, dimension_separator="."), root)
+    _create_examples(partial(write_ome_zarr, dimension_separator="."), root, **kwargs)
 
 
-def create_v02():
+def create_v02(**kwargs):
     from prototypes.v02 import write_ome_zarr
     root = "v0.2"
-    _create_examples(write_ome_zarr, root)
+    _create_examples(write_ome_zarr, root, **kwargs)
 
 
-def create_v03():
+def create_v03(**kwargs):
     from prototypes.v03 import write_ome_zarr
     root = "v0.3"
-    _create_examples(write_ome_zarr, root)
+    _create_examples(write_ome_zarr, root, **kwargs)
 
 
-def create_v04():
-    from prototypes.v04 import write_ome_zarr
+def create_v04(**kwargs):
+    from prototypes.v04 import write_multi_image_ome_zarr, write_ome_zarr
     root = "v0.4"
-    _create_examples(write_ome_zarr, root)
+    _create_examples(write_ome_zarr, root, multi_image_writer=write_multi_image_ome_zarr, **kwargs)
+
+
+def create_v05(**kwargs):
+    from prototypes.v05 import write_ome_zarr
+    root = "v0.5"
+    _create_examples(write_ome_zarr, root, **kwargs)
 
 
 def main():
+    from prototypes.chunks import ACCESS_PATTERNS
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--version", type=str)
+    parser.add_argument("-n", "--n_workers", type=int, default=1)
+    # use one of the integer factor downscaling functions from prototypes.downscaling instead of skimage
+    parser.add_argument("-d", "--downscaler", type=str, default=None)
+    parser.add_argument("-a", "--access_pattern", type=str, default=None, choices=ACCESS_PATTERNS)
+    # consolidate the metadata of each ome.zarr file into a single '.zmetadata' file (not supported for 0.5)
+    parser.add_argument("-c", "--consolidate", action="store_true")
     args = parser.parse_args()
     version = args.version.lstrip("v")
+    assert not (args.consolidate and version == "0.5"), "Consolidated metadata is not supported for version 0.5"
+    kwargs = {"n_workers": args.n_workers, "downscaler": args.downscaler, "access_pattern": args.access_pattern,
+              "consolidate": args.consolidate}
     if version == "0.1":
-        create_v01()
+        create_v01(**kwargs)
     elif version == "0.2":
-        create_v02()
+        create_v02(**kwargs)
     elif version == "0.3":
-        create_v03()
+        create_v03(**kwargs)
     elif version == "0.4":
-        create_v04()
+        create_v04(**kwargs)
+    elif version == "0.5":
+        create_v05(**kwargs)
     else:
         raise ValueError(f"Invalid version: {args.version}")
 
@@ -0,0 +1,112 @@
+import math
+
+import numpy as np
+
+# the access patterns that the chunks can be optimized for:
+# - "slice": 2d slice viewer, reads single yx planes
+# - "block": 3d block processing, reads zyx blocks
+# - "timeseries": per pixel time series, reads all timepoints for small spatial neighborhoods
+ACCESS_PATTERNS = ("slice", "block", "timeseries")
+
+# the axes that are grown first for the given access pattern, the other axes are only grown
+# if these span the full array already (e.g. for small arrays at coarse scale levels)
+PRIMARY_AXES = {
+    "slice": ("y", "x"),
+    "block": ("z", "y", "x"),
+    "timeseries": ("y", "x"),
+}
+
+
+def _grow(chunks, shape, axes, max_elements):
+    # double the chunk size for each of the axes in turn until the size limit is reached
+    while True:
+        grown = False
+        for ax in axes:
+            if chunks[ax] == shape[ax]:
+                continue
+            new_size = min(2 * chunks[ax], shape[ax])
+            if math.prod(chunks) // chunks[ax] * new_size > max_elements:
+                continue
+            chunks[ax] = new_size
+            grown = True
+        if not grown:
+            return chunks
+
+
+def _get_grow_axes(axes_names, access_pattern):
+    assert access_pattern in ACCESS_PATTERNS, f"Invalid access pattern {access_pattern}, choose from {ACCESS_PATTERNS}"
+    ax_ids = {ax: ii for ii, ax in enumerate(axes_names)}
+    primary = [ax_ids[ax] for ax in PRIMARY_AXES[access_pattern] if ax in ax_ids]
+    # the channel axis is grown last, because channels are usually read independently
+    secondary = [ax_ids[ax] for ax in ("z", "t", "c") if ax in ax_ids and ax_ids[ax] not in primary]
+    return primary, secondary
+
+
+def get_default_access_pattern(axes_names):
+    return "block" if "z" in axes_names else "slice"
+
+
+def plan_chunks(shape, dtype, axes_names, access_pattern=None,
+                target_bytes=2**20, compression_ratio=1.0, shard_bytes=None):
+    """Plan the chunk shape for an array of the given shape and dtype.
+
+    The chunk shape is chosen such that the (compressed) chunks are close to target_bytes
+    and that reading for the given access pattern ('slice', 'block' or 'timeseries') touches few chunks.
+    If shard_bytes is given, the shard shape for packing multiple chunks into one object is planned as well.
+    Returns a dict with the chunk shape, the number of chunks and the bytes per (uncompressed) chunk.
+    """
+    assert len(shape) == len(axes_names)
+    access_pattern = get_default_access_pattern(axes_names) if access_pattern is None else access_pattern
+    itemsize = np.dtype(dtype).itemsize
+    max_elements = max(int(target_bytes * compression_ratio / itemsize), 1)
+
+    primary, secondary = _get_grow_axes(axes_names, access_pattern)
+    ax_ids = {ax: ii for ii, ax in enumerate(axes_names)}
+
+    chunks = [1] * len(shape)
+    # time series are read along the full time axis
+    if access_pattern == "timeseries" and "t" in ax_ids:
+        t_id = ax_ids["t"]
+        chunks[t_id] = min(shape[t_id], max_elements)
+    chunks = _grow(chunks, shape, primary, max_elements)
+    chunks = _grow(chunks, shape, secondary, max_elements)
+    chunks = tuple(chunks)
+
+    n_chunks = math.prod(math.ceil(sh / ch) for sh, ch in zip(shape, chunks))
+    plan = {"chunks": chunks, "n_chunks": n_chunks, "bytes_per_chunk": math.prod(chunks) * itemsize}
+
+    if shard_bytes is not None:
+        shards = plan_shards(shape, chunks, dtype, axes_names, access_pattern, shard_bytes, compression_ratio)
+        plan.update({
+            "shards": shards,
+            "n_shards": math.prod(math.ceil(sh / sd) for sh, sd in zip(shape, shards)),
+            "bytes_per_shard": math.prod(shards) * itemsize,
+        })
+    return plan
+
+
+def plan_shards(shape, chunks, dtype, axes_names, access_pattern=None, shard_bytes=2**26, compression_ratio=1.0):
+    """Plan the shard shape for packing chunks of the given shape into shards of roughly shard_bytes.
+    """
+    access_pattern = get_default_access_pattern(axes_names) if access_pattern is None else access_pattern
+    primary, secondary = _get_grow_axes(axes_names, access_pattern)
+    bytes_per_chunk = math.prod(chunks) * np.dtype(dtype).itemsize
+    max_chunks_per_shard = max(int(shard_bytes * compression_ratio / bytes_per_chunk), 1)
+    # the shards are planned on the chunk grid, so that they are always a multiple of the chunks
+    grid_shape = [math.ceil(sh / ch) for sh, ch in zip(shape, chunks)]
+    shard_grid = _grow([1] * len(shape), grid_shape, primary + secondary, max_chunks_per_shard)
+    return tuple(sg * ch for sg, ch in zip(shard_grid, chunks))
+
+
+def plan_pyramid_chunks(shapes, dtype, axes_names, **kwargs):
+    """Plan the chunk shapes for all levels of a multiscale pyramid with the given shapes.
+    """
+    return [plan_chunks(shape, dtype, axes_names, **kwargs) for shape in shapes]
+
+
+def format_chunk_plan(plan):
+    msg = f"chunks: {plan['chunks']}, number of chunks: {plan['n_chunks']}, "
+    msg += f"bytes per chunk: {plan['bytes_per_chunk']}"
+    if "shards" in plan:
+        msg += f", shards: {plan['shards']}, number of shards: {plan['n_shards']}"
+    return msg
@@ -0,0 +1,110 @@
+import itertools
+
+import numpy as np
+
+
+def _normalize_scale_factor(scale_factor, ndim):
+    # a scalar scale factor is used for all axes, like a scalar scale for skimage.transform.rescale
+    if np.isscalar(scale_factor):
+        return (scale_factor,) * ndim
+    assert len(scale_factor) == ndim, f"{scale_factor}, {ndim}"
+    return tuple(scale_factor)
+
+
+def _get_block_views(data, scale_factor):
+    scale_factor = _normalize_scale_factor(scale_factor, data.ndim)
+    # pad the data to a multiple of the scale factor (this is only necessary at the border)
+    pad_width = [(0, -sh % fac) for sh, fac in zip(data.shape, scale_factor)]
+    if any(pw[1] > 0 for pw in pad_width):
+        data = np.pad(data, pad_width, mode="edge")
+    # return one strided view per position in the block; reducing over these views is much faster
+    # than reshaping the data into blocks and reducing over the (non-contiguous) block axes
+    return [
+        data[tuple(slice(off, None, fac) for off, fac in zip(offset, scale_factor))]
+        for offset in itertools.product(*[range(fac) for fac in scale_factor])
+    ]
+
+
+def get_downscaled_shape(shape, scale_factor):
+    scale_factor = _normalize_scale_factor(scale_factor, len(shape))
+    return tuple(-(-sh // fac) for sh, fac in zip(shape, scale_factor))
+
+
+def downscale_mean(data, scale_factor):
+    """Downscale by averaging over blocks of size scale_factor.
+    """
+    views = _get_block_views(data, scale_factor)
+    is_integer = np.issubdtype(data.dtype, np.integer)
+    acc = np.zeros(views[0].shape, dtype="int64" if is_integer else "float64")
+    for view in views:
+        acc += view
+    n = len(views)
+    if is_integer:  # divide with rounding
+        acc += n // 2
+        acc //= n
+    else:
+        acc /= n
+    return acc.astype(data.dtype)
+
+
+def downscale_max(data, scale_factor):
+    """Downscale by taking the maximum over blocks of size scale_factor.
+    """
+    views = _get_block_views(data, scale_factor)
+    downscaled = views[0].copy()
+    for view in views[1:]:
+        np.maximum(downscaled, view, out=downscaled)
+    return downscaled
+
+
+def downscale_nearest(data, scale_factor):
+    """Downscale by taking every scale_factor-th value.
+    """
+    scale_factor = _normalize_scale_factor(scale_factor, data.ndim)
+    return np.ascontiguousarray(data[tuple(slice(None, None, fac) for fac in scale_factor)])
+
+
+def downscale_mode(data, scale_factor):
+    """Downscale by taking the most frequent value over blocks of size scale_factor.
+
+    This is the appropriate downscaling for label images. Ties are resolved in favor
+    of the value that occurs first in the block.
+    """
+    views = _get_block_views(data, scale_factor)
+    downscaled = views[0].copy()
+    max_count = np.zeros(downscaled.shape, dtype="uint16")
+    # count how often the value of each block position occurs in the block
+    # and keep the value with the highest count
+    for view in views:
+        count = np.zeros(downscaled.shape, dtype="uint16")
+        for other in views:
+            count += (view == other)
+        update = count > max_count
+        downscaled[update] = view[update]
+        max_count[update] = count[update]
+    return downscaled
+
+
+DOWNSCALERS = {
+    "mean": downscale_mean,
+    "max": downscale_max,
+    "nearest": downscale_nearest,
+    "mode": downscale_mode,
+}
+
+
+def get_downscaler(name, kwargs):
+    """Get one of the integer factor downscaling functions by name.
+
+    Returns the function and the kwargs to call it with. The scale factor is taken from the
+    'scale_factor' kwarg or derived from the 'scale' kwarg used for skimage.transform.rescale.
+    """
+    assert name in DOWNSCALERS, f"Invalid downscaler {name}, choose one of {list(DOWNSCALERS.keys())}"
+    if "scale_factor" in kwargs:
+        scale_factor = kwargs["scale_factor"]
+    elif np.isscalar(kwargs["scale"]):
+        scale_factor = int(round(1.0 / kwargs["scale"]))
+    else:
+        scale_factor = [int(round(1.0 / sc)) for sc in kwargs["scale"]]
+    # a scalar scale factor is used for all (spatial) axes
+    return DOWNSCALERS[name], {"scale_factor": scale_factor if np.isscalar(scale_factor) else list(scale_factor)}
@@ -0,0 +1,101 @@
+import json
+import os
+from concurrent import futures
+from shutil import rmtree
+
+import zarr
+
+from .v04 import write_ome_zarr
+
+
+def _sort_key(name):
+    # sort the numeric column and field names by their value, i.e. 2 before 10
+    return (0, int(name), "") if name.isdigit() else (1, 0, name)
+
+
+def _is_written(path, key):
+    # write_ome_zarr writes the multiscales metadata after all scale levels,
+    # so a field is complete if its metadata exists
+    attrs_path = os.path.join(path, key, ".zattrs")
+    if not os.path.exists(attrs_path):
+        return False
+    with open(attrs_path) as f:
+        return "multiscales" in json.load(f)
+
+
+def get_plate_metadata(fields, rows=None, columns=None, name=None):
+    """Get the ome-ngff plate metadata and the well metadata for the given (row, column, field) keys.
+    """
+    rows = sorted({row for row, _, _ in fields}, key=_sort_key) if rows is None else [str(row) for row in rows]
+    columns = sorted({col for _, col, _ in fields}, key=_sort_key) if columns is None else [str(col) for col in columns]
+
+    well_fields = {}
+    for row, col, field in fields:
+        well_fields.setdefault((row, col), []).append(field)
+    wells = sorted(well_fields, key=lambda well: (rows.index(well[0]), columns.index(well[1])))
+
+    plate = {
+        "columns": [{"name": col} for col in columns],
+        "rows": [{"name": row} for row in rows],
+        "wells": [
+            {"path": f"{row}/{col}", "rowIndex": rows.index(row), "columnIndex": columns.index(col)}
+            for row, col in wells
+        ],
+        "field_count": max(len(well) for well in well_fields.values()),
+        "version": "0.4",
+    }
+    if name is not None:
+        plate["name"] = name
+    well_metadata = {
+        f"{row}/{col}": {
+            "images": [{"path": field} for field in sorted(well_fields[(row, col)], key=_sort_key)],
+            "version": "0.4",
+        }
+        for row, col in wells
+    }
+    return plate, well_metadata
+
+
+def write_plate_ome_zarr(fields, path, axes_names, n_scales, name=None, rows=None, columns=None,
+                         n_workers=4, consolidate=False, image_name=None, **kwargs):
+    """Write the fields of view of a HCS plate to ome.zarr with the layout <row>/<column>/<field>.
+
+    fields maps (row, column, field) to the image data of the field or to a function that loads it,
+    so that at most n_workers fields are loaded at a time. The fields are written in parallel with write_ome_zarr,
+    the other kwargs are passed to it. Fields that were completely written by a previous call are skipped,
+    so an interrupted conversion can be resumed. The well and plate metadata is written once at the end.
+    The multiscales of each field is named after the field, or by image_name(row, column, field) if it is given.
+    Returns the number of written and skipped fields.
+    """
+    assert "key" not in kwargs and "prefix" not in kwargs, "The layout of the fields is given by the plate"
+    fields = {tuple(str(k) for k in field_key): data for field_key, data in fields.items()}
+    assert all(len(field_key) == 3 for field_key in fields), "The fields must be given as (row, column, field)"
+
+    root = zarr.open(path, mode="a")
+    # create the well groups up front, so that the workers don't race to create them
+    for row, col, _ in fields:
+        root.require_group(f"{row}/{col}")
+
+    keys = sorted(fields, key=lambda field_key: tuple(_sort_key(k) for k in field_key))
+    todo = [field_key for field_key in keys if not _is_written(path, "/".join(field_key))]
+
+    def write_field(field_key):
+        key = "/".join(field_key)
+        # remove the data of a field that was only partially written by an interrupted run
+        if os.path.exists(os.path.join(path, key)):
+            rmtree(os.path.join(path, key))
+        data = fields[field_key]
+        data = data() if callable(data) else data
+        field_name = field_key[2] if image_name is None else image_name(*field_key)
+        write_ome_zarr(data, path, axes_names, field_name, n_scales, key=key, **kwargs)
+
+    with futures.ThreadPoolExecutor(n_workers) as tp:
+        list(tp.map(write_field, todo))
+
+    plate, well_metadata = get_plate_metadata(list(fields), rows=rows, columns=columns, name=name)
+    for well_path, well in well_metadata.items():
+        root[well_path].attrs["well"] = well
+    root.attrs["plate"] = plate
+    if consolidate:
+        zarr.consolidate_metadata(path)
+    return {"written": len(todo), "skipped": len(fields) - len(todo)}
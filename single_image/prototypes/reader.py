@@ -0,0 +1,390 @@
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent import futures
+
+import numpy as np
+import zarr
+
+# the implicit axes of ome-ngff 0.1 and 0.2, which do not have axes metadata
+DEFAULT_AXES_NAMES = ("t", "c", "z", "y", "x")
+
+
+class ChunkCache:
+    """Thread-safe LRU cache for decoded chunks that holds at most max_bytes.
+    """
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits, self.misses = 0, 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._chunks.move_to_end(key)
+            return chunk
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._chunks
+
+    def put(self, key, chunk):
+        # chunks that are larger than the cache are not cached
+        if chunk.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._chunks:
+                self._chunks.move_to_end(key)
+                return
+            # the cached chunks are shared, so they must not be modified
+            chunk.flags.writeable = False
+            self._chunks[key] = chunk
+            self.n_bytes += chunk.nbytes
+            # evict the least recently used chunks
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.n_bytes = 0
+
+
+def _normalize_selection(key, shape):
+    # translate a numpy style selection of integers, slices and ellipsis
+    # into the bounding box to load, the steps within the box and the axes to squeeze
+    key = key if isinstance(key, tuple) else (key,)
+    if any(k is Ellipsis for k in key):
+        ell = key.index(Ellipsis)
+        key = key[:ell] + (slice(None),) * (len(shape) - len(key) + 1) + key[ell + 1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+    assert len(key) == len(shape), f"Invalid selection {key} for shape {shape}"
+
+    bb, steps, squeeze = [], [], []
+    for axis, (k, sh) in enumerate(zip(key, shape)):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(sh)
+            assert step > 0, "Negative steps are not supported"
+            bb.append(slice(start, max(start, stop)))
+            steps.append(slice(None, None, step))
+        else:
+            k = int(k)
+            k = k + sh if k < 0 else k
+            assert 0 <= k < sh, f"Index {k} is out of bounds for axis {axis} with size {sh}"
+            bb.append(slice(k, k + 1))
+            steps.append(slice(None))
+            squeeze.append(axis)
+    return tuple(bb), tuple(steps), tuple(squeeze)
+
+
+class MultiscaleLevel:
+    """Lazy array for one scale level, the chunks are loaded through the chunk cache when the level is indexed.
+
+    scale and translation map the array indices to physical coordinates: coordinate = translation + scale * index.
+    """
+    def __init__(self, array, scale, translation, cache, prefetch_pool=None, prefetch_axis=None, n_prefetch=1):
+        self.array = array
+        self.scale = tuple(scale)
+        self.translation = tuple(translation)
+        self.cache = cache
+        self.prefetch_pool = prefetch_pool
+        self.prefetch_axis = prefetch_axis
+        self.n_prefetch = n_prefetch
+        self._last_chunk_pos = None
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def chunks(self):
+        return self.array.chunks
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    def get_coordinates(self, axis):
+        """Get the physical coordinates of the pixel (centers) along the axis.
+        """
+        return self.translation[axis] + self.scale[axis] * np.arange(self.shape[axis])
+
+    def _chunk_key(self, chunk_id):
+        return (getattr(self.array.store, "path", id(self.array.store)), self.array.path, chunk_id)
+
+    def get_chunk(self, chunk_id):
+        """Get the decoded chunk, from the cache if possible.
+        """
+        key = self._chunk_key(chunk_id)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            chunk = self.array.blocks[chunk_id]
+            self.cache.put(key, chunk)
+        return chunk
+
+    def _prefetch_chunk(self, chunk_id):
+        if self._chunk_key(chunk_id) not in self.cache:
+            self.cache.put(self._chunk_key(chunk_id), self.array.blocks[chunk_id])
+
+    def _prefetch(self, chunk_ids):
+        # prefetch the next chunks along the prefetch axis in the direction in which the data is browsed
+        # (or in both directions for the first read), so that sequential slice browsing hits the cache
+        axis = self.prefetch_axis
+        if self.prefetch_pool is None or axis is None or not chunk_ids:
+            return
+        positions = sorted({cid[axis] for cid in chunk_ids})
+        last_pos, self._last_chunk_pos = self._last_chunk_pos, positions
+        if last_pos is None or positions == last_pos:
+            offsets = [off for step in range(1, self.n_prefetch + 1) for off in (-step, step)]
+        elif positions[0] > last_pos[0]:
+            offsets = list(range(1, self.n_prefetch + 1))
+        else:
+            offsets = list(range(-self.n_prefetch, 0))
+        n_chunks = self.array.cdata_shape[axis]
+        for offset in offsets:
+            pos = positions[-1] + offset if offset > 0 else positions[0] + offset
+            if not 0 <= pos < n_chunks:
+                continue
+            for chunk_id in {cid[:axis] + (pos,) + cid[axis + 1:] for cid in chunk_ids}:
+                self.prefetch_pool.submit(self._prefetch_chunk, chunk_id)
+
+    def read(self, bb):
+        """Read the bounding box bb (tuple of slices with step 1) from the chunks that intersect it.
+        """
+        out = np.empty(tuple(b.stop - b.start for b in bb), dtype=self.dtype)
+        chunk_ranges = [
+            range(b.start // ch, -(-b.stop // ch)) for b, ch in zip(bb, self.chunks)
+        ]
+        chunk_ids = list(np.ndindex(*[len(cr) for cr in chunk_ranges]))
+        chunk_ids = [tuple(cr[cid] for cr, cid in zip(chunk_ranges, chunk_id)) for chunk_id in chunk_ids]
+        for chunk_id in chunk_ids:
+            chunk = self.get_chunk(chunk_id)
+            chunk_start = [cid * ch for cid, ch in zip(chunk_id, self.chunks)]
+            # the overlap of the chunk and the bounding box, in the coordinates of the chunk and the output
+            chunk_bb = tuple(
+                slice(max(b.start - cs, 0), min(b.stop - cs, csh))
+                for b, cs, csh in zip(bb, chunk_start, chunk.shape)
+            )
+            out_bb = tuple(
+                slice(cs + cb.start - b.start, cs + cb.stop - b.start)
+                for b, cs, cb in zip(bb, chunk_start, chunk_bb)
+            )
+            out[out_bb] = chunk[chunk_bb]
+        self._prefetch(chunk_ids)
+        return out
+
+    def __getitem__(self, key):
+        bb, steps, squeeze = _normalize_selection(key, self.shape)
+        out = self.read(bb)[steps]
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+
+class MultiscaleImage:
+    """Multiscale image that is parsed from the ome-ngff metadata (version 0.1 - 0.4) once.
+
+    The scale levels share a single chunk cache and a thread pool for prefetching. If no pool is passed,
+    the image creates its own pool, which is shut down by close() or when the image is garbage collected.
+    """
+    def __init__(self, group, ms_entry, cache, n_prefetch=1, n_prefetch_workers=4, prefetch_pool=None):
+        self.name = ms_entry.get("name")
+        self.version = ms_entry.get("version")
+        self.axes_names, self.units = _parse_axes(ms_entry)
+        self.cache = cache
+        self._finalizer = None
+        if n_prefetch == 0:
+            prefetch_pool = None
+        elif prefetch_pool is None:
+            prefetch_pool = futures.ThreadPoolExecutor(n_prefetch_workers)
+            self._finalizer = weakref.finalize(self, prefetch_pool.shutdown, wait=False)
+        self.prefetch_pool = prefetch_pool
+
+        arrays = [group[ds["path"]] for ds in ms_entry["datasets"]]
+        transforms = _parse_transforms(ms_entry, arrays, self.axes_names)
+        # browsing goes through z-slices (or through time points for 2d data)
+        prefetch_axis = None
+        for ax in ("z", "t"):
+            if ax in self.axes_names:
+                prefetch_axis = self.axes_names.index(ax)
+                break
+        self.levels = [
+            MultiscaleLevel(array, scale, translation, cache, self.prefetch_pool, prefetch_axis, n_prefetch)
+            for array, (scale, translation) in zip(arrays, transforms)
+        ]
+
+    def __getitem__(self, level):
+        return self.levels[level]
+
+    def __len__(self):
+        return len(self.levels)
+
+    def _get_spatial_values(self, value):
+        # translate a scalar for all spatial axes or a dict of axis names to values into per axis values
+        if isinstance(value, dict):
+            return [value.get(ax) for ax in self.axes_names]
+        return [value if ax in "zyx" else None for ax in self.axes_names]
+
+    def get_region_bb(self, level, roi=None):
+        """Get the bounding box in the array coordinates of the level for a region in physical coordinates.
+
+        roi maps axis names to the (min, max) physical coordinates of the region, axes that are not in roi
+        are selected fully. The bounding box contains all pixels with a center inside of the region.
+        """
+        level = self.levels[level]
+        roi = {} if roi is None else roi
+        assert all(ax in self.axes_names for ax in roi), f"Invalid axes in {roi}, expected {self.axes_names}"
+        bb = []
+        for ax, sh, sc, tr in zip(self.axes_names, level.shape, level.scale, level.translation):
+            if ax not in roi:
+                bb.append(slice(0, sh))
+                continue
+            min_coord, max_coord = roi[ax]
+            # tolerate floating point errors in the coordinates
+            start = int(np.ceil((min_coord - tr) / sc - 1e-6))
+            stop = int(np.floor((max_coord - tr) / sc + 1e-6)) + 1
+            start, stop = min(max(start, 0), sh), min(max(stop, 0), sh)
+            bb.append(slice(start, max(start, stop)))
+        return tuple(bb)
+
+    def select_level(self, roi=None, resolution=None, max_pixels=None):
+        """Select the scale level to read a region in physical coordinates from.
+
+        If resolution (the pixel size in physical units, a scalar for all spatial axes or a dict of axis names
+        to pixel sizes) is given, the coarsest level that has at least this resolution is selected.
+        If max_pixels is given, coarser levels are selected until the region has at most max_pixels pixels.
+        """
+        level_id = 0
+        if resolution is not None:
+            resolution = self._get_spatial_values(resolution)
+            for ii, level in enumerate(self.levels):
+                if all(res is None or sc <= res * (1 + 1e-6) for sc, res in zip(level.scale, resolution)):
+                    level_id = ii
+        if max_pixels is not None:
+            while level_id < len(self.levels) - 1:
+                bb = self.get_region_bb(level_id, roi)
+                if int(np.prod([b.stop - b.start for b in bb])) <= max_pixels:
+                    break
+                level_id += 1
+        return level_id
+
+    def read_region(self, roi=None, resolution=None, max_pixels=None, level=None):
+        """Read a region in physical coordinates from the cheapest sufficient scale level.
+
+        The arguments roi, resolution and max_pixels are explained in get_region_bb and select_level.
+        Only the chunks that intersect with the region are read. Returns the data, the ome-ngff
+        coordinate transformations that map its pixels to physical coordinates and the selected level.
+        """
+        level = self.select_level(roi, resolution, max_pixels) if level is None else level
+        bb = self.get_region_bb(level, roi)
+        scale = list(self.levels[level].scale)
+        translation = [tr + sc * b.start for tr, sc, b in zip(self.levels[level].translation, scale, bb)]
+        transforms = [{"type": "scale", "scale": scale}, {"type": "translation", "translation": translation}]
+        return self.levels[level].read(bb), transforms, level
+
+    def close(self):
+        # a pool that was passed in is shared with other images, so it is not shut down here
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self.prefetch_pool.shutdown(wait=True)
+            self._finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _parse_axes(ms_entry):
+    axes = ms_entry.get("axes")
+    # 0.1 and 0.2 do not have axes metadata, the data is always 5d
+    if axes is None:
+        return DEFAULT_AXES_NAMES, (None,) * len(DEFAULT_AXES_NAMES)
+    # 0.3 stores the axes names, 0.4 stores the axes as dicts with name, type and unit
+    if isinstance(axes[0], str):
+        return tuple(axes), (None,) * len(axes)
+    return tuple(ax["name"] for ax in axes), tuple(ax.get("unit") for ax in axes)
+
+
+def _get_transform(trafos, ndim):
+    scale, translation = np.ones(ndim), np.zeros(ndim)
+    for trafo in trafos:
+        if trafo["type"] == "scale":
+            scale = np.array(trafo["scale"], dtype="float64")
+        elif trafo["type"] == "translation":
+            translation = np.array(trafo["translation"], dtype="float64")
+    return scale, translation
+
+
+def _parse_transforms(ms_entry, arrays, axes_names):
+    ndim = arrays[0].ndim
+    # 0.4 stores the scale (and translation) for each dataset, and optionally for all datasets
+    if "coordinateTransformations" in ms_entry["datasets"][0]:
+        ms_scale, ms_translation = _get_transform(ms_entry.get("coordinateTransformations", []), ndim)
+        transforms = []
+        for ds in ms_entry["datasets"]:
+            scale, translation = _get_transform(ds["coordinateTransformations"], ndim)
+            transforms.append((scale * ms_scale, translation * ms_scale + ms_translation))
+        return transforms
+    # earlier versions don't have transformations, so we derive the scale of the spatial axes from the shape
+    # relative to the previous scale level. the shape ratio is rounded to the integer downscaling factor,
+    # which it only approximates for shapes that are not divisible by the factor (e.g. 301 / 150)
+    transforms, scale = [], np.ones(ndim)
+    for prev, array in zip([arrays[0]] + arrays[:-1], arrays):
+        factors = [
+            max(1, round(prev_sh / sh)) if ax in "zyx" else 1
+            for ax, prev_sh, sh in zip(axes_names, prev.shape, array.shape)
+        ]
+        scale = scale * np.array(factors, dtype="float64")
+        transforms.append((scale, np.zeros(ndim)))
+    return transforms
+
+
+def _open_container(path, consolidated):
+    # an opened container can be passed to open multiple images without reading the metadata again
+    if isinstance(path, zarr.Group):
+        return path
+    # with consolidated metadata the metadata of all groups and arrays is read at once from '.zmetadata'
+    if consolidated is None or consolidated:
+        try:
+            return zarr.open_consolidated(path, mode="r")
+        except KeyError:
+            if consolidated:
+                raise
+    return zarr.open(path, mode="r")
+
+
+def open_multiscales(path, key=None, name=None, cache=None, cache_bytes=2**28, n_prefetch=1, n_prefetch_workers=4,
+                     prefetch_pool=None, consolidated=None):
+    """Open a multiscale image from an ome.zarr file written by the prototypes.
+
+    path can be a file path, url, zarr store or an opened zarr group.
+    The image is selected by its name in the multiscales metadata, or the first image is used.
+    A chunk cache can be passed to share it between images, otherwise a new cache with cache_bytes is created.
+    n_prefetch chunks are prefetched along the z (or t) axis in the direction in which the data is read.
+    Like the cache, a thread pool for prefetching can be passed to share it between images,
+    otherwise a pool with n_prefetch_workers is created for the image (see MultiscaleImage.close).
+    The consolidated metadata is used if it exists, unless consolidated is False.
+    """
+    f = _open_container(path, consolidated)
+    g = f if key is None else f[key]
+    multiscales = g.attrs["multiscales"]
+    if name is None:
+        ms_entry = multiscales[0]
+    else:
+        ms_entries = [ms for ms in multiscales if ms.get("name") == name]
+        assert len(ms_entries) == 1, f"Could not find the multiscales entry {name}"
+        ms_entry = ms_entries[0]
+    cache = ChunkCache(cache_bytes) if cache is None else cache
+    return MultiscaleImage(g, ms_entry, cache, n_prefetch=n_prefetch, n_prefetch_workers=n_prefetch_workers,
+                           prefetch_pool=prefetch_pool)
@@ -0,0 +1,162 @@
+import io
+import posixpath
+import threading
+
+import numpy as np
+import zarr
+
+from .v03 import _get_blocks
+
+# the statistics are stored in a single npz file next to the scale levels
+STATISTICS_KEY = "statistics.npz"
+
+
+def _get_histogram_offset(dtype):
+    # the histogram has one bin per value, which is only feasible for 8 and 16 bit integers
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2:
+        return int(np.iinfo(dtype).min)
+    return None
+
+
+class StatisticsDataset:
+    """Wrapper around a zarr array that records the statistics of the chunks that are written to it.
+
+    The min, max and mean value of each chunk, whether the chunk is empty (i.e. only contains the fill value)
+    and a histogram of all values (for 8 and 16 bit integer data) are recorded.
+    The data must be written in blocks that are aligned with the chunks, and each chunk must be written once.
+    """
+    def __init__(self, ds):
+        self.ds = ds
+        grid_shape = ds.cdata_shape
+        self.min = np.zeros(grid_shape, dtype=ds.dtype)
+        self.max = np.zeros(grid_shape, dtype=ds.dtype)
+        self.mean = np.zeros(grid_shape, dtype="float64")
+        # chunks that are never written only contain the fill value
+        self.empty = np.ones(grid_shape, dtype="bool")
+        self.fill_value = 0 if ds.fill_value is None else ds.fill_value
+        self.histogram_offset = _get_histogram_offset(ds.dtype)
+        if self.histogram_offset is None:
+            self.histogram = None
+        else:
+            self.histogram = np.zeros(2 ** (8 * ds.dtype.itemsize), dtype="int64")
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.ds.shape
+
+    @property
+    def chunks(self):
+        return self.ds.chunks
+
+    @property
+    def dtype(self):
+        return self.ds.dtype
+
+    @property
+    def attrs(self):
+        return self.ds.attrs
+
+    def __getitem__(self, bb):
+        return self.ds[bb]
+
+    def __setitem__(self, bb, data):
+        self.ds[bb] = data
+        data = np.asarray(data)
+        if data.size == 0:
+            return
+        assert all(b.start % ch == 0 for b, ch in zip(bb, self.chunks)), f"{bb} is not aligned with {self.chunks}"
+        block_offset = [b.start // ch for b, ch in zip(bb, self.chunks)]
+        # the chunks are computed by different threads, so each entry is only written by a single thread
+        for chunk_bb in _get_blocks(data.shape, self.chunks):
+            chunk = data[chunk_bb]
+            chunk_id = tuple(off + cb.start // ch for off, cb, ch in zip(block_offset, chunk_bb, self.chunks))
+            self.min[chunk_id] = chunk.min()
+            self.max[chunk_id] = chunk.max()
+            self.mean[chunk_id] = chunk.mean()
+            self.empty[chunk_id] = bool((chunk == self.fill_value).all())
+        if self.histogram is not None:
+            values = data.ravel()
+            if self.histogram_offset != 0:
+                values = values.astype("int64") - self.histogram_offset
+            counts = np.bincount(values, minlength=len(self.histogram))
+            with self._lock:
+                self.histogram += counts
+
+
+def write_statistics(store, root, datasets):
+    """Write the statistics recorded by the StatisticsDataset for each scale level to the store.
+    """
+    arrays = {}
+    for level, ds in enumerate(datasets):
+        prefix = f"s{level}"
+        arrays.update({
+            f"{prefix}/shape": np.array(ds.shape), f"{prefix}/chunks": np.array(ds.chunks),
+            f"{prefix}/min": ds.min, f"{prefix}/max": ds.max, f"{prefix}/mean": ds.mean, f"{prefix}/empty": ds.empty,
+        })
+        if ds.histogram is not None:
+            arrays[f"{prefix}/histogram"] = ds.histogram
+            arrays[f"{prefix}/histogram_offset"] = np.array(ds.histogram_offset)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    store[posixpath.join(root, STATISTICS_KEY)] = buffer.getvalue()
+
+
+def load_statistics(path, key=None, prefix=None):
+    """Load the statistics written by prototypes.v04.write_ome_zarr with statistics=True.
+
+    Returns a list with a dict of the statistics for each scale level.
+    """
+    f = zarr.open(path, mode="r")
+    root = "" if key is None else key
+    root = root if prefix is None else posixpath.join(root, prefix)
+    with np.load(io.BytesIO(f.store[posixpath.join(root, STATISTICS_KEY)])) as data:
+        arrays = {name: data[name] for name in data.files}
+    n_levels = len({name.split("/")[0] for name in arrays})
+    return [
+        {name.split("/")[1]: arr for name, arr in arrays.items() if name.split("/")[0] == f"s{level}"}
+        for level in range(n_levels)
+    ]
+
+
+def find_chunks(statistics, level=0, min_value=None, max_value=None, skip_empty=True):
+    """Find the chunks of a scale level that contain values in the range [min_value, max_value].
+
+    Only the statistics are used to find the chunks, so empty chunks and chunks with values outside
+    of the range are skipped without reading them. E.g. use min_value = max_value = label_id to find
+    the chunks that may contain a given label. Returns the bounding boxes of the chunks.
+    """
+    stats = statistics[level]
+    mask = np.ones(stats["empty"].shape, dtype="bool")
+    if skip_empty:
+        mask &= ~stats["empty"]
+    if min_value is not None:
+        mask &= stats["max"] >= min_value
+    if max_value is not None:
+        mask &= stats["min"] <= max_value
+    shape, chunks = stats["shape"], stats["chunks"]
+    return [
+        tuple(slice(int(cid * ch), int(min((cid + 1) * ch, sh))) for cid, ch, sh in zip(chunk_id, chunks, shape))
+        for chunk_id in zip(*np.where(mask))
+    ]
+
+
+def get_contrast_limits(statistics, level=0, percentiles=(0.5, 99.5)):
+    """Get the contrast limits for displaying the data from the statistics.
+
+    The limits are computed from the percentiles of the histogram if it is available,
+    otherwise the min and max value of the non-empty chunks are returned.
+    """
+    stats = statistics[level]
+    if "histogram" in stats:
+        cumulative = np.cumsum(stats["histogram"])
+        limits = [
+            int(np.searchsorted(cumulative, perc / 100.0 * cumulative[-1])) + int(stats["histogram_offset"])
+            for perc in percentiles
+        ]
+        return tuple(limits)
+    non_empty = ~stats["empty"]
+    if not non_empty.any():
+        return (0, 0)
+    return (stats["min"][non_empty].min(), stats["max"][non_empty].max())
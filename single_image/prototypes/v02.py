@@ -2,6 +2,9 @@ import numpy as np
 import skimage.transform
 import zarr
 
+from .downscaling import get_downscaler
+from .v03 import _get_level_chunks, _get_level_codecs, _write_multiscale
+
 AXES_NAMES = {"t", "c", "z", "y", "x"}
 
 
@@ -34,33 +37,6 @@ def _validate_axes_names(ndim, axes_names):
         assert val_axes == ("t", "c", "z", "y", "x"), str(val_axes)
 
 
-def _downscale(data, axes_names, downscaler, kwargs):
-    is_spatial = [ax in ("z", "y", "x") for ax in axes_names]
-    # downscaling is easy if we only have spatial axes
-    if all(is_spatial):
-        data = downscaler(data, **kwargs).astype(data.dtype)
-    else:
-        spatial_start = [i for i, spatial in enumerate(is_spatial) if spatial][0]
-        assert spatial_start in (1, 2), str(spatial_start)
-        if spatial_start == 1:
-            downscaled_data = []
-            for d in data:
-                ds = downscaler(d, **kwargs).astype(data.dtype)
-                downscaled_data.append(ds[None])
-            data = np.concatenate(downscaled_data, axis=0)
-        else:
-            downscaled_data = []
-            for time_slice in data:
-                downscaled_channel = []
-                for channel_slice in time_slice:
-                    ds = downscaler(channel_slice, **kwargs).astype(data.dtype)
-                    downscaled_channel.append(ds[None])
-                downscaled_channel = np.concatenate(downscaled_channel, axis=0)
-                downscaled_data.append(downscaled_channel[None])
-            data = np.concatenate(downscaled_data, axis=0)
-    return data
-
-
 def expand_data(data, axes_names):
     target_axes = tuple("tczyx")
     singletons = tuple(np.s_[:] if ax in axes_names else np.s_[None] for ax in target_axes)
@@ -69,16 +45,40 @@ def expand_data(data, axes_names):
     return expanded
 
 
+class _ExpandedDataset:
+    """Wrap a 5d dataset so that it can be written and read with data that has only the given axes.
+    """
+    def __init__(self, ds, axes_names):
+        self.ds = ds
+        self.axes_names = axes_names
+        self.shape = tuple(sh for ax, sh in zip("tczyx", ds.shape) if ax in axes_names)
+        self.chunks = tuple(ch for ax, ch in zip("tczyx", ds.chunks) if ax in axes_names)
+        self.dtype = ds.dtype
+
+    def __getitem__(self, bb):
+        bb = iter(bb)
+        return self.ds[tuple(next(bb) if ax in self.axes_names else 0 for ax in "tczyx")]
+
+    def __setitem__(self, bb, data):
+        bb = iter(bb)
+        expanded_bb = tuple(next(bb) if ax in self.axes_names else np.s_[:] for ax in "tczyx")
+        self.ds[expanded_bb] = expand_data(data, self.axes_names)
+
+
 def write_ome_zarr(data, path, axes_names, name, n_scales,
                    key=None, chunks=None,
                    downscaler=skimage.transform.rescale,
                    kwargs={"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True},
-                   dimension_separator="/", **extra_kwargs):
-    """Write numpy data to ome.zarr format.
+                   dimension_separator="/", n_workers=None, access_pattern=None,
+                   compressor="default", filters=None, consolidate=False, write_empty_chunks=False,
+                   **extra_kwargs):
+    """Write numpy data to ome.zarr format, see the README for the options.
     """
     assert dimension_separator in (".", "/")
     assert 2 <= data.ndim <= 5
     _validate_axes_names(data.ndim, axes_names)
+    if isinstance(downscaler, str):
+        downscaler, kwargs = get_downscaler(downscaler, kwargs)
 
     chunks = _get_chunks(axes_names) if chunks is None else chunks
     if dimension_separator == "/":
@@ -88,14 +88,26 @@ def write_ome_zarr(data, path, axes_names, name, n_scales,
 
     with zarr.open(store, mode="a") as f:
         g = f if key is None else f.require_group(key)
-        expanded_data = expand_data(data, axes_names)
-        g.create_dataset("s0", data=expanded_data, chunks=chunks, dimension_separator=dimension_separator)
-        for ii in range(1, n_scales):
-            data = _downscale(data, axes_names, downscaler, kwargs)
-            expanded_data = expand_data(data, axes_names)
-            g.create_dataset(f"s{ii}", data=expanded_data, chunks=chunks, dimension_separator=dimension_separator)
+
+        def create_dataset(ii, shape, dtype):
+            level_chunks = _get_level_chunks(chunks, shape, dtype, axes_names, access_pattern)
+            level_compressor, level_filters = _get_level_codecs(compressor, filters, ii)
+            if len(level_chunks) < 5:
+                level_chunks = iter(level_chunks)
+                level_chunks = tuple(next(level_chunks) if ax in axes_names else 1 for ax in "tczyx")
+            shape = iter(shape)
+            expanded_shape = tuple(next(shape) if ax in axes_names else 1 for ax in "tczyx")
+            ds = g.create_dataset(f"s{ii}", shape=expanded_shape, dtype=dtype, chunks=level_chunks,
+                                  compressor=level_compressor, filters=level_filters,
+                                  write_empty_chunks=write_empty_chunks,
+                                  dimension_separator=dimension_separator)
+            return _ExpandedDataset(ds, axes_names)
+
+        _write_multiscale(data, create_dataset, axes_names, n_scales, downscaler, kwargs, n_workers)
         function_name = f"{downscaler.__module__}.{downscaler.__name__}"
         create_ngff_metadata(g, name, type_=function_name, metadata=kwargs)
+        if consolidate:
+            zarr.consolidate_metadata(store)
 
 
 def create_ngff_metadata(g, name, type_=None, metadata=None):
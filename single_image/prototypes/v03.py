@@ -1,8 +1,17 @@
+import itertools
+import math
+from concurrent import futures
+
 import numpy as np
 import skimage.transform
 import zarr
 
+from .chunks import plan_chunks
+from .downscaling import DOWNSCALERS, get_downscaled_shape, get_downscaler
+
 AXES_NAMES = {"t", "c", "z", "y", "x"}
+# the memory for the tiles that are processed at a time by the tiled pyramid writer
+MAX_TILE_BYTES = 2**28
 
 
 def _get_chunks(axes_names):
@@ -16,6 +25,24 @@ def _get_chunks(axes_names):
         return (1, 1, 64, 64, 64)
 
 
+def _get_level_chunks(chunks, shape, dtype, axes_names, access_pattern):
+    # plan the chunks for each scale level individually
+    if isinstance(chunks, str) and chunks == "auto":
+        return plan_chunks(shape, dtype, axes_names, access_pattern)["chunks"]
+    return chunks
+
+
+def _get_level_codecs(compressor, filters, level):
+    # the compressor and filters can be given per scale level as a list,
+    # the last entry is used for all further scale levels
+    if isinstance(compressor, (list, tuple)):
+        compressor = compressor[min(level, len(compressor) - 1)]
+    # filters are a list of codecs, so the per level filters are a list of lists
+    if filters and all(filt is None or isinstance(filt, (list, tuple)) for filt in filters):
+        filters = filters[min(level, len(filters) - 1)]
+    return compressor, filters
+
+
 def _validate_axes_names(ndim, axes_names):
     assert len(axes_names) == ndim
     val_axes = tuple(axes_names)
@@ -29,7 +56,29 @@ def _validate_axes_names(ndim, axes_names):
         assert val_axes == ("t", "c", "z", "y", "x"), str(val_axes)
 
 
-def _downscale(data, axes_names, downscaler, kwargs):
+def _map(func, items, n_workers):
+    if n_workers is not None and n_workers > 1:
+        with futures.ThreadPoolExecutor(n_workers) as tp:
+            return list(tp.map(func, items))
+    return [func(item) for item in items]
+
+
+def _get_blocks(shape, block_shape):
+    n_blocks = [math.ceil(sh / bs) for sh, bs in zip(shape, block_shape)]
+    for block_id in itertools.product(*[range(nb) for nb in n_blocks]):
+        yield tuple(
+            slice(bid * bs, min((bid + 1) * bs, sh)) for bid, bs, sh in zip(block_id, block_shape, shape)
+        )
+
+
+def _write_data(ds, data, n_workers=1):
+    # the blocks are aligned with the chunks, so they can be written in parallel without locking
+    def _write_block(bb):
+        ds[bb] = data[bb]
+    _map(_write_block, _get_blocks(ds.shape, ds.chunks), n_workers)
+
+
+def _downscale(data, axes_names, downscaler, kwargs, n_workers=1):
     is_spatial = [ax in ("z", "y", "x") for ax in axes_names]
     # downscaling is easy if we only have spatial axes
     if all(is_spatial):
@@ -37,36 +86,175 @@ def _downscale(data, axes_names, downscaler, kwargs):
     else:
         spatial_start = [i for i, spatial in enumerate(is_spatial) if spatial][0]
         assert spatial_start in (1, 2), str(spatial_start)
-        if spatial_start == 1:
-            downscaled_data = []
-            for d in data:
-                ds = downscaler(d, **kwargs).astype(data.dtype)
-                downscaled_data.append(ds[None])
-            data = np.concatenate(downscaled_data, axis=0)
-        else:
-            downscaled_data = []
-            for time_slice in data:
-                downscaled_channel = []
-                for channel_slice in time_slice:
-                    ds = downscaler(channel_slice, **kwargs).astype(data.dtype)
-                    downscaled_channel.append(ds[None])
-                downscaled_channel = np.concatenate(downscaled_channel, axis=0)
-                downscaled_data.append(downscaled_channel[None])
-            data = np.concatenate(downscaled_data, axis=0)
+        # downscale the time and / or channel slices independently
+        # and write them to the pre-allocated output to avoid concatenating copies of the data
+        slice_ids = list(np.ndindex(*data.shape[:spatial_start]))
+        first_slice = downscaler(data[slice_ids[0]], **kwargs).astype(data.dtype)
+        downscaled_data = np.empty(data.shape[:spatial_start] + first_slice.shape, dtype=data.dtype)
+        downscaled_data[slice_ids[0]] = first_slice
+
+        def _downscale_slice(slice_id):
+            downscaled_data[slice_id] = downscaler(data[slice_id], **kwargs)
+
+        _map(_downscale_slice, slice_ids[1:], n_workers)
+        data = downscaled_data
     return data
 
 
+def _get_scale_factors(axes_names, kwargs):
+    # the downscaling kwargs only contain the scale (factor) for the spatial axes
+    n_spatial = len([ax for ax in axes_names if ax in "zyx"])
+    if "scale_factor" in kwargs:
+        spatial_factors = kwargs["scale_factor"]
+        spatial_factors = n_spatial * [spatial_factors] if np.isscalar(spatial_factors) else spatial_factors
+    elif "scale" in kwargs:
+        scale = kwargs["scale"]
+        scale = n_spatial * [scale] if np.isscalar(scale) else scale
+        spatial_factors = [int(round(1.0 / sc)) for sc in scale]
+    else:
+        raise ValueError(f"Can't determine the scale factors from the downscaling kwargs {list(kwargs)}, "
+                         "they need to contain 'scale' or 'scale_factor'")
+    assert len(spatial_factors) == n_spatial
+    spatial_factors = iter(spatial_factors)
+    return tuple(next(spatial_factors) if ax in "zyx" else 1 for ax in axes_names)
+
+
+def _is_block_local(downscaler):
+    # the integer factor downscalers compute each value from a block of scale_factor values,
+    # so downscaling blocks that are aligned with the scale factors gives the same result as downscaling
+    # the whole array. this is not the case for skimage.transform.rescale or other custom downscalers
+    return downscaler in DOWNSCALERS.values()
+
+
+def _get_level_shapes(shape, factors, n_scales, downscaler):
+    shapes = [tuple(shape)]
+    for _ in range(1, n_scales):
+        if downscaler in DOWNSCALERS.values():
+            shape = get_downscaled_shape(shape, factors)
+        else:  # round the shape in the same way as skimage.transform.rescale
+            shape = tuple(max(int(np.round(sh / fac)), 1) for sh, fac in zip(shape, factors))
+        shapes.append(shape)
+    return shapes
+
+
+def _get_tile_shape(shape, itemsize, datasets, factors, n_workers):
+    # grow the tile shape level by level, so that the tiles are aligned with the chunks of all these levels.
+    # the tile shape grows with factor**level, so we stop growing it once the tiles that are processed at a time
+    # (one per worker) would need more than MAX_TILE_BYTES, but we always include two levels so that each pass
+    # writes at least one downscaled level. returns the tile shape and the number of levels written from the tiles
+    tile_shape = [1] * len(shape)
+    for level, ds in enumerate(datasets):
+        next_shape = [math.lcm(ts, ch * fac**level) for ts, ch, fac in zip(tile_shape, ds.chunks, factors)]
+        tile_bytes = itemsize * math.prod(min(ts, sh) for ts, sh in zip(next_shape, shape))
+        if level > 1 and tile_bytes * (n_workers or 1) > MAX_TILE_BYTES:
+            return tile_shape, level
+        tile_shape = next_shape
+    return tile_shape, len(datasets)
+
+
+def _write_pyramid(data, datasets, axes_names, downscaler, kwargs, factors, n_workers=None, write_first=True):
+    # compute the scale levels in a single pass over tiles of the data:
+    # each tile is written to s0 and then successively downscaled and written to s1, ..., sN.
+    # the tile shape is chosen such that the tiles are aligned with the chunks of all scale levels,
+    # so that the tiles can be processed in parallel without locking.
+    # this is only correct for downscalers that give the same result for aligned blocks as for the whole array
+    tile_shape, n_levels = _get_tile_shape(data.shape, data.dtype.itemsize, datasets, factors, n_workers)
+
+    def _write_tile(bb):
+        block = data[bb]
+        if write_first:
+            datasets[0][bb] = block
+        for level, ds in enumerate(datasets[1:n_levels], 1):
+            block = _downscale(block, axes_names, downscaler, kwargs)
+            level_start = [b.start // fac**level for b, fac in zip(bb, factors)]
+            ds[tuple(slice(start, start + sh) for start, sh in zip(level_start, block.shape))] = block
+
+    _map(_write_tile, _get_blocks(data.shape, tile_shape), n_workers)
+    # if the tiles would become too large for the coarser levels, we compute the remaining levels
+    # in another pass over the last level that was written
+    if n_levels < len(datasets):
+        _write_pyramid(datasets[n_levels - 1], datasets[n_levels - 1:], axes_names, downscaler, kwargs, factors,
+                       n_workers, write_first=False)
+
+
+def _is_dask_array(data):
+    # dask is only imported for dask input, it is not needed otherwise
+    return type(data).__module__.split(".")[0] == "dask"
+
+
+def _get_dask_chunks(shape, chunks):
+    # the chunks of a zarr array in the format of dask, i.e. the extents of the chunks along each axis
+    return tuple((ch,) * (sh // ch) + ((sh % ch,) if sh % ch else ()) for sh, ch in zip(shape, chunks))
+
+
+def _get_input_chunks(level_chunks, factors, prev_shape):
+    # the blocks of the level above that are downscaled to the chunks of a level:
+    # each block ends at the end of the chunk times the scale factor, the last block extends to the end of the level
+    input_chunks = []
+    for dim_chunks, fac, sh in zip(level_chunks, factors, prev_shape):
+        dim_input_chunks = [ch * fac for ch in dim_chunks[:-1]]
+        input_chunks.append(tuple(dim_input_chunks + [sh - sum(dim_input_chunks)]))
+    return tuple(input_chunks)
+
+
+def _write_pyramid_dask(data, datasets, axes_names, downscaler, kwargs, factors, n_workers=None):
+    # express the s0 write and the computation of all scale levels as a single dask graph:
+    # each level is rechunked to the chunks of its dataset and the blocks of the next level are downscaled from
+    # the blocks of this level that correspond to its chunks, so the levels are computed chunk by chunk
+    # while streaming over the input and the task size does not grow with the number of levels
+    import dask.array as da
+
+    levels = [data.rechunk(_get_dask_chunks(data.shape, datasets[0].chunks))]
+    meta = np.empty((0,) * data.ndim, dtype=data.dtype)
+    for ds in datasets[1:]:
+        level_chunks = _get_dask_chunks(ds.shape, ds.chunks)
+        prev = levels[-1].rechunk(_get_input_chunks(level_chunks, factors, levels[-1].shape))
+        levels.append(prev.map_blocks(_downscale, axes_names, downscaler, kwargs, chunks=level_chunks, meta=meta))
+    # the blocks are aligned with the chunks, so they can be written without locking.
+    # the graph is run by the current dask scheduler, n_workers only sets the number of its workers if given
+    store_kwargs = {} if n_workers is None else {"num_workers": n_workers}
+    da.store(levels, datasets, lock=False, **store_kwargs)
+
+
+def _write_multiscale(data, create_dataset, axes_names, n_scales, downscaler, kwargs, n_workers=None):
+    # n_workers=None uses a single thread for numpy data and the default number of workers of the dask scheduler.
+    # the pyramid can only be computed tile by tile with a downscaler that works on blocks (see _is_block_local),
+    # otherwise we have to downscale the full data level by level
+    if not _is_block_local(downscaler):
+        if _is_dask_array(data):
+            data = data.compute()
+        ds = create_dataset(0, data.shape, data.dtype)
+        _write_data(ds, data, n_workers)
+        for ii in range(1, n_scales):
+            data = _downscale(data, axes_names, downscaler, kwargs, n_workers)
+            ds = create_dataset(ii, data.shape, data.dtype)
+            _write_data(ds, data, n_workers)
+        return
+
+    factors = _get_scale_factors(axes_names, kwargs)
+    shapes = _get_level_shapes(data.shape, factors, n_scales, downscaler)
+    datasets = [create_dataset(ii, shape, data.dtype) for ii, shape in enumerate(shapes)]
+    if _is_dask_array(data):
+        _write_pyramid_dask(data, datasets, axes_names, downscaler, kwargs, factors, n_workers)
+    else:
+        _write_pyramid(data, datasets, axes_names, downscaler, kwargs, factors, n_workers)
+
+
 def write_ome_zarr(data, path, axes_names, name, n_scales,
                    key=None, chunks=None,
                    downscaler=skimage.transform.rescale,
                    kwargs={"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True},
                    scale=None, units=None,
-                   dimension_separator="/", **extra_kwargs):
-    """Write numpy data to ome.zarr format.
+                   dimension_separator="/", n_workers=None, access_pattern=None,
+                   compressor="default", filters=None, consolidate=False, write_empty_chunks=False,
+                   **extra_kwargs):
+    """Write numpy data to ome.zarr format, see the README for the options.
     """
     assert dimension_separator in (".", "/")
     assert 2 <= data.ndim <= 5
     _validate_axes_names(data.ndim, axes_names)
+    if isinstance(downscaler, str):
+        downscaler, kwargs = get_downscaler(downscaler, kwargs)
 
     chunks = _get_chunks(axes_names) if chunks is None else chunks
     if dimension_separator == "/":
@@ -76,13 +264,21 @@ def write_ome_zarr(data, path, axes_names, name, n_scales,
 
     with zarr.open(store, mode="a") as f:
         g = f if key is None else f.require_group(key)
-        g.create_dataset("s0", data=data, chunks=chunks, dimension_separator=dimension_separator)
-        for ii in range(1, n_scales):
-            data = _downscale(data, axes_names, downscaler, kwargs)
-            g.create_dataset(f"s{ii}", data=data, chunks=chunks, dimension_separator=dimension_separator)
+
+        def create_dataset(ii, shape, dtype):
+            level_chunks = _get_level_chunks(chunks, shape, dtype, axes_names, access_pattern)
+            level_compressor, level_filters = _get_level_codecs(compressor, filters, ii)
+            return g.create_dataset(f"s{ii}", shape=shape, dtype=dtype, chunks=level_chunks,
+                                    compressor=level_compressor, filters=level_filters,
+                                    write_empty_chunks=write_empty_chunks,
+                                    dimension_separator=dimension_separator)
+
+        _write_multiscale(data, create_dataset, axes_names, n_scales, downscaler, kwargs, n_workers)
         function_name = f"{downscaler.__module__}.{downscaler.__name__}"
         create_ngff_metadata(g, name, axes_names,
                              type_=function_name, metadata=kwargs)
+        if consolidate:
+            zarr.consolidate_metadata(store)
 
 
 def create_ngff_metadata(g, name, axes_names, type_=None, metadata=None):
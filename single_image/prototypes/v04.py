@@ -1,7 +1,16 @@
+import importlib
+import itertools
+import json
+import posixpath
+from collections.abc import MutableMapping
+
 import skimage.transform
 import zarr
 
-from .v03 import _get_chunks, _downscale
+from .downscaling import get_downscaler
+from .statistics import STATISTICS_KEY, StatisticsDataset, write_statistics
+from .v03 import (_get_blocks, _get_chunks, _downscale, _get_level_chunks, _get_level_codecs,
+                  _get_level_shapes, _get_scale_factors, _is_block_local, _map, _write_data, _write_multiscale)
 
 AXES_TYPE_DICT = {
     "x": "space",
@@ -12,9 +21,10 @@ AXES_TYPE_DICT = {
 }
 
 
-def create_ngff_metadata(g, name, axes_names, scale=None, units=None, type_=None,
-                         metadata=None, time_scale=None, prefix=None):
-
+def get_multiscales_entry(name, axes_names, dataset_names, scale=None, units=None, type_=None,
+                          metadata=None, time_scale=None, prefix=None, scale_factor=None):
+    """Get the ome-ngff multiscales metadata entry for a multiscale dataset with the given dataset names.
+    """
     # axes metadata
     axes = [
         {"name": name, "type": AXES_TYPE_DICT[name]} for name in axes_names
@@ -32,20 +42,20 @@ def create_ngff_metadata(g, name, axes_names, scale=None, units=None, type_=None
     else:
         scale = [scale[ax] for ax in axes_names if ax in "xyz"]
 
-    # TODO read this from the downscaling args
-    scale_factor = 2
-
-    ds_root = g if prefix is None else g[prefix]
+    # the downscaling factor between scale levels for each spatial axis
+    if scale_factor is None:
+        scale_factor = [2] * len(spatial_dims)
+    assert len(scale_factor) == len(spatial_dims)
 
     # NOTE we might need a half pixel offset for proper scale alignment here (via a translation)
     n_non_spatial = len(axes_names) - len(spatial_dims)
     transforms = [
-        [{"type": "scale", "scale": [1] * n_non_spatial + [sc * scale_factor**i for sc in scale]}]
-        for i in range(len(ds_root))
+        [{"type": "scale", "scale": [1] * n_non_spatial + [sc * fac**i for sc, fac in zip(scale, scale_factor)]}]
+        for i in range(len(dataset_names))
     ]
     datasets = [
         {"path": name if prefix is None else f"{prefix}/{name}", "coordinateTransformations": trafo}
-        for name, trafo in zip(ds_root, transforms)
+        for name, trafo in zip(dataset_names, transforms)
     ]
 
     ms_entry = {
@@ -66,6 +76,15 @@ def create_ngff_metadata(g, name, axes_names, scale=None, units=None, type_=None
         transforms = [{"type": "scale", "scale": scale}]
     if transforms is not None:
         ms_entry["coordinateTransformations"] = transforms
+    return ms_entry
+
+
+def create_ngff_metadata(g, name, axes_names, scale=None, units=None, type_=None,
+                         metadata=None, time_scale=None, prefix=None, scale_factor=None):
+    ds_root = g if prefix is None else g[prefix]
+    ms_entry = get_multiscales_entry(name, axes_names, list(ds_root), scale=scale, units=units, type_=type_,
+                                     metadata=metadata, time_scale=time_scale, prefix=prefix,
+                                     scale_factor=scale_factor)
 
     metadata = g.attrs.get("multiscales", [])
     metadata.append(ms_entry)
@@ -77,34 +96,377 @@ def create_ngff_metadata(g, name, axes_names, scale=None, units=None, type_=None
         ds.attrs["_ARRAY_DIMENSIONS"] = axes_names
 
 
+def _get_spatial_scale_factor(axes_names, kwargs):
+    if "scale" not in kwargs and "scale_factor" not in kwargs:
+        return None
+    factors = _get_scale_factors(axes_names, kwargs)
+    return [fac for ax, fac in zip(axes_names, factors) if ax in "zyx"]
+
+
+def _downscale_blocks(ds, out_ds, blocks, factors, axes_names, downscaler, kwargs, n_workers):
+    # compute the given (chunk-aligned) blocks of out_ds by downscaling the corresponding blocks of ds
+    def _downscale_block(bb):
+        in_bb = tuple(
+            slice(b.start * fac, min(b.stop * fac, sh)) for b, fac, sh in zip(bb, factors, ds.shape)
+        )
+        out_ds[bb] = _downscale(ds[in_bb], axes_names, downscaler, kwargs)
+
+    _map(_downscale_block, blocks, n_workers)
+
+
+def _write_pyramid_block_wise(data, create_dataset, axes_names, n_scales, downscaler, kwargs, n_workers):
+    if not _is_block_local(downscaler):
+        raise ValueError("block_wise needs a downscaler that works on blocks, "
+                         "use one of 'mean', 'max', 'nearest' or 'mode'")
+    factors = _get_scale_factors(axes_names, kwargs)
+
+    # write s0 chunk by chunk, so that only a single chunk of the input is loaded per worker
+    ds = create_dataset(0, data.shape, data.dtype)
+    _write_data(ds, data, n_workers)
+
+    # compute each scale level block-wise from the level above,
+    # so that at most prod(scale_factors) chunks of the previous level are loaded per worker
+    shapes = _get_level_shapes(data.shape, factors, n_scales, downscaler)
+    for ii, shape in enumerate(shapes[1:], 1):
+        out_ds = create_dataset(ii, shape, ds.dtype)
+        _downscale_blocks(ds, out_ds, _get_blocks(out_ds.shape, out_ds.chunks), factors,
+                          axes_names, downscaler, kwargs, n_workers)
+        ds = out_ds
+
+
+def _get_store(path, dimension_separator):
+    if dimension_separator == "/":
+        return zarr.NestedDirectoryStore(path, dimension_separator=dimension_separator)
+    return zarr.DirectoryStore(path, dimension_separator=dimension_separator)
+
+
+def _write_image(g, data, axes_names, n_scales, prefix, chunks, downscaler, kwargs, dimension_separator,
+                 block_wise, n_workers, access_pattern, compressor, filters, statistics, write_empty_chunks):
+    # write all scale levels of an image to g (below prefix) and return the datasets
+    datasets = []
+
+    def create_dataset(ii, shape, dtype):
+        level_chunks = _get_level_chunks(chunks, shape, dtype, axes_names, access_pattern)
+        level_compressor, level_filters = _get_level_codecs(compressor, filters, ii)
+        ds = g.create_dataset(f"s{ii}" if prefix is None else f"{prefix}/s{ii}",
+                              shape=shape, dtype=dtype, chunks=level_chunks,
+                              compressor=level_compressor, filters=level_filters,
+                              write_empty_chunks=write_empty_chunks,
+                              dimension_separator=dimension_separator)
+        if statistics:
+            ds = StatisticsDataset(ds)
+        datasets.append(ds)
+        return ds
+
+    if block_wise:
+        _write_pyramid_block_wise(data, create_dataset, axes_names, n_scales, downscaler, kwargs, n_workers)
+    else:
+        _write_multiscale(data, create_dataset, axes_names, n_scales, downscaler, kwargs, n_workers)
+    if statistics:
+        write_statistics(g.store, posixpath.join(g.path, "" if prefix is None else prefix), datasets)
+    return datasets
+
+
 def write_ome_zarr(data, path, axes_names, name, n_scales,
                    key=None, chunks=None,
                    downscaler=skimage.transform.rescale,
                    kwargs={"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True},
                    scale=None, units=None, time_scale=None,
-                   dimension_separator="/", prefix=None):
-    """Write numpy data to ome.zarr format.
+                   dimension_separator="/", prefix=None, block_wise=False, n_workers=None, access_pattern=None,
+                   compressor="default", filters=None, consolidate=False, statistics=False,
+                   write_empty_chunks=False):
+    """Write numpy data to ome.zarr format, see the README for the options.
     """
     assert dimension_separator in (".", "/")
     assert 2 <= data.ndim <= 5
     assert len(axes_names) == data.ndim
+    if isinstance(downscaler, str):
+        downscaler, kwargs = get_downscaler(downscaler, kwargs)
 
     chunks = _get_chunks(axes_names) if chunks is None else chunks
-    if dimension_separator == "/":
-        store = zarr.NestedDirectoryStore(path, dimension_separator=dimension_separator)
-    else:
-        store = zarr.DirectoryStore(path, dimension_separator=dimension_separator)
-
+    store = _get_store(path, dimension_separator)
     with zarr.open(store, mode="a") as f:
         g = f if key is None else f.require_group(key)
-        g.create_dataset("s0" if prefix is None else f"{prefix}/s0",
-                         data=data, chunks=chunks, dimension_separator=dimension_separator)
-        for ii in range(1, n_scales):
-            data = _downscale(data, axes_names, downscaler, kwargs)
-            g.create_dataset(f"s{ii}" if prefix is None else f"{prefix}/s{ii}",
-                             data=data, chunks=chunks, dimension_separator=dimension_separator)
+        _write_image(g, data, axes_names, n_scales, prefix, chunks, downscaler, kwargs, dimension_separator,
+                     block_wise, n_workers, access_pattern, compressor, filters, statistics, write_empty_chunks)
         function_name = f"{downscaler.__module__}.{downscaler.__name__}"
         create_ngff_metadata(g, name, axes_names,
                              type_=function_name, metadata=kwargs,
                              scale=scale, units=units, time_scale=time_scale,
-                             prefix=prefix)
+                             prefix=prefix, scale_factor=_get_spatial_scale_factor(axes_names, kwargs))
+        if consolidate:
+            zarr.consolidate_metadata(store)
+
+
+def write_multi_image_ome_zarr(images, path, axes_names, names, n_scales,
+                               key=None, chunks=None,
+                               downscaler=skimage.transform.rescale,
+                               kwargs={"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True},
+                               scale=None, units=None, time_scale=None,
+                               dimension_separator="/", block_wise=False, n_workers=None, access_pattern=None,
+                               compressor="default", filters=None, consolidate=False, statistics=False,
+                               write_empty_chunks=False):
+    """Write multiple images with the same axes to a single ome.zarr container.
+
+    Each image is stored below its name and described by its own multiscales entry, like with
+    write_ome_zarr(..., prefix=name). The images are written in parallel by n_workers threads
+    and the multiscales metadata is written once for all images, whereas calling write_ome_zarr
+    for each image rewrites the metadata of all previous images.
+    images is a list of arrays or an array whose first axis enumerates the images.
+    The other arguments are the same as for write_ome_zarr and apply to all images.
+    """
+    assert dimension_separator in (".", "/")
+    assert len(images) == len(names), f"{len(images)}, {len(names)}"
+    assert len(set(names)) == len(names), "The image names must be unique"
+    assert all(2 <= image.ndim <= 5 and len(axes_names) == image.ndim for image in images)
+    if isinstance(downscaler, str):
+        downscaler, kwargs = get_downscaler(downscaler, kwargs)
+
+    chunks = _get_chunks(axes_names) if chunks is None else chunks
+    store = _get_store(path, dimension_separator)
+    with zarr.open(store, mode="a") as f:
+        g = f if key is None else f.require_group(key)
+        multiscales = g.attrs.get("multiscales", [])
+        assert not any(ms["name"] in names for ms in multiscales), "Some of the images are already in the container"
+        for name in names:
+            g.require_group(name)
+
+        # the images are distributed over the workers and the remaining workers are used within the images
+        image_workers = None if n_workers is None else max(1, n_workers // len(names))
+
+        def write_image(image_id):
+            datasets = _write_image(g, images[image_id], axes_names, n_scales, names[image_id], chunks,
+                                    downscaler, kwargs, dimension_separator, block_wise, image_workers,
+                                    access_pattern, compressor, filters, statistics, write_empty_chunks)
+            for ds in datasets:
+                ds.attrs["_ARRAY_DIMENSIONS"] = axes_names
+            return len(datasets)
+
+        n_levels = _map(write_image, range(len(names)), n_workers)
+
+        function_name = f"{downscaler.__module__}.{downscaler.__name__}"
+        scale_factor = _get_spatial_scale_factor(axes_names, kwargs)
+        multiscales.extend([
+            get_multiscales_entry(name, axes_names, [f"s{ii}" for ii in range(n)],
+                                  type_=function_name, metadata=kwargs,
+                                  scale=scale, units=units, time_scale=time_scale,
+                                  prefix=name, scale_factor=scale_factor)
+            for name, n in zip(names, n_levels)
+        ])
+        g.attrs["multiscales"] = multiscales
+        if consolidate:
+            zarr.consolidate_metadata(store)
+
+
+class _ResizedStore(MutableMapping):
+    """View of a zarr store in which an array has a different shape than in the stored metadata.
+
+    This is used to write data beyond the current shape of an array before the new shape is stored,
+    so that readers never see the new shape without the corresponding data.
+    """
+    def __init__(self, store, metadata_key, shape):
+        self.store = store
+        self.metadata_key = metadata_key
+        metadata = json.loads(store[metadata_key])
+        metadata["shape"] = list(shape)
+        self.metadata = json.dumps(metadata).encode("utf-8")
+
+    def __getitem__(self, key):
+        return self.metadata if key == self.metadata_key else self.store[key]
+
+    def __setitem__(self, key, value):
+        assert key != self.metadata_key
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+
+def _get_downscaler_from_metadata(ms_entry, downscaler=None, kwargs=None):
+    # the multiscales metadata stores the full name of the downscaling function in 'type' and its kwargs in 'metadata',
+    # they are used for the downscaler and / or kwargs that are not given
+    if downscaler is None or kwargs is None:
+        assert "type" in ms_entry and "metadata" in ms_entry, "Cannot determine the downscaler, please pass it"
+    if downscaler is None:
+        module_name, function_name = ms_entry["type"].rsplit(".", 1)
+        downscaler = getattr(importlib.import_module(module_name), function_name)
+    if kwargs is None:
+        kwargs = ms_entry["metadata"]
+    if isinstance(downscaler, str):
+        downscaler, kwargs = get_downscaler(downscaler, kwargs)
+    return downscaler, kwargs
+
+
+def _get_ms_entry(g, name):
+    multiscales = g.attrs["multiscales"]
+    if name is None:
+        return multiscales[0]
+    ms_entries = [ms for ms in multiscales if ms["name"] == name]
+    assert len(ms_entries) == 1, f"Could not find the multiscales entry {name}"
+    return ms_entries[0]
+
+
+def append_ome_zarr(data, path, axis="t", key=None, name=None, downscaler=None, kwargs=None, n_workers=1):
+    """Append timepoints or channels to an existing multiscale image written by write_ome_zarr.
+
+    data contains the new slices, it must have the same shape as s0 except for the axis that is appended to.
+    Only the new slices are downscaled and written, so the cost does not depend on the size of the existing data.
+    All new data is written before the new shapes of the scale levels are stored, so an interrupted append
+    leaves the image unchanged. Storing the new shapes is not atomic: if it is interrupted, only some
+    of the levels have the new shape. The downscaler can be given by name (see get_downscaler),
+    the downscaler and / or its kwargs that are not given are taken from the multiscales metadata.
+    """
+    with zarr.open(path, mode="a") as f:
+        g = f if key is None else f[key]
+        ms_entry = _get_ms_entry(g, name)
+        axes_names = tuple(ax["name"] for ax in ms_entry["axes"])
+        assert axis in ("t", "c") and axis in axes_names, f"Can only append along an existing t or c axis, got {axis}"
+        assert data.ndim == len(axes_names)
+        axis_id = axes_names.index(axis)
+        downscaler, kwargs = _get_downscaler_from_metadata(ms_entry, downscaler, kwargs)
+
+        datasets = [g[ds["path"]] for ds in ms_entry["datasets"]]
+        assert all(sh == dsh for ii, (sh, dsh) in enumerate(zip(data.shape, datasets[0].shape)) if ii != axis_id)
+        n_new = data.shape[axis_id]
+
+        # write the new slices of all scale levels, downscaling them from the level above
+        new_shapes = []
+        for level, ds in enumerate(datasets):
+            if level > 0:
+                data = _downscale(data, axes_names, downscaler, kwargs, n_workers)
+            new_shape = tuple(sh + n_new if ii == axis_id else sh for ii, sh in enumerate(ds.shape))
+            resized = zarr.open_array(_ResizedStore(ds.store, f"{ds.path}/.zarray", new_shape), path=ds.path, mode="r+")
+            offset = ds.shape[axis_id]
+            bb = tuple(slice(offset, sh) if ii == axis_id else slice(None) for ii, sh in enumerate(new_shape))
+            resized[bb] = data
+            new_shapes.append(new_shape)
+
+        # only now store the new shapes of all levels, and only then update the other metadata;
+        # each .zarray is replaced in a single write by the store, but the levels are resized one after the other
+        for ds, new_shape in zip(datasets, new_shapes):
+            ds.resize(new_shape)
+        for ds in datasets:
+            ds.attrs["_ARRAY_DIMENSIONS"] = axes_names
+        _remove_statistics(g, ms_entry)
+        # the consolidated metadata contains the shapes, so it has to be updated as well
+        if ".zmetadata" in f.store:
+            zarr.consolidate_metadata(f.store)
+
+
+def _get_level_scale_factors(ms_entry):
+    # the scale factors between consecutive levels, derived from the scale transformations of the datasets
+    scales = [
+        [trafo["scale"] for trafo in ds["coordinateTransformations"] if trafo["type"] == "scale"][0]
+        for ds in ms_entry["datasets"]
+    ]
+    return [None] + [
+        tuple(int(round(sc / prev_sc)) for sc, prev_sc in zip(scale, prev_scale))
+        for prev_scale, scale in zip(scales[:-1], scales[1:])
+    ]
+
+
+def _get_affected_chunks(bb, factors, ds):
+    # the chunks of ds (at the next scale level) that are affected by a change in the region bb of the current level
+    ranges = []
+    for b, fac, ch, sh in zip(bb, factors, ds.chunks, ds.shape):
+        stop = min(-(-b.stop // fac), sh)
+        ranges.append(range(b.start // fac // ch, -(-stop // ch)))
+    return set(itertools.product(*ranges))
+
+
+def _get_sidecar_key(g, ms_entry, file_name):
+    # the dirty chunk log and the statistics are stored next to the scale levels
+    return posixpath.join(g.path, posixpath.dirname(ms_entry["datasets"][0]["path"]), file_name)
+
+
+def _remove_statistics(g, ms_entry):
+    # the statistics are outdated after the data was changed
+    statistics_key = _get_sidecar_key(g, ms_entry, STATISTICS_KEY)
+    if statistics_key in g.store:
+        del g.store[statistics_key]
+
+
+def _propagate(datasets, level_factors, dirty_chunks, axes_names, downscaler, kwargs, n_workers):
+    # downscalers that don't work on blocks give a different result for the dirty chunks than for the whole array
+    # (see _is_block_local), so for them all levels are recomputed from s0
+    if not _is_block_local(downscaler):
+        for level in range(1, len(datasets)):
+            data = _downscale(datasets[level - 1][:], axes_names, downscaler, kwargs, n_workers)
+            _write_data(datasets[level], data, n_workers)
+        return
+    # recompute the dirty chunks of s1 and then successively the chunks they affect in s2, ..., sN
+    for level in range(1, len(datasets)):
+        ds, out_ds = datasets[level - 1], datasets[level]
+        blocks = [
+            tuple(slice(cid * ch, min((cid + 1) * ch, sh))
+                  for cid, ch, sh in zip(chunk_id, out_ds.chunks, out_ds.shape))
+            for chunk_id in sorted(dirty_chunks)
+        ]
+        _downscale_blocks(ds, out_ds, blocks, level_factors[level], axes_names, downscaler, kwargs, n_workers)
+        if level + 1 < len(datasets):
+            dirty_chunks = set().union(
+                *[_get_affected_chunks(bb, level_factors[level + 1], datasets[level + 1]) for bb in blocks]
+            )
+
+
+def _propagate_dirty_chunks(g, ms_entry, dirty_chunks, downscaler, kwargs, n_workers):
+    axes_names = tuple(ax["name"] for ax in ms_entry["axes"])
+    downscaler, kwargs = _get_downscaler_from_metadata(ms_entry, downscaler, kwargs)
+    datasets = [g[ds["path"]] for ds in ms_entry["datasets"]]
+    _propagate(datasets, _get_level_scale_factors(ms_entry), dirty_chunks, axes_names, downscaler, kwargs, n_workers)
+    # the log is only cleared after all levels are updated, so that an interrupted propagation can be repeated
+    log_key = _get_sidecar_key(g, ms_entry, "dirty_chunks.json")
+    if log_key in g.store:
+        del g.store[log_key]
+
+
+def update_ome_zarr(data, path, bb, key=None, name=None, downscaler=None, kwargs=None, n_workers=1, propagate=True):
+    """Update the region bb of s0 of a multiscale image written by write_ome_zarr with data.
+
+    Only the chunks of s1, ..., sN that are affected by the update are recomputed, the scale factors between the
+    levels are taken from the scale transformations in the multiscales metadata.
+    If propagate is False, the affected chunks are only recorded in a dirty chunk log and are recomputed
+    by the next call to propagate_updates, so that several edits can be batched.
+    By default the downscaler and its kwargs are taken from the multiscales metadata.
+    """
+    with zarr.open(path, mode="a") as f:
+        g = f if key is None else f[key]
+        ms_entry = _get_ms_entry(g, name)
+        ds = g[ms_entry["datasets"][0]["path"]]
+        bb = tuple(slice(*b.indices(sh)[:2]) for b, sh in zip(bb, ds.shape))
+        assert data.shape == tuple(b.stop - b.start for b in bb), f"{data.shape}, {bb}"
+        ds[bb] = data
+        _remove_statistics(g, ms_entry)
+        if len(ms_entry["datasets"]) == 1:
+            return
+
+        level_factors = _get_level_scale_factors(ms_entry)
+        next_ds = g[ms_entry["datasets"][1]["path"]]
+        dirty_chunks = _get_affected_chunks(bb, level_factors[1], next_ds)
+        log_key = _get_sidecar_key(g, ms_entry, "dirty_chunks.json")
+        if log_key in g.store:
+            dirty_chunks |= set(map(tuple, json.loads(g.store[log_key])["chunks"]))
+
+        if propagate:
+            _propagate_dirty_chunks(g, ms_entry, dirty_chunks, downscaler, kwargs, n_workers)
+        else:
+            g.store[log_key] = json.dumps({"chunks": sorted(dirty_chunks)}).encode("utf-8")
+
+
+def propagate_updates(path, key=None, name=None, downscaler=None, kwargs=None, n_workers=1):
+    """Recompute the chunks of s1, ..., sN that were recorded in the dirty chunk log by update_ome_zarr.
+    """
+    with zarr.open(path, mode="a") as f:
+        g = f if key is None else f[key]
+        ms_entry = _get_ms_entry(g, name)
+        log_key = _get_sidecar_key(g, ms_entry, "dirty_chunks.json")
+        if log_key not in g.store:
+            return
+        dirty_chunks = set(map(tuple, json.loads(g.store[log_key])["chunks"]))
+        _propagate_dirty_chunks(g, ms_entry, dirty_chunks, downscaler, kwargs, n_workers)
@@ -0,0 +1,262 @@
+import itertools
+import json
+import os
+
+import numcodecs
+import numpy as np
+import skimage.transform
+
+from .chunks import plan_shards
+from .downscaling import get_downscaler
+from .v03 import _get_blocks, _get_chunks, _get_level_chunks, _get_level_codecs, _write_multiscale
+from .v04 import _get_spatial_scale_factor, get_multiscales_entry
+
+# the offset and number of bytes that mark an empty chunk in the shard index
+EMPTY_CHUNK = 2**64 - 1
+
+BLOSC_SHUFFLE_NAMES = {
+    numcodecs.Blosc.NOSHUFFLE: "noshuffle",
+    numcodecs.Blosc.SHUFFLE: "shuffle",
+    numcodecs.Blosc.BITSHUFFLE: "bitshuffle",
+}
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, metadata):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def _require_group(path):
+    # zarr v3 does not have implicit groups, so the metadata of every group has to be written explicitly
+    metadata_path = os.path.join(path, "zarr.json")
+    if not os.path.exists(metadata_path):
+        _write_json(metadata_path, {"zarr_format": 3, "node_type": "group", "attributes": {}})
+
+
+def _get_codec_metadata(compressor, dtype):
+    # translate the numcodecs compressor to the zarr v3 codec metadata
+    if isinstance(compressor, numcodecs.Blosc):
+        shuffle = compressor.shuffle
+        if shuffle == numcodecs.Blosc.AUTOSHUFFLE:
+            shuffle = numcodecs.Blosc.BITSHUFFLE if dtype.itemsize == 1 else numcodecs.Blosc.SHUFFLE
+        config = {"cname": compressor.cname, "clevel": compressor.clevel, "shuffle": BLOSC_SHUFFLE_NAMES[shuffle],
+                  "typesize": dtype.itemsize, "blocksize": compressor.blocksize}
+        return {"name": "blosc", "configuration": config}
+    elif isinstance(compressor, numcodecs.Zstd):
+        return {"name": "zstd", "configuration": {"level": compressor.level, "checksum": False}}
+    elif isinstance(compressor, numcodecs.GZip):
+        return {"name": "gzip", "configuration": {"level": compressor.level}}
+    raise ValueError(f"Compressor {compressor} is not supported")
+
+
+def _get_compressor(codec_metadata):
+    name, config = codec_metadata["name"], codec_metadata["configuration"]
+    if name == "blosc":
+        shuffle = {v: k for k, v in BLOSC_SHUFFLE_NAMES.items()}[config["shuffle"]]
+        return numcodecs.Blosc(cname=config["cname"], clevel=config["clevel"], shuffle=shuffle,
+                               blocksize=config["blocksize"])
+    elif name == "zstd":
+        return numcodecs.Zstd(level=config["level"])
+    elif name == "gzip":
+        return numcodecs.GZip(level=config["level"])
+    raise ValueError(f"Codec {name} is not supported")
+
+
+class ShardedArray:
+    """Minimal zarr v3 array with the sharding_indexed codec.
+
+    Each shard is a single file that contains the encoded inner chunks followed by the shard index,
+    see https://zarr-specs.readthedocs.io/en/latest/v3/codecs/sharding-indexed/v1.0.html.
+    Shards can only be written as a whole, but single chunks can be read from a shard.
+    """
+    def __init__(self, path):
+        self.path = path
+        metadata = _read_json(os.path.join(path, "zarr.json"))
+        self.shape = tuple(metadata["shape"])
+        self.dtype = np.dtype(metadata["data_type"])
+        self.fill_value = metadata["fill_value"]
+        self.shards = tuple(metadata["chunk_grid"]["configuration"]["chunk_shape"])
+        sharding_config = metadata["codecs"][0]["configuration"]
+        self.inner_chunks = tuple(sharding_config["chunk_shape"])
+        self.compressor = _get_compressor(sharding_config["codecs"][1])
+        self.chunks_per_shard = tuple(sd // ch for sd, ch in zip(self.shards, self.inner_chunks))
+        # the writers align the data they write with the chunks, which are the shards for a sharded array
+        self.chunks = self.shards
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.path, "c", *map(str, shard_id))
+
+    def _encode_chunk(self, chunk):
+        chunk = chunk.astype(self.dtype.newbyteorder("<"), copy=False)
+        return self.compressor.encode(np.ascontiguousarray(chunk))
+
+    def write_shard(self, shard_id, data):
+        """Write the data for a full shard; data may be smaller than the shard at the array border.
+        """
+        shard_start = [sid * sd for sid, sd in zip(shard_id, self.shards)]
+        assert all(st + dsh == min(st + sd, sh) for st, dsh, sd, sh in zip(shard_start, data.shape,
+                                                                          self.shards, self.shape))
+        index = np.full(self.chunks_per_shard + (2,), EMPTY_CHUNK, dtype="<u8")
+        encoded_chunks, offset = [], 0
+        for chunk_id in np.ndindex(*self.chunks_per_shard):
+            bb = tuple(slice(cid * ch, (cid + 1) * ch) for cid, ch in zip(chunk_id, self.inner_chunks))
+            chunk = data[bb]
+            # chunks that are fully outside of the array are not written
+            if chunk.size == 0:
+                continue
+            # chunks at the array border are padded to the full chunk shape
+            if chunk.shape != self.inner_chunks:
+                pad_width = [(0, ch - csh) for ch, csh in zip(self.inner_chunks, chunk.shape)]
+                chunk = np.pad(chunk, pad_width, constant_values=self.fill_value)
+            encoded = self._encode_chunk(chunk)
+            index[chunk_id] = (offset, len(encoded))
+            encoded_chunks.append(encoded)
+            offset += len(encoded)
+
+        shard_path = self._shard_path(shard_id)
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        with open(shard_path, "wb") as f:
+            for encoded in encoded_chunks:
+                f.write(encoded)
+            # the index is stored at the end of the shard
+            f.write(index.tobytes())
+
+    def __setitem__(self, bb, data):
+        # only writing full shards is supported
+        assert all(b.start % sd == 0 for b, sd in zip(bb, self.shards))
+        for shard_bb in _get_blocks(data.shape, self.shards):
+            shard_id = tuple((b.start + sbb.start) // sd for b, sbb, sd in zip(bb, shard_bb, self.shards))
+            self.write_shard(shard_id, data[shard_bb])
+
+    def __getitem__(self, bb):
+        # read all inner chunks that overlap with the bounding box
+        bb = bb if isinstance(bb, tuple) else (bb,)
+        bb = bb + (slice(None),) * (len(self.shape) - len(bb))
+        bb = tuple(slice(*b.indices(sh)[:2]) for b, sh in zip(bb, self.shape))
+        data = np.empty(tuple(b.stop - b.start for b in bb), dtype=self.dtype)
+        chunk_ranges = [range(b.start // ch, -(-b.stop // ch)) for b, ch in zip(bb, self.inner_chunks)]
+        for chunk_id in itertools.product(*chunk_ranges):
+            chunk_start = [cid * ch for cid, ch in zip(chunk_id, self.inner_chunks)]
+            overlap = [
+                (max(b.start, st), min(b.stop, st + ch)) for b, st, ch in zip(bb, chunk_start, self.inner_chunks)
+            ]
+            out_bb = tuple(slice(lo - b.start, hi - b.start) for (lo, hi), b in zip(overlap, bb))
+            chunk_bb = tuple(slice(lo - st, hi - st) for (lo, hi), st in zip(overlap, chunk_start))
+            data[out_bb] = self.read_chunk(chunk_id)[chunk_bb]
+        return data
+
+    def read_chunk(self, chunk_id):
+        """Read a single inner chunk, only the index and the chunk itself are read from the shard.
+        """
+        shard_id = tuple(cid // cps for cid, cps in zip(chunk_id, self.chunks_per_shard))
+        local_id = tuple(cid % cps for cid, cps in zip(chunk_id, self.chunks_per_shard))
+        shard_path = self._shard_path(shard_id)
+        if not os.path.exists(shard_path):
+            return np.full(self.inner_chunks, self.fill_value, dtype=self.dtype)
+
+        index_size = int(np.prod(self.chunks_per_shard)) * 2 * 8
+        with open(shard_path, "rb") as f:
+            f.seek(-index_size, os.SEEK_END)
+            index = np.frombuffer(f.read(index_size), dtype="<u8").reshape(self.chunks_per_shard + (2,))
+            offset, n_bytes = index[local_id]
+            if offset == EMPTY_CHUNK:
+                return np.full(self.inner_chunks, self.fill_value, dtype=self.dtype)
+            f.seek(int(offset))
+            encoded = f.read(int(n_bytes))
+        chunk = np.frombuffer(self.compressor.decode(encoded), dtype=self.dtype.newbyteorder("<"))
+        return chunk.reshape(self.inner_chunks).astype(self.dtype, copy=False)
+
+
+def create_sharded_array(path, shape, dtype, chunks, shards, compressor=None, dimension_names=None, fill_value=0):
+    """Create a zarr v3 array that stores the chunks in shards.
+    """
+    dtype = np.dtype(dtype)
+    assert len(shape) == len(chunks) == len(shards)
+    assert all(sd % ch == 0 for sd, ch in zip(shards, chunks)), f"Shards {shards} are not a multiple of {chunks}"
+    # use the same default compressor as zarr v2
+    if compressor is None:
+        compressor = numcodecs.Blosc(cname="lz4", clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)
+    endian = {"name": "bytes", "configuration": {"endian": "little"}}
+    sharding_codec = {
+        "name": "sharding_indexed",
+        "configuration": {
+            "chunk_shape": list(chunks),
+            "codecs": [endian, _get_codec_metadata(compressor, dtype)],
+            "index_codecs": [endian],
+            "index_location": "end",
+        }
+    }
+    metadata = {
+        "zarr_format": 3,
+        "node_type": "array",
+        "shape": list(shape),
+        "data_type": dtype.name,
+        "chunk_grid": {"name": "regular", "configuration": {"chunk_shape": list(shards)}},
+        "chunk_key_encoding": {"name": "default", "configuration": {"separator": "/"}},
+        "fill_value": fill_value,
+        "codecs": [sharding_codec],
+        "attributes": {},
+    }
+    if dimension_names is not None:
+        metadata["dimension_names"] = list(dimension_names)
+    _write_json(os.path.join(path, "zarr.json"), metadata)
+    return ShardedArray(path)
+
+
+def write_ome_zarr(data, path, axes_names, name, n_scales,
+                   key=None, chunks=None, shards=None,
+                   downscaler=skimage.transform.rescale,
+                   kwargs={"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True},
+                   scale=None, units=None, time_scale=None,
+                   prefix=None, n_workers=None, access_pattern=None, compressor=None, shard_bytes=2**26):
+    """Write numpy data to ome.zarr format with sharded zarr v3 arrays (prototype for ome-ngff 0.5).
+
+    Each shard packs multiple chunks into a single file. If shards is None, the shards of each scale level
+    are planned for a size of shard_bytes with prototypes.chunks.plan_shards.
+    The compressor (Blosc, Zstd or GZip from numcodecs) can also be given per scale level as a list,
+    in which case the last entry is used for all further levels.
+    """
+    assert 2 <= data.ndim <= 5
+    assert len(axes_names) == data.ndim
+    if isinstance(downscaler, str):
+        downscaler, kwargs = get_downscaler(downscaler, kwargs)
+
+    chunks = _get_chunks(axes_names) if chunks is None else chunks
+    _require_group(path)
+    root = path if key is None else os.path.join(path, key)
+    _require_group(root)
+    image_root = root if prefix is None else os.path.join(root, prefix)
+    _require_group(image_root)
+
+    def create_dataset(ii, shape, dtype):
+        level_chunks = _get_level_chunks(chunks, shape, dtype, axes_names, access_pattern)
+        if shards is None:
+            level_shards = plan_shards(shape, level_chunks, dtype, axes_names, access_pattern, shard_bytes)
+        else:
+            level_shards = shards
+        level_compressor, _ = _get_level_codecs(compressor, None, ii)
+        return create_sharded_array(os.path.join(image_root, f"s{ii}"), shape, dtype, level_chunks, level_shards,
+                                    compressor=level_compressor, dimension_names=axes_names)
+
+    _write_multiscale(data, create_dataset, axes_names, n_scales, downscaler, kwargs, n_workers)
+
+    function_name = f"{downscaler.__module__}.{downscaler.__name__}"
+    ms_entry = get_multiscales_entry(name, axes_names, [f"s{ii}" for ii in range(n_scales)],
+                                     type_=function_name, metadata=kwargs,
+                                     scale=scale, units=units, time_scale=time_scale, prefix=prefix,
+                                     scale_factor=_get_spatial_scale_factor(axes_names, kwargs))
+    # the version is stored once for all multiscales in 0.5
+    ms_entry.pop("version")
+
+    metadata_path = os.path.join(root, "zarr.json")
+    metadata = _read_json(metadata_path)
+    ome = metadata["attributes"].get("ome", {"version": "0.5"})
+    ome["multiscales"] = ome.get("multiscales", []) + [ms_entry]
+    metadata["attributes"]["ome"] = ome
+    _write_json(metadata_path, metadata)
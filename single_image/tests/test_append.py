@@ -0,0 +1,50 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+import os
+
+import numpy as np
+import pytest
+import zarr
+
+from prototypes import v04
+from prototypes.statistics import STATISTICS_KEY
+
+RESCALE_KWARGS = {"scale": (0.5, 0.5), "order": 0, "preserve_range": True}
+
+
+def _load_levels(path, n_scales):
+    return [zarr.open(f"{path}/s{ii}", mode="r")[:] for ii in range(n_scales)]
+
+
+@pytest.mark.parametrize("axis", ["t", "c"])
+@pytest.mark.parametrize("downscaler", ["mean", "mode", None])
+def test_append_ome_zarr(tmp_path, axis, downscaler):
+    # appending gives the same levels as writing all data at once
+    axes_names, n_scales = (axis, "y", "x"), 3
+    data = np.random.default_rng(0).integers(0, 4, size=(7, 67, 45), dtype="uint8") * 60
+    options = {"kwargs": RESCALE_KWARGS} if downscaler is None else\
+        {"downscaler": downscaler, "kwargs": {"scale_factor": [2, 2]}}
+    chunks = (1, 16, 16)
+    expected_path = str(tmp_path / "expected.ome.zarr")
+    v04.write_ome_zarr(data, expected_path, axes_names, "data", n_scales, chunks=chunks, **options)
+
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data[:3], path, axes_names, "data", n_scales, chunks=chunks, statistics=True, **options)
+    # the downscaler is taken from the metadata
+    v04.append_ome_zarr(data[3:5], path, axis=axis)
+    v04.append_ome_zarr(data[5:], path, axis=axis, n_workers=4)
+    for level, expected in zip(_load_levels(path, n_scales), _load_levels(expected_path, n_scales)):
+        np.testing.assert_array_equal(level, expected)
+    # the statistics are outdated after appending
+    assert not os.path.exists(os.path.join(path, STATISTICS_KEY))
+
+
+def test_append_ome_zarr_errors(tmp_path):
+    data = np.zeros((2, 32, 32), dtype="uint8")
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data, path, ("t", "y", "x"), "data", 2, downscaler="mean", kwargs={"scale_factor": [2, 2]})
+    # can only append along existing t or c axes
+    with pytest.raises(AssertionError):
+        v04.append_ome_zarr(data, path, axis="c")
+    # the shape of the other axes must match
+    with pytest.raises(AssertionError):
+        v04.append_ome_zarr(data[:, :16], path, axis="t")
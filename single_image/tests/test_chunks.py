@@ -0,0 +1,50 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+import math
+
+import numpy as np
+import pytest
+import zarr
+
+from prototypes import v04
+from prototypes.chunks import ACCESS_PATTERNS, plan_chunks, plan_shards
+
+
+@pytest.mark.parametrize("access_pattern", ACCESS_PATTERNS)
+def test_plan_chunks(access_pattern):
+    shape, axes_names = (20, 2, 64, 512, 512), ("t", "c", "z", "y", "x")
+    plan = plan_chunks(shape, "uint16", axes_names, access_pattern, target_bytes=2**20)
+    chunks = plan["chunks"]
+    assert all(1 <= ch <= sh for ch, sh in zip(chunks, shape))
+    assert plan["bytes_per_chunk"] == 2 * math.prod(chunks) <= 2**20
+    assert plan["n_chunks"] == math.prod(math.ceil(sh / ch) for sh, ch in zip(shape, chunks))
+    if access_pattern == "slice":
+        # full planes first, then z once the planes fit into the target size
+        assert chunks[:2] == (1, 1) and chunks[3:] == shape[3:]
+    elif access_pattern == "block":
+        assert chunks[:2] == (1, 1) and chunks[2] > 1
+    else:
+        assert chunks[0] == shape[0]
+
+
+def test_plan_chunks_small_array():
+    # the chunks span the full array if it is smaller than the target size
+    plan = plan_chunks((3, 40, 50), "uint8", ("c", "y", "x"), "slice")
+    assert plan["chunks"] == (3, 40, 50) and plan["n_chunks"] == 1
+
+
+def test_plan_shards():
+    chunks = (32, 64, 64)
+    shards = plan_shards((128, 1024, 1024), chunks, "uint8", ("z", "y", "x"), "block", shard_bytes=2**24)
+    assert all(sd % ch == 0 for sd, ch in zip(shards, chunks))
+    assert math.prod(shards) <= 2**24
+
+
+def test_auto_chunks(tmp_path):
+    # with chunks='auto' the chunks of each scale level are planned for its shape
+    data = np.zeros((8, 512, 512), dtype="uint8")
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data, path, ("t", "y", "x"), "data", 3, chunks="auto", access_pattern="timeseries",
+                       downscaler="mean", kwargs={"scale_factor": [2, 2]})
+    for ii in range(3):
+        ds = zarr.open(f"{path}/s{ii}", mode="r")
+        assert ds.chunks == plan_chunks(ds.shape, ds.dtype, ("t", "y", "x"), "timeseries")["chunks"]
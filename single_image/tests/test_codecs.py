@@ -0,0 +1,28 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+import numcodecs
+import numpy as np
+import zarr
+
+from prototypes.v03 import _get_level_codecs, write_ome_zarr
+
+
+def test_get_level_codecs():
+    delta = numcodecs.Delta(dtype="uint8")
+    # the same filters for all scale levels
+    assert _get_level_codecs(None, [delta], 2) == (None, [delta])
+    # the filters per scale level, the last entry is used for all further levels
+    assert _get_level_codecs(None, [[delta], None], 0) == (None, [delta])
+    assert _get_level_codecs(None, [[delta], None], 2) == (None, None)
+    # no filters
+    assert _get_level_codecs(None, None, 1) == (None, None)
+    assert _get_level_codecs(None, [], 1) == (None, [])
+
+
+def test_write_without_filters(tmp_path):
+    data = np.random.default_rng(0).integers(0, 255, size=(64, 64), dtype="uint8")
+    path = str(tmp_path / "data.ome.zarr")
+    write_ome_zarr(data, path, ("y", "x"), "data", 2, kwargs={"scale": (0.5, 0.5), "order": 0, "preserve_range": True},
+                   filters=[])
+    f = zarr.open(path, mode="r")
+    assert not f["s0"].filters
+    np.testing.assert_array_equal(f["s0"][:], data)
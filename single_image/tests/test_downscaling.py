@@ -0,0 +1,59 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+import itertools
+
+import numpy as np
+import pytest
+
+from prototypes.downscaling import DOWNSCALERS, get_downscaled_shape, get_downscaler
+
+
+def _downscale_brute_force(data, scale_factor, reduce):
+    # reduce each block of the data, the blocks at the border are smaller
+    out = np.zeros(get_downscaled_shape(data.shape, scale_factor), dtype=data.dtype)
+    for out_id in itertools.product(*map(range, out.shape)):
+        block = data[tuple(slice(oid * fac, (oid + 1) * fac) for oid, fac in zip(out_id, scale_factor))]
+        out[out_id] = reduce(block, data.shape, out_id, scale_factor)
+    return out
+
+
+def _pad_block(block, scale_factor):
+    # the kernels pad the border blocks by repeating the last value
+    return np.pad(block, [(0, fac - sh) for sh, fac in zip(block.shape, scale_factor)], mode="edge")
+
+
+def _mean(block, shape, out_id, scale_factor):
+    block = _pad_block(block, scale_factor)
+    return int(block.astype("int64").sum() * 2 + block.size) // (2 * block.size)
+
+
+def _mode(block, shape, out_id, scale_factor):
+    values = _pad_block(block, scale_factor).ravel()
+    counts = [(values == val).sum() for val in values]
+    return values[int(np.argmax(counts))]
+
+
+REDUCTIONS = {
+    "mean": _mean,
+    "max": lambda block, *args: block.max(),
+    "nearest": lambda block, *args: block.ravel()[0],
+    "mode": _mode,
+}
+
+
+@pytest.mark.parametrize("name", list(DOWNSCALERS))
+@pytest.mark.parametrize("scale_factor", [(2, 2, 2), (1, 2, 3)])
+def test_downscalers(name, scale_factor):
+    data = np.random.default_rng(0).integers(0, 5, size=(9, 13, 17), dtype="uint8") * 50
+    expected = _downscale_brute_force(data, scale_factor, REDUCTIONS[name])
+    np.testing.assert_array_equal(DOWNSCALERS[name](data, scale_factor), expected)
+
+
+def test_get_downscaler():
+    data = np.random.default_rng(0).integers(0, 255, size=(10, 11), dtype="uint8")
+    downscaler, kwargs = get_downscaler("mean", {"scale": (0.5, 0.25)})
+    assert kwargs == {"scale_factor": [2, 4]}
+    assert downscaler(data, **kwargs).shape == (5, 3)
+    # a scalar scale is used for all axes, like for skimage.transform.rescale
+    downscaler, kwargs = get_downscaler("mean", {"scale": 0.5, "order": 0})
+    assert kwargs == {"scale_factor": 2}
+    np.testing.assert_array_equal(downscaler(data, **kwargs), downscaler(data, scale_factor=(2, 2)))
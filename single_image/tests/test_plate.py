@@ -0,0 +1,57 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+import os
+
+import numpy as np
+import zarr
+
+from prototypes.plate import write_plate_ome_zarr
+
+OPTIONS = {"downscaler": "mean", "kwargs": {"scale_factor": [2, 2]}, "chunks": (1, 32, 32)}
+
+
+def _make_fields():
+    rng = np.random.default_rng(0)
+    keys = [("A", 2, 0), ("A", 10, 0), ("A", 10, 1), ("B", 2, 0)]
+    return {key: rng.integers(0, 255, size=(2, 64, 48), dtype="uint8") for key in keys}
+
+
+def test_write_plate_ome_zarr(tmp_path):
+    fields = _make_fields()
+    path = str(tmp_path / "plate.ome.zarr")
+    # the fields can also be given as functions that load the data
+    result = write_plate_ome_zarr({key: (lambda data=data: data) for key, data in fields.items()}, path,
+                                  ("c", "y", "x"), 2, name="test-plate", **OPTIONS)
+    assert result == {"written": 4, "skipped": 0}
+
+    root = zarr.open(path, mode="r")
+    plate = root.attrs["plate"]
+    assert plate["name"] == "test-plate" and plate["field_count"] == 2
+    # the columns are sorted by their value, i.e. 2 before 10
+    assert [col["name"] for col in plate["columns"]] == ["2", "10"]
+    assert [row["name"] for row in plate["rows"]] == ["A", "B"]
+    assert [well["path"] for well in plate["wells"]] == ["A/2", "A/10", "B/2"]
+    assert root["A/10"].attrs["well"]["images"] == [{"path": "0"}, {"path": "1"}]
+    for (row, col, field), data in fields.items():
+        g = root[f"{row}/{col}/{field}"]
+        # the multiscales are named after the field
+        assert g.attrs["multiscales"][0]["name"] == str(field)
+        np.testing.assert_array_equal(g["s0"][:], data)
+
+
+def test_write_plate_ome_zarr_image_name(tmp_path):
+    path = str(tmp_path / "plate.ome.zarr")
+    write_plate_ome_zarr(_make_fields(), path, ("c", "y", "x"), 2,
+                         image_name=lambda row, col, field: f"{row}{col}-{field}", **OPTIONS)
+    assert zarr.open(path, mode="r")["A/10/1"].attrs["multiscales"][0]["name"] == "A10-1"
+
+
+def test_write_plate_ome_zarr_resume(tmp_path):
+    fields = _make_fields()
+    path = str(tmp_path / "plate.ome.zarr")
+    write_plate_ome_zarr(fields, path, ("c", "y", "x"), 2, **OPTIONS)
+    # simulate a field that was interrupted before its metadata was written
+    os.remove(os.path.join(path, "A", "10", "1", ".zattrs"))
+    zarr.open(f"{path}/A/10/1/s0", mode="r+")[:] = 0
+    result = write_plate_ome_zarr(fields, path, ("c", "y", "x"), 2, **OPTIONS)
+    assert result == {"written": 1, "skipped": 3}
+    np.testing.assert_array_equal(zarr.open(f"{path}/A/10/1/s0", mode="r")[:], fields[("A", 10, 1)])
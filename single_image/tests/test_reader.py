@@ -0,0 +1,124 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+from concurrent import futures
+
+import numpy as np
+import pytest
+
+from prototypes import v02, v03, v04
+from prototypes.reader import ChunkCache, open_multiscales
+
+RESCALE_KWARGS = {"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True}
+SELECTIONS = [
+    np.s_[:], np.s_[3], np.s_[-1, 10:50, ::3], np.s_[..., 7], np.s_[5:30:4, 40:, :20], np.s_[10:10, 2],
+]
+
+
+def _make_data(shape=(37, 101, 75)):
+    return np.random.default_rng(0).integers(0, 255, size=shape, dtype="uint8")
+
+
+def test_chunk_cache():
+    cache = ChunkCache(max_bytes=300)
+    chunks = {key: np.full(100, key, dtype="uint8") for key in range(4)}
+    for key in range(3):
+        cache.put(key, chunks[key])
+    assert cache.get(0) is chunks[0] and cache.n_bytes == 300
+    # the least recently used chunk is evicted
+    cache.put(3, chunks[3])
+    assert 1 not in cache and all(key in cache for key in (0, 2, 3))
+    assert cache.get(1) is None and (cache.hits, cache.misses) == (1, 1)
+    # the cached chunks must not be modified
+    with pytest.raises(ValueError):
+        chunks[0][0] = 1
+    # chunks that are larger than the cache are not cached
+    cache.put(4, np.zeros(301, dtype="uint8"))
+    assert 4 not in cache and cache.n_bytes == 300
+    cache.clear()
+    assert cache.n_bytes == 0 and 0 not in cache
+
+
+@pytest.mark.parametrize("module", [v02, v03, v04])
+def test_open_multiscales(tmp_path, module):
+    data = _make_data()
+    path = str(tmp_path / "data.ome.zarr")
+    module.write_ome_zarr(data, path, ("z", "y", "x"), "data", 3, chunks=(8, 16, 16), kwargs=RESCALE_KWARGS)
+    with open_multiscales(path, n_prefetch=0) as image:
+        assert len(image) == 3
+        level = image[0]
+        # 0.1 and 0.2 store the data as 5d
+        data = data[None, None] if module is v02 else data
+        assert level.shape == data.shape and level.dtype == data.dtype
+        for selection in SELECTIONS:
+            selection = selection if isinstance(selection, tuple) else (selection,)
+            selection = (0, 0) + selection if module is v02 else selection
+            np.testing.assert_array_equal(level[selection], data[selection])
+        assert image.cache.hits > 0
+
+
+def test_prefetch(tmp_path):
+    data = _make_data()
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data, path, ("z", "y", "x"), "data", 1, chunks=(8, 32, 32))
+    with open_multiscales(path, n_prefetch=2) as image:
+        np.testing.assert_array_equal(image[0][12], data[12])
+    # the two neighboring chunks in z are prefetched after the slice was read,
+    # close waits for the prefetching to finish
+    n_chunks_yx = 4 * 3
+    assert len(image.cache._chunks) == 4 * n_chunks_yx
+
+
+def test_select_level_v03(tmp_path):
+    # 0.3 does not store the scale, it is derived from the shapes, which are not divisible by 2 here
+    data = _make_data((37, 301, 259))
+    path = str(tmp_path / "data.ome.zarr")
+    v03.write_ome_zarr(data, path, ("z", "y", "x"), "data", 4, chunks=(8, 64, 64), kwargs=RESCALE_KWARGS)
+    with open_multiscales(path, n_prefetch=0) as image:
+        assert [level.scale for level in image.levels] == [(1.0,) * 3, (2.0,) * 3, (4.0,) * 3, (8.0,) * 3]
+        assert image.select_level(resolution=2.0) == 1
+        assert image.select_level(resolution=5.0) == 2
+        # the axes that are not given are not taken into account
+        assert image.select_level(resolution={"y": 4.0, "x": 4.0}) == 2
+        assert image.select_level(resolution={"z": 1.0, "y": 4.0, "x": 4.0}) == 0
+
+
+def test_read_region(tmp_path):
+    data = _make_data((37, 301, 259))
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data, path, ("z", "y", "x"), "data", 3, chunks=(8, 64, 64), scale={"z": 1.0, "y": 0.5, "x": 0.5},
+                       downscaler="mean", kwargs={"scale_factor": [1, 2, 2]})
+    with open_multiscales(path, n_prefetch=0) as image:
+        roi = {"y": (10.0, 20.0), "x": (0.0, 9.75)}
+        assert image.get_region_bb(0, roi) == (slice(0, 37), slice(20, 41), slice(0, 20))
+        region, transforms, level = image.read_region(roi)
+        assert level == 0
+        np.testing.assert_array_equal(region, data[:, 20:41, :20])
+        # the coarsest level with at least the resolution is selected
+        region, transforms, level = image.read_region(roi, resolution=1.0)
+        assert level == 1 and region.shape == (37, 11, 10)
+        assert transforms == [{"type": "scale", "scale": [1.0, 1.0, 1.0]},
+                              {"type": "translation", "translation": [0.0, 10.0, 0.0]}]
+        np.testing.assert_array_equal(region, image[1][:, 10:21, :10])
+        # the region must have at most max_pixels
+        assert image.select_level(roi, max_pixels=37 * 6 * 5) == 2
+
+
+def test_prefetch_pool(tmp_path):
+    data = _make_data()
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data, path, ("z", "y", "x"), "data", 1, chunks=(8, 32, 32))
+    # the pool that is created for the image is shut down by close
+    image = open_multiscales(path)
+    pool = image.prefetch_pool
+    image.close()
+    with pytest.raises(RuntimeError):
+        pool.submit(print)
+    # and when the image is garbage collected
+    pool = open_multiscales(path).prefetch_pool
+    with pytest.raises(RuntimeError):
+        pool.submit(print)
+    # a pool that is shared between images is not shut down
+    with futures.ThreadPoolExecutor(2) as pool:
+        for _ in range(2):
+            with open_multiscales(path, prefetch_pool=pool) as image:
+                np.testing.assert_array_equal(image[0][3], data[3])
+        assert pool.submit(sum, [1, 2]).result() == 3
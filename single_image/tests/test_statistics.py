@@ -0,0 +1,77 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+import itertools
+
+import numpy as np
+import pytest
+import zarr
+
+from prototypes import v04
+from prototypes.statistics import find_chunks, get_contrast_limits, load_statistics
+from prototypes.v03 import _get_blocks
+
+WRITE_OPTIONS = {
+    "tiled": {"downscaler": "mode", "kwargs": {"scale_factor": [2, 2, 2]}, "n_workers": 4},
+    "block_wise": {"downscaler": "mode", "kwargs": {"scale_factor": [2, 2, 2]}, "n_workers": 4, "block_wise": True},
+    "rescale": {"kwargs": {"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True}},
+}
+
+
+def _make_labels(shape=(37, 101, 75)):
+    # a few objects on an empty background, with negative values to check the histogram offset
+    data = np.zeros(shape, dtype="int16")
+    data[2:10, 5:40, 10:30] = 3
+    data[20:35, 60:90, 40:70] = -7
+    return data
+
+
+def _get_expected(ds):
+    chunk_ranges = [range(-(-sh // ch)) for sh, ch in zip(ds.shape, ds.chunks)]
+    expected = {name: np.zeros(ds.cdata_shape, dtype=dtype)
+                for name, dtype in [("min", ds.dtype), ("max", ds.dtype), ("mean", "float64"), ("empty", "bool")]}
+    data = ds[:]
+    for chunk_id in itertools.product(*chunk_ranges):
+        chunk = data[tuple(slice(cid * ch, (cid + 1) * ch) for cid, ch in zip(chunk_id, ds.chunks))]
+        expected["min"][chunk_id], expected["max"][chunk_id] = chunk.min(), chunk.max()
+        expected["mean"][chunk_id], expected["empty"][chunk_id] = chunk.mean(), (chunk == 0).all()
+    return expected, data
+
+
+@pytest.mark.parametrize("options", list(WRITE_OPTIONS))
+def test_statistics(tmp_path, options):
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(_make_labels(), path, ("z", "y", "x"), "data", 3, chunks=(8, 16, 16), statistics=True,
+                       **WRITE_OPTIONS[options])
+    statistics = load_statistics(path)
+    assert len(statistics) == 3
+    for level, stats in enumerate(statistics):
+        ds = zarr.open(f"{path}/s{level}", mode="r")
+        expected, data = _get_expected(ds)
+        assert tuple(stats["shape"]) == ds.shape and tuple(stats["chunks"]) == ds.chunks
+        for name, values in expected.items():
+            np.testing.assert_allclose(stats[name], values)
+        values, counts = np.unique(data, return_counts=True)
+        assert int(stats["histogram_offset"]) == -2**15
+        np.testing.assert_array_equal(stats["histogram"][values.astype("int64") + 2**15], counts)
+        assert stats["histogram"].sum() == data.size
+
+        # the chunks that contain the label -7 are found without reading the data
+        chunks = find_chunks(statistics, level, min_value=-7, max_value=-7)
+        assert chunks and all((data[bb] == -7).any() for bb in chunks)
+        n_non_empty = sum(not (data[bb] == 0).all() for bb in _get_blocks(ds.shape, ds.chunks))
+        assert len(find_chunks(statistics, level)) == n_non_empty
+
+
+def test_contrast_limits(tmp_path):
+    data = np.random.default_rng(0).integers(0, 1000, size=(16, 64, 64)).astype("uint16")
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data, path, ("z", "y", "x"), "data", 2, chunks=(8, 32, 32), statistics=True,
+                       downscaler="mean", kwargs={"scale_factor": [2, 2, 2]})
+    low, high = get_contrast_limits(load_statistics(path), percentiles=(1, 99))
+    assert abs(low - np.percentile(data, 1)) <= 1 and abs(high - np.percentile(data, 99)) <= 1
+    # there is no histogram for float data, so the min and max value are used
+    path = str(tmp_path / "float.ome.zarr")
+    v04.write_ome_zarr(data.astype("float32"), path, ("z", "y", "x"), "data", 2, chunks=(8, 32, 32),
+                       statistics=True, downscaler="mean", kwargs={"scale_factor": [2, 2, 2]})
+    statistics = load_statistics(path)
+    assert "histogram" not in statistics[0]
+    assert get_contrast_limits(statistics) == (data.min(), data.max())
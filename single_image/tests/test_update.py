@@ -0,0 +1,58 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+import os
+
+import numpy as np
+import pytest
+import zarr
+
+from prototypes import v04
+
+RESCALE_KWARGS = {"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True}
+BOXES = [
+    (slice(3, 9), slice(20, 41), slice(0, 17)),
+    (slice(30, 37), slice(90, None), slice(60, 75)),
+    (slice(None), slice(50, 52), slice(10, 11)),
+]
+
+
+def _make_data(shape, seed):
+    return np.random.default_rng(seed).integers(0, 4, size=shape, dtype="uint8") * 60
+
+
+def _load_levels(path, n_scales):
+    return [zarr.open(f"{path}/s{ii}", mode="r")[:] for ii in range(n_scales)]
+
+
+def _check_update(tmp_path, options, propagate, n_workers):
+    axes_names, n_scales, chunks = ("z", "y", "x"), 4, (8, 16, 16)
+    data = _make_data((37, 101, 75), seed=0)
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data, path, axes_names, "data", n_scales, chunks=chunks, **options)
+
+    for ii, bb in enumerate(BOXES):
+        new_data = _make_data(data[bb].shape, seed=ii + 1)
+        data[bb] = new_data
+        v04.update_ome_zarr(new_data, path, bb, propagate=propagate, n_workers=n_workers)
+    if not propagate:
+        assert os.path.exists(os.path.join(path, "dirty_chunks.json"))
+        v04.propagate_updates(path, n_workers=n_workers)
+    assert not os.path.exists(os.path.join(path, "dirty_chunks.json"))
+
+    # the updated levels are the same as the levels written from the updated data
+    expected_path = str(tmp_path / "expected.ome.zarr")
+    v04.write_ome_zarr(data, expected_path, axes_names, "data", n_scales, chunks=chunks, **options)
+    for level, expected in zip(_load_levels(path, n_scales), _load_levels(expected_path, n_scales)):
+        np.testing.assert_array_equal(level, expected)
+
+
+@pytest.mark.parametrize("downscaler", ["mean", "max", "nearest", "mode"])
+@pytest.mark.parametrize("propagate", [True, False])
+def test_update_ome_zarr(tmp_path, downscaler, propagate):
+    options = {"downscaler": downscaler, "kwargs": {"scale_factor": [2, 2, 2]}}
+    _check_update(tmp_path, options, propagate, n_workers=4)
+
+
+@pytest.mark.parametrize("propagate", [True, False])
+def test_update_ome_zarr_rescale(tmp_path, propagate):
+    # the levels are recomputed from s0 for skimage.transform.rescale
+    _check_update(tmp_path, {"kwargs": RESCALE_KWARGS}, propagate, n_workers=1)
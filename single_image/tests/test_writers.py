@@ -0,0 +1,197 @@
+# Run these tests from the 'single_image' folder via 'python -m pytest tests'.
+import numpy as np
+import pytest
+import skimage.transform
+import zarr
+
+from prototypes import v02, v03, v04, v05
+from prototypes.downscaling import get_downscaler
+from prototypes.v03 import _downscale
+
+# shapes that are not divisible by the chunks or the scale factors
+SHAPES = {("z", "y", "x"): (37, 101, 75), ("t", "z", "y", "x"): (2, 21, 67, 45), ("c", "y", "x"): (2, 131, 97)}
+
+
+def _make_data(shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 4, size=shape, dtype="uint8") * 60
+
+
+def _get_reference(data, axes_names, downscaler, kwargs, n_scales):
+    # the pyramid computed by downscaling the whole array level by level
+    if isinstance(downscaler, str):
+        downscaler, kwargs = get_downscaler(downscaler, kwargs)
+    levels = [data]
+    for _ in range(1, n_scales):
+        levels.append(_downscale(levels[-1], axes_names, downscaler, kwargs))
+    return levels
+
+
+def _load_levels(path, n_scales):
+    return [zarr.open(f"{path}/s{ii}", mode="r")[:] for ii in range(n_scales)]
+
+
+def _check_levels(levels, reference):
+    assert len(levels) == len(reference)
+    for level, ref in zip(levels, reference):
+        assert level.shape == ref.shape
+        np.testing.assert_array_equal(level, ref)
+
+
+@pytest.mark.parametrize("axes_names", list(SHAPES))
+@pytest.mark.parametrize("downscaler", ["mean", "max", "nearest", "mode"])
+def test_block_wise(tmp_path, axes_names, downscaler):
+    data = _make_data(SHAPES[axes_names])
+    kwargs = {"scale_factor": [2] * sum(ax in "zyx" for ax in axes_names)}
+    n_scales = 4
+    chunks = (1,) * (len(axes_names) - 3) + (16, 32, 32) if "z" in axes_names else (1, 32, 32)
+    path = str(tmp_path / "data.ome.zarr")
+    v04.write_ome_zarr(data, path, axes_names, "data", n_scales, chunks=chunks, downscaler=downscaler, kwargs=kwargs,
+                       block_wise=True, n_workers=4)
+    _check_levels(_load_levels(path, n_scales), _get_reference(data, axes_names, downscaler, kwargs, n_scales))
+
+
+def test_block_wise_errors(tmp_path):
+    data = _make_data((32, 32))
+    # skimage.transform.rescale does not give the same result for blocks as for the whole array
+    with pytest.raises(ValueError):
+        v04.write_ome_zarr(data, str(tmp_path / "a.ome.zarr"), ("y", "x"), "a", 2,
+                           kwargs={"scale": (0.5, 0.5), "order": 0}, block_wise=True)
+    # the scale factors can't be determined from the kwargs
+    with pytest.raises(ValueError):
+        v04.write_ome_zarr(data, str(tmp_path / "b.ome.zarr"), ("y", "x"), "b", 2,
+                           downscaler=get_downscaler("mean", {"scale_factor": [2, 2]})[0], kwargs={},
+                           block_wise=True)
+
+
+def _get_chunks(axes_names):
+    return (1,) * (len(axes_names) - 3) + (16, 32, 32) if "z" in axes_names else (1, 32, 32)
+
+
+@pytest.mark.parametrize("axes_names", list(SHAPES))
+@pytest.mark.parametrize("downscaler", ["mean", "mode"])
+@pytest.mark.parametrize("n_workers", [None, 4])
+@pytest.mark.parametrize("n_scales", [2, 4])
+def test_tiled(tmp_path, axes_names, downscaler, n_workers, n_scales):
+    data = _make_data(SHAPES[axes_names])
+    kwargs = {"scale_factor": [2] * sum(ax in "zyx" for ax in axes_names)}
+    reference = _get_reference(data, axes_names, downscaler, kwargs, n_scales)
+    for module in (v03, v04):
+        path = str(tmp_path / f"{module.__name__}.ome.zarr")
+        module.write_ome_zarr(data, path, axes_names, "data", n_scales, chunks=_get_chunks(axes_names),
+                              downscaler=downscaler, kwargs=kwargs, n_workers=n_workers)
+        _check_levels(_load_levels(path, n_scales), reference)
+
+
+@pytest.mark.parametrize("n_workers", [None, 4])
+def test_tiled_several_passes(tmp_path, monkeypatch, n_workers):
+    # with a small memory budget the coarser levels are computed from the levels written by a previous pass
+    monkeypatch.setattr(v03, "MAX_TILE_BYTES", 2**14)
+    axes_names, n_scales = ("z", "y", "x"), 5
+    data = _make_data((37, 301, 259))
+    kwargs = {"scale_factor": [2, 2, 2]}
+    reference = _get_reference(data, axes_names, "mean", kwargs, n_scales)
+    path = str(tmp_path / "v04.ome.zarr")
+    v04.write_ome_zarr(data, path, axes_names, "data", n_scales, chunks=(8, 16, 16), downscaler="mean",
+                       kwargs=kwargs, n_workers=n_workers, statistics=True)
+    _check_levels(_load_levels(path, n_scales), reference)
+    # the 0.1 / 0.2 writer reads the 5d datasets back via _ExpandedDataset
+    path = str(tmp_path / "v02.ome.zarr")
+    v02.write_ome_zarr(data, path, axes_names, "data", n_scales, chunks=(1, 1, 8, 16, 16), downscaler="mean",
+                       kwargs=kwargs, n_workers=n_workers)
+    _check_levels([level[0, 0] for level in _load_levels(path, n_scales)], reference)
+
+
+@pytest.mark.parametrize("n_workers", [None, 4])
+def test_rescale(tmp_path, n_workers):
+    # skimage.transform.rescale downscales the whole array, so the result does not depend on the chunks or workers
+    axes_names, n_scales = ("z", "y", "x"), 4
+    data = _make_data((37, 301, 259))
+    kwargs = {"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True}
+    reference = _get_reference(data, axes_names, skimage.transform.rescale, kwargs, n_scales)
+    for module in (v03, v04):
+        path = str(tmp_path / f"{module.__name__}.ome.zarr")
+        module.write_ome_zarr(data, path, axes_names, "data", n_scales, chunks=(16, 32, 32), kwargs=kwargs,
+                              n_workers=n_workers)
+        _check_levels(_load_levels(path, n_scales), reference)
+
+
+@pytest.mark.parametrize("downscaler", ["mean", None])
+@pytest.mark.parametrize("n_workers", [None, 4])
+def test_v05(tmp_path, downscaler, n_workers):
+    # the sharded 0.5 arrays hold the same pixels as the 0.4 arrays
+    axes_names, n_scales = ("z", "y", "x"), 3
+    data = _make_data((37, 101, 75))
+    if downscaler is None:
+        kwargs = {"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True}
+        options = {"kwargs": kwargs}
+    else:
+        options = {"downscaler": downscaler, "kwargs": {"scale_factor": [2, 2, 2]}}
+    path04, path05 = str(tmp_path / "v04.ome.zarr"), str(tmp_path / "v05.ome.zarr")
+    v04.write_ome_zarr(data, path04, axes_names, "data", n_scales, chunks=(8, 16, 16), n_workers=n_workers, **options)
+    v05.write_ome_zarr(data, path05, axes_names, "data", n_scales, chunks=(8, 16, 16), shards=(16, 32, 32),
+                       n_workers=n_workers, **options)
+    levels = [v05.ShardedArray(f"{path05}/s{ii}")[:] for ii in range(n_scales)]
+    _check_levels(levels, _load_levels(path04, n_scales))
+
+
+@pytest.mark.parametrize("downscaler", ["mean", "mode", None])
+@pytest.mark.parametrize("n_workers", [None, 4])
+def test_dask(tmp_path, downscaler, n_workers):
+    # dask arrays with chunks that are not aligned with the zarr chunks give the same result as numpy data
+    da = pytest.importorskip("dask.array")
+    axes_names, n_scales = ("z", "y", "x"), 4
+    data = _make_data((37, 301, 259))
+    if downscaler is None:
+        kwargs = {"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True}
+        reference = _get_reference(data, axes_names, skimage.transform.rescale, kwargs, n_scales)
+        options = {"kwargs": kwargs}
+    else:
+        kwargs = {"scale_factor": [2, 2, 2]}
+        reference = _get_reference(data, axes_names, downscaler, kwargs, n_scales)
+        options = {"downscaler": downscaler, "kwargs": kwargs}
+    for module in (v03, v04):
+        path = str(tmp_path / f"{module.__name__}.ome.zarr")
+        module.write_ome_zarr(da.from_array(data, chunks=(11, 70, 90)), path, axes_names, "data", n_scales,
+                              chunks=(16, 32, 32), n_workers=n_workers, **options)
+        _check_levels(_load_levels(path, n_scales), reference)
+
+
+@pytest.mark.parametrize("n_workers", [None, 1, 4])
+def test_multi_image(tmp_path, n_workers):
+    # writing the images at once gives the same data and metadata as writing them one after the other
+    axes_names, n_scales, names = ("y", "x"), 3, ["image-0", "image-1", "image-2"]
+    images = _make_data((3, 131, 97))
+    options = {"downscaler": "mean", "kwargs": {"scale_factor": [2, 2]}, "chunks": (32, 32),
+               "scale": {"y": 0.5, "x": 0.5}, "units": ("micrometer", "micrometer")}
+    path = str(tmp_path / "multi.ome.zarr")
+    v04.write_multi_image_ome_zarr(images, path, axes_names, names, n_scales, n_workers=n_workers, **options)
+    expected_path = str(tmp_path / "expected.ome.zarr")
+    for image, name in zip(images, names):
+        v04.write_ome_zarr(image, expected_path, axes_names, name, n_scales, prefix=name, **options)
+
+    f, expected = zarr.open(path, mode="r"), zarr.open(expected_path, mode="r")
+    assert f.attrs["multiscales"] == expected.attrs["multiscales"]
+    for name in names:
+        _check_levels(_load_levels(f"{path}/{name}", n_scales), _load_levels(f"{expected_path}/{name}", n_scales))
+        assert f[f"{name}/s0"].attrs["_ARRAY_DIMENSIONS"] == list(axes_names)
+
+    # the names must be unique and must not exist in the container yet
+    with pytest.raises(AssertionError):
+        v04.write_multi_image_ome_zarr(images[:2], str(tmp_path / "a.ome.zarr"), axes_names, ["a", "a"], n_scales)
+    with pytest.raises(AssertionError):
+        v04.write_multi_image_ome_zarr(images[:1], path, axes_names, names[:1], n_scales)
+
+
+def test_n_workers_5d(tmp_path):
+    # the time points and channels are downscaled in parallel, which gives the same result as the serial loop
+    axes_names, n_scales = ("t", "c", "z", "y", "x"), 3
+    data = _make_data((3, 2, 21, 67, 45))
+    kwargs = {"scale": (0.5, 0.5, 0.5), "order": 0, "preserve_range": True}
+    np.testing.assert_array_equal(_downscale(data, axes_names, skimage.transform.rescale, kwargs, n_workers=4),
+                                  _downscale(data, axes_names, skimage.transform.rescale, kwargs))
+    reference = _get_reference(data, axes_names, skimage.transform.rescale, kwargs, n_scales)
+    for module in (v03, v04):
+        path = str(tmp_path / f"{module.__name__}.ome.zarr")
+        module.write_ome_zarr(data, path, axes_names, "data", n_scales, chunks=(1, 1, 8, 16, 16), kwargs=kwargs,
+                              n_workers=4)
+        _check_levels(_load_levels(path, n_scales), reference)
@@ -1,40 +1,197 @@
 import argparse
 import json
 import os
+import time
+from concurrent import futures
+from functools import lru_cache
 from glob import glob
 
-import requests
-from jsonschema import validate
+from jsonschema.validators import validator_for
 
+# the json schemas for ome-ngff 0.1 - 0.4, taken from https://github.com/ome/ngff,
+# so that the validation does not need network access
+SCHEMA_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas")
+VERSIONS = ("0.1", "0.2", "0.3", "0.4")
 
-def validate_v04():
-    # TODO there is probably a more elegant way to do this with json schema
-    url = "https://raw.githubusercontent.com/ome/ngff/main/0.4/schemas/image.schema"
-    with requests.get(url) as r:
-        with open("./schema.json", "w") as f:
-            f.write(r.text)
-    with open("./schema.json") as f:
+
+@lru_cache(maxsize=None)
+def get_validator(version, schema_name="image"):
+    """Get the (cached) json schema validator for the given ome-ngff version and schema.
+    """
+    assert version in VERSIONS, f"Invalid version {version}, choose one of {VERSIONS}"
+    with open(os.path.join(SCHEMA_ROOT, version, f"{schema_name}.schema")) as f:
         schema = json.load(f)
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+def _load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _validate_schema(attrs, version, schema_name, name):
+    return [f"{name}: {error.message}" for error in get_validator(version, schema_name).iter_errors(attrs)]
+
+
+def _check_multiscales(path, attrs, name):
+    # check that the multiscales metadata is consistent with the arrays
+    errors = []
+    for ms in attrs["multiscales"]:
+        axes = ms.get("axes")
+        # 0.1 and 0.2 don't have axes, the data is always 5d
+        ndim = 5 if axes is None else len(axes)
+        axes_names = None if axes is None else [ax if isinstance(ax, str) else ax["name"] for ax in axes]
+        shapes = []
+        for ds in ms["datasets"]:
+            array_path = os.path.join(path, ds["path"])
+            if not os.path.exists(os.path.join(array_path, ".zarray")):
+                errors.append(f"{name}: the dataset {ds['path']} does not exist")
+                continue
+            array_meta = _load_json(os.path.join(array_path, ".zarray"))
+            shape = array_meta["shape"]
+            shapes.append(shape)
+            if len(shape) != ndim:
+                errors.append(f"{name}: the dataset {ds['path']} has {len(shape)} dimensions, expected {ndim}")
+            for trafo in ds.get("coordinateTransformations", []):
+                values = trafo.get(trafo["type"], [])
+                if len(values) != ndim:
+                    errors.append(
+                        f"{name}: the {trafo['type']} of {ds['path']} has {len(values)} values, expected {ndim}"
+                    )
+            array_attrs_path = os.path.join(array_path, ".zattrs")
+            if axes_names is not None and os.path.exists(array_attrs_path):
+                dims = _load_json(array_attrs_path).get("_ARRAY_DIMENSIONS")
+                if dims is not None and list(dims) != axes_names:
+                    errors.append(
+                        f"{name}: _ARRAY_DIMENSIONS {dims} of {ds['path']} do not match the axes {axes_names}"
+                    )
+        # the scale levels must not increase in size
+        for prev_shape, shape in zip(shapes[:-1], shapes[1:]):
+            if len(prev_shape) == len(shape) and any(sh > prev_sh for sh, prev_sh in zip(shape, prev_shape)):
+                errors.append(f"{name}: the shape {shape} is larger than the shape {prev_shape} of the previous level")
+    return errors
+
+
+def _validate_group(path, attrs, version, name):
+    errors = []
+    if "multiscales" in attrs:
+        errors.extend(_validate_schema(attrs, version, "image", name))
+        errors.extend(_check_multiscales(path, attrs, name))
+        # image labels are validated with the label schema (which only exists from 0.4 on)
+        if "image-label" in attrs and version == "0.4":
+            errors.extend(_validate_schema(attrs, version, "label", name))
+    if "plate" in attrs:
+        errors.extend(_validate_schema(attrs, version, "plate", name))
+        for well in attrs["plate"].get("wells", []):
+            if not os.path.exists(os.path.join(path, well["path"], ".zattrs")):
+                errors.append(f"{name}: the well {well['path']} does not exist")
+    if "well" in attrs:
+        errors.extend(_validate_schema(attrs, version, "well", name))
+        for image in attrs["well"].get("images", []):
+            if not os.path.exists(os.path.join(path, image["path"], ".zattrs")):
+                errors.append(f"{name}: the image {image['path']} does not exist")
+    return errors
+
+
+def _get_version(attrs):
+    if "multiscales" in attrs:
+        return attrs["multiscales"][0].get("version")
+    for key in ("plate", "well"):
+        if key in attrs:
+            return attrs[key].get("version")
+    return None
+
 
-    files = glob("./v0.4/*.ome.zarr")
-    for path in files:
-        print("Validate", path)
-        with open(os.path.join(path, ".zattrs"), "r") as f:
-            metadata = json.load(f)
-        validate(instance=metadata, schema=schema)
-    print("All passed")
+def _get_groups(path):
+    # get all groups with ome-ngff metadata in the store
+    groups = []
+    for root, dirs, files in os.walk(path):
+        if ".zattrs" not in files or ".zarray" in files:
+            continue
+        attrs = _load_json(os.path.join(root, ".zattrs"))
+        if any(key in attrs for key in ("multiscales", "plate", "well", "labels")):
+            groups.append((root, attrs))
+        # don't descend into the arrays
+        dirs[:] = [dd for dd in dirs if not os.path.exists(os.path.join(root, dd, ".zarray"))]
+    return groups
+
+
+def validate_store(path, version=None):
+    """Validate the ome-ngff metadata of all groups in the store against the schema and against the data.
+
+    Returns the list of errors and the validation time in seconds.
+    """
+    t0 = time.perf_counter()
+    errors = []
+    groups = _get_groups(path)
+    if not groups:
+        errors.append(f"{path}: no ome-ngff metadata found")
+    for group_path, attrs in groups:
+        name = os.path.relpath(group_path, path)
+        group_version = _get_version(attrs) if version is None else version
+        if group_version is None:
+            # groups that only list the labels don't have a version
+            if "labels" in attrs:
+                missing = [label for label in attrs["labels"] if not os.path.isdir(os.path.join(group_path, label))]
+                errors.extend(f"{name}: the label {label} does not exist" for label in missing)
+                continue
+            errors.append(f"{name}: could not determine the ome-ngff version")
+            continue
+        if group_version not in VERSIONS:
+            errors.append(f"{name}: the version {group_version} is not supported")
+            continue
+        errors.extend(_validate_group(group_path, attrs, group_version, name))
+    return errors, time.perf_counter() - t0
+
+
+def validate_stores(paths, version=None, n_workers=1):
+    """Validate the stores in parallel, each worker process compiles the schemas once.
+    """
+    if n_workers > 1:
+        with futures.ProcessPoolExecutor(n_workers) as pp:
+            results = list(pp.map(validate_store, paths, [version] * len(paths), chunksize=16))
+    else:
+        results = [validate_store(path, version) for path in paths]
+    return {path: {"errors": errors, "time": t} for path, (errors, t) in zip(paths, results)}
+
+
+def print_report(report):
+    for path, result in sorted(report.items(), key=lambda item: item[1]["time"], reverse=True):
+        status = "passed" if not result["errors"] else f"failed with {len(result['errors'])} errors"
+        print(f"{path}: {status} in {result['time'] * 1000:.1f} ms")
+        for error in result["errors"]:
+            print("  ", error)
+    n_failed = sum(1 for result in report.values() if result["errors"])
+    total_time = sum(result["time"] for result in report.values())
+    print(f"Validated {len(report)} stores in {total_time:.2f} s, {n_failed} failed")
 
 
 def main():
     parser = argparse.ArgumentParser()
+    # the version selects the example data folder, the stores are validated against the version in their metadata
     parser.add_argument("-v", "--version", type=str)
+    parser.add_argument("-i", "--inputs", type=str, nargs="+", default=None,
+                        help="The stores to validate, by default all stores in ./v<VERSION>")
+    parser.add_argument("-n", "--n_workers", type=int, default=1)
+    parser.add_argument("-o", "--output", default=None, help="Save the validation report as json")
     args = parser.parse_args()
-    version = args.version.lstrip("v")
-    if version == "0.4":
-        validate_v04()
-    else:
+    version = None if args.version is None else args.version.lstrip("v")
+    if version is not None and version not in VERSIONS:
         raise ValueError(f"Invalid version: {args.version}")
 
+    if args.inputs is None:
+        assert version is not None, "Either the version or the inputs have to be given"
+        paths = sorted(glob(f"./v{version}/*.ome.zarr"))
+    else:
+        paths = args.inputs
+    report = validate_stores(paths, n_workers=args.n_workers)
+    print_report(report)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,204 @@
+# Convert the example data from the n5 container on s3 to ome.zarr on a (remote) target store,
+# without downloading the data to local disk first.
+import argparse
+import itertools
+import math
+from concurrent import futures
+
+import numpy as np
+import zarr
+from tqdm import tqdm
+from zarr.n5 import N5FSStore
+from zarr.storage import FSStore
+
+# the ome-ngff names for the units that are commonly used in n5 attributes
+UNITS = {"nm": "nanometer", "um": "micrometer", "µm": "micrometer", "mm": "millimeter"}
+
+
+def _get_storage_options(endpoint_url, anon):
+    if endpoint_url is None:
+        return {}
+    return {"anon": anon, "client_kwargs": {"endpoint_url": endpoint_url}}
+
+
+def _run_bounded(func, blocks, n_threads, max_in_flight, desc):
+    # only submit max_in_flight blocks at a time, so that the memory used for the data of blocks
+    # that were read but not yet written is bounded, independent of the size of the volume
+    blocks = list(blocks)
+    in_flight = set()
+    with futures.ThreadPoolExecutor(n_threads) as tp, tqdm(total=len(blocks), desc=desc) as pbar:
+        for bb in blocks:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+                pbar.update(len(done))
+            in_flight.add(tp.submit(func, bb))
+        for task in futures.as_completed(in_flight):
+            task.result()
+            pbar.update(1)
+
+
+def _get_blocks(shape, block_shape):
+    n_blocks = [math.ceil(sh / bs) for sh, bs in zip(shape, block_shape)]
+    for block_id in itertools.product(*[range(nb) for nb in n_blocks]):
+        yield tuple(
+            slice(bid * bs, min((bid + 1) * bs, sh)) for bid, bs, sh in zip(block_id, block_shape, shape)
+        )
+
+
+def _get_downscaled_shape(shape, scale_factor):
+    return tuple(-(-sh // fac) for sh, fac in zip(shape, scale_factor))
+
+
+def _downscale_mean(data, scale_factor):
+    # pad the data to a multiple of the scale factor (this is only necessary at the border)
+    pad_width = [(0, -sh % fac) for sh, fac in zip(data.shape, scale_factor)]
+    if any(pw[1] > 0 for pw in pad_width):
+        data = np.pad(data, pad_width, mode="edge")
+    views = [
+        data[tuple(slice(off, None, fac) for off, fac in zip(offset, scale_factor))]
+        for offset in itertools.product(*[range(fac) for fac in scale_factor])
+    ]
+    is_integer = np.issubdtype(data.dtype, np.integer)
+    acc = np.zeros(views[0].shape, dtype="int64" if is_integer else "float64")
+    for view in views:
+        acc += view
+    n = len(views)
+    if is_integer:  # divide with rounding
+        acc += n // 2
+        acc //= n
+    else:
+        acc /= n
+    return acc.astype(data.dtype)
+
+
+def _downscale_nearest(data, scale_factor):
+    return np.ascontiguousarray(data[tuple(slice(None, None, fac) for fac in scale_factor)])
+
+
+def _get_resolution(source_root, source_key):
+    # n5 stores the resolution in xyz order, either as 'resolution' (+ 'unit') or as 'pixelResolution'.
+    # it is given for the dataset or for one of its parent groups, in which case it refers to s0
+    # and is multiplied with the 'downsamplingFactors' of the dataset. returns the resolution in zyx order and the unit
+    parts = source_key.split("/")
+    for ii in range(len(parts), -1, -1):
+        attrs = source_root["/".join(parts[:ii])].attrs if ii > 0 else source_root.attrs
+        if "pixelResolution" in attrs:
+            resolution, unit = attrs["pixelResolution"]["dimensions"], attrs["pixelResolution"].get("unit")
+        elif "resolution" in attrs:
+            resolution, unit = attrs["resolution"], attrs.get("unit")
+        else:
+            continue
+        factors = [1, 1, 1]
+        if ii < len(parts):
+            factors = source_root[source_key].attrs.get("downsamplingFactors", factors)
+        resolution = [res * fac for res, fac in zip(resolution[::-1], factors[::-1])]
+        return resolution, UNITS.get(unit, unit)
+    raise ValueError(f"Could not find the resolution of {source_key} in the n5 attributes")
+
+
+def _get_multiscales(name, n_scales, resolution, unit, scale_factors):
+    axes = [{"name": ax, "type": "space"} for ax in "zyx"]
+    if unit is not None:
+        for ax in axes:
+            ax["unit"] = unit
+    datasets, scale = [], list(resolution)
+    for ii in range(n_scales):
+        datasets.append({"path": f"s{ii}", "coordinateTransformations": [{"type": "scale", "scale": list(scale)}]})
+        if ii < n_scales - 1:
+            scale = [sc * fac for sc, fac in zip(scale, scale_factors[ii])]
+    return {"name": name, "axes": axes, "datasets": datasets, "version": "0.4"}
+
+
+def convert_n5_to_ngff(source_url, source_key, target_url, name, scale_factors, chunks, resolution=None,
+                       unit=None, is_label=False, source_options={}, target_options={},
+                       n_threads=16, max_in_flight=2048):
+    """Convert a dataset from an n5 container to an ome.zarr image with a multiscale pyramid.
+
+    The source and target can be any fsspec url (e.g. s3://bucket/container.n5 or a local path),
+    the data is streamed tile-wise from the source to the target. Each tile is aligned with the chunks of all
+    scale levels, so all levels are downscaled from the tile in memory (mean for images, nearest for labels)
+    and the target is never read. At most max_in_flight chunks of s0 are held in memory at a time.
+    The resolution and its unit are read from the n5 attributes if the resolution is not given.
+    Chunks that only contain zeros (e.g. the background of segmentations) are not written.
+    """
+    source_root = zarr.open(N5FSStore(source_url, mode="r", **source_options), mode="r")
+    source = source_root[source_key]
+    if resolution is None:
+        resolution, unit = _get_resolution(source_root, source_key)
+    target = zarr.group(FSStore(target_url, key_separator="/", mode="w", **target_options))
+    downscaler = _downscale_nearest if is_label else _downscale_mean
+
+    shapes = [source.shape]
+    for scale_factor in scale_factors:
+        shapes.append(_get_downscaled_shape(shapes[-1], scale_factor))
+    datasets = [
+        target.create_dataset(f"s{ii}", shape=shape, chunks=chunks, dtype=source.dtype,
+                              dimension_separator="/", overwrite=True, write_empty_chunks=False)
+        for ii, shape in enumerate(shapes)
+    ]
+    # the tiles are aligned with the chunks of all scale levels, so they can be written without locking
+    total_factors = [math.prod(facs) for facs in zip(*scale_factors)] if scale_factors else [1] * len(chunks)
+    tile_shape = [ch * fac for ch, fac in zip(chunks, total_factors)]
+    chunks_per_tile = math.prod(total_factors)
+    if max_in_flight < chunks_per_tile:
+        raise ValueError(f"max_in_flight={max_in_flight} is smaller than the {chunks_per_tile} chunks of s0 in a tile, "
+                         "which are needed to downscale all levels from the tile. Use fewer scale levels.")
+
+    def convert_tile(bb):
+        data = source[bb]
+        datasets[0][bb] = data
+        level_factors = [1] * data.ndim
+        for ds, scale_factor in zip(datasets[1:], scale_factors):
+            level_factors = [lfac * fac for lfac, fac in zip(level_factors, scale_factor)]
+            data = downscaler(data, scale_factor)
+            level_bb = tuple(
+                slice(b.start // fac, b.start // fac + sh) for b, fac, sh in zip(bb, level_factors, data.shape)
+            )
+            ds[level_bb] = data
+
+    # the reads and writes of the chunks in a tile are concurrent already (via fsspec),
+    # so processing a few tiles at a time is enough to saturate the connection
+    tiles_in_flight = max_in_flight // chunks_per_tile
+    _run_bounded(convert_tile, _get_blocks(source.shape, tile_shape), min(n_threads, tiles_in_flight),
+                 tiles_in_flight, f"Convert {name}")
+
+    ms = _get_multiscales(name, len(scale_factors) + 1, resolution, unit, scale_factors)
+    target.attrs["multiscales"] = [ms]
+
+
+def convert_remote_example(target_root, source_endpoint, target_endpoint, scale, n_threads, max_in_flight):
+    scale_factors = [[2, 2, 2]] * 3
+    chunks = (64,) * 3
+
+    source_options = _get_storage_options(source_endpoint, anon=True)
+    target_options = _get_storage_options(target_endpoint, anon=False)
+    dataset = f"setup0/timepoint0/s{scale}"
+
+    convert_n5_to_ngff("s3://covid-fib-sem/Covid19-S4-Area2/images/local/fibsem-raw.n5", dataset,
+                       f"{target_root}/raw.ome.zarr", "raw", scale_factors, chunks,
+                       source_options=source_options, target_options=target_options,
+                       n_threads=n_threads, max_in_flight=max_in_flight)
+    convert_n5_to_ngff("s3://covid-fib-sem/Covid19-S4-Area2/images/local/s4_area2_segmentation.n5", dataset,
+                       f"{target_root}/segmentation.ome.zarr", "segmentation", scale_factors, chunks,
+                       is_label=True, source_options=source_options, target_options=target_options,
+                       n_threads=n_threads, max_in_flight=max_in_flight)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    # the root url for the converted data, e.g. s3://my-bucket/covid-example
+    parser.add_argument("target_root")
+    parser.add_argument("--source_endpoint", default="https://s3.embl.de")
+    parser.add_argument("--target_endpoint", default=None)
+    parser.add_argument("--scale", "-s", default=3, type=int)
+    parser.add_argument("--n_threads", "-n", default=16, type=int)
+    parser.add_argument("--max_in_flight", "-m", default=2048, type=int)
+    args = parser.parse_args()
+    convert_remote_example(args.target_root, args.source_endpoint, args.target_endpoint,
+                           args.scale, args.n_threads, args.max_in_flight)
+
+
+if __name__ == "__main__":
+    main()
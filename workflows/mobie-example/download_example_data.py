@@ -1,50 +1,90 @@
 import argparse
 import json
 import os
+from concurrent import futures
 
 import s3fs
+from fsspec.implementations.dirfs import DirFileSystem
 from tqdm import tqdm
 
 
-def download_n5_volume(endpoint_url, bucket_name, container, dataset, output_file, output_key):
+def _download_chunk(fs, remote_path, local_path):
+    data = fs.cat_file(remote_path)
+    with open(local_path, "wb") as f:
+        f.write(data)
+    return len(data)
+
+
+def _is_downloaded(local_path, size):
+    return os.path.exists(local_path) and os.path.getsize(local_path) == size
+
+
+def download_n5_volume(endpoint_url, bucket_name, container, dataset, output_file, output_key,
+                       n_threads=16, fs=None):
+    """Download a dataset from an n5 container on s3.
+
+    The chunks are downloaded concurrently with n_threads, which share the connection pool of the s3 filesystem.
+    Chunks that were already downloaded with the correct size are skipped, so an interrupted download can be resumed.
+    A different fsspec filesystem can be passed via fs, e.g. fsspec.filesystem("file") to copy from a local directory
+    that has the same layout as the bucket.
+    """
     os.makedirs(output_file, exist_ok=True)
 
-    # open the container on s3
-    fs = s3fs.S3FileSystem(anon=True, client_kwargs={"endpoint_url": endpoint_url})
-    store = s3fs.S3Map(root=f"{bucket_name}/{container}", s3=fs)
+    # open the container on s3, the connection pool must be large enough to serve all threads
+    if fs is None:
+        fs = s3fs.S3FileSystem(anon=True, client_kwargs={"endpoint_url": endpoint_url},
+                               config_kwargs={"max_pool_connections": n_threads})
+    fs = DirFileSystem(path=f"{bucket_name}/{container}", fs=fs)
 
     # copy the root level attributes file
-    attrs = store["attributes.json"].decode("utf-8")
-    attrs = json.loads(attrs)
+    attrs = json.loads(fs.cat_file("attributes.json").decode("utf-8"))
     attrs_file = os.path.join(output_file, "attributes.json")
     with open(attrs_file, "w") as f:
         json.dump(attrs, f)
 
-    # open the dataset store
-    store = s3fs.S3Map(root=f"{bucket_name}/{container}/{dataset}", s3=fs)
-
     # copy the dataset level attributes file
     ds_file = os.path.join(output_file, output_key)
     os.makedirs(ds_file, exist_ok=True)
-    attrs = store["attributes.json"].decode("utf-8")
-    attrs = json.loads(attrs)
+    attrs = json.loads(fs.cat_file(f"{dataset}/attributes.json").decode("utf-8"))
     attrs_file = os.path.join(ds_file, "attributes.json")
     with open(attrs_file, "w") as f:
         json.dump(attrs, f)
 
-    # download all the chunks
-    for name, obj in tqdm(store.items(), desc=f"Download data from {endpoint_url}/{bucket_name}/{container}/{dataset}"):
+    # list all chunks with their size (this needs a single listing request per 1000 chunks on s3)
+    # and skip the chunks that have already been downloaded
+    chunks, n_skipped = {}, 0
+    for path, info in fs.find(dataset, detail=True).items():
+        name = os.path.relpath(path, dataset)
         if name == "attributes.json":
             continue
         chunk_path = os.path.join(ds_file, name)
-        os.makedirs(os.path.split(chunk_path)[0], exist_ok=True)
-        with open(chunk_path, "wb") as f:
-            f.write(obj)
+        if _is_downloaded(chunk_path, info["size"]):
+            n_skipped += 1
+        else:
+            chunks[path] = (chunk_path, info["size"])
+    if n_skipped > 0:
+        print("Skipping", n_skipped, "chunks that have already been downloaded")
+
+    # create the chunk directories once up front instead of once per chunk
+    for chunk_dir in {os.path.dirname(chunk_path) for chunk_path, _ in chunks.values()}:
+        os.makedirs(chunk_dir, exist_ok=True)
+
+    # download all the chunks and report the progress in bytes / s
+    total_size = sum(size for _, size in chunks.values())
+    desc = f"Download data from {endpoint_url}/{bucket_name}/{container}/{dataset}"
+    with tqdm(total=total_size, desc=desc, unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+        with futures.ThreadPoolExecutor(n_threads) as tp:
+            tasks = [
+                tp.submit(_download_chunk, fs, path, chunk_path) for path, (chunk_path, _) in chunks.items()
+            ]
+            for task in futures.as_completed(tasks):
+                pbar.update(task.result())
 
 
 def download_example_data():
     parser = argparse.ArgumentParser()
     parser.add_argument("--scale", "-s", default=3, type=int)
+    parser.add_argument("--n_threads", "-n", default=16, type=int)
     args = parser.parse_args()
 
     os.makedirs("./example_data", exist_ok=True)
@@ -52,12 +92,13 @@ def download_example_data():
     download_n5_volume("https://s3.embl.de", "covid-fib-sem",
                        container="Covid19-S4-Area2/images/local/fibsem-raw.n5",
                        dataset=f"setup0/timepoint0/s{args.scale}",
-                       output_file="./example_data/raw.n5", output_key="data")
+                       output_file="./example_data/raw.n5", output_key="data", n_threads=args.n_threads)
     # download the segmentation data
     download_n5_volume("https://s3.embl.de", "covid-fib-sem",
                        container="Covid19-S4-Area2/images/local/s4_area2_segmentation.n5",
                        dataset=f"setup0/timepoint0/s{args.scale}",
-                       output_file="./example_data/segmentation.n5", output_key="data")
+                       output_file="./example_data/segmentation.n5", output_key="data",
+                       n_threads=args.n_threads)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+# Run these tests from the 'mobie-example' folder via 'python -m pytest'.
+import os
+
+import numpy as np
+import pytest
+import zarr
+
+from convert_remote_to_ngff import _downscale_mean, convert_n5_to_ngff
+
+SCALE_FACTORS = [[2, 2, 2], [1, 2, 2]]
+
+
+def _create_source(tmp_path, is_label=False):
+    # the resolution is stored in the attributes of the parent group and refers to s0
+    container = os.path.join(tmp_path, "data.n5")
+    root = zarr.open(zarr.N5Store(container), mode="w")
+    group = root.create_group("setup0/timepoint0")
+    group.attrs["resolution"] = [4.0, 4.0, 8.0]
+    group.attrs["unit"] = "nm"
+    rng = np.random.default_rng(0)
+    # shapes and blocks that are not aligned with the tiles
+    data = rng.integers(0, 255, size=(37, 101, 75), dtype="uint8")
+    if is_label:
+        data = np.zeros(data.shape, dtype="uint32")
+        data[5:20, 10:60, 20:50] = 3
+    ds = group.create_dataset("s1", data=data, chunks=(13, 17, 19))
+    ds.attrs["downsamplingFactors"] = [2, 2, 2]
+    return container, data
+
+
+@pytest.mark.parametrize("is_label", [False, True])
+def test_convert_n5_to_ngff(tmp_path, is_label):
+    container, data = _create_source(tmp_path, is_label)
+    target = os.path.join(tmp_path, "data.ome.zarr")
+    convert_n5_to_ngff(container, "setup0/timepoint0/s1", target, "data", SCALE_FACTORS, (8, 16, 16),
+                       is_label=is_label, n_threads=4, max_in_flight=64)
+    root = zarr.open(target, mode="r")
+    # the tiles are aligned with the scale factors, so the result is the same as for the whole volume
+    expected = data
+    for ii, scale_factor in enumerate([None] + SCALE_FACTORS):
+        if scale_factor is not None:
+            slices = tuple(slice(None, None, fac) for fac in scale_factor)
+            expected = expected[slices] if is_label else _downscale_mean(expected, scale_factor)
+        np.testing.assert_array_equal(root[f"s{ii}"][:], expected)
+
+    ms = root.attrs["multiscales"][0]
+    assert [ax["unit"] for ax in ms["axes"]] == ["nanometer"] * 3
+    scales = [ds["coordinateTransformations"][0]["scale"] for ds in ms["datasets"]]
+    assert scales == [[16.0, 8.0, 8.0], [32.0, 16.0, 16.0], [32.0, 32.0, 32.0]]
+
+
+def test_convert_n5_to_ngff_max_in_flight(tmp_path):
+    container, _ = _create_source(tmp_path)
+    target = os.path.join(tmp_path, "data.ome.zarr")
+    # a tile contains 2 * 4 * 4 = 32 chunks of s0, which don't fit into max_in_flight
+    with pytest.raises(ValueError):
+        convert_n5_to_ngff(container, "setup0/timepoint0/s1", target, "data", SCALE_FACTORS, (8, 16, 16),
+                           max_in_flight=16)
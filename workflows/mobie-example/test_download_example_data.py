@@ -0,0 +1,49 @@
+# Run these tests from the 'mobie-example' folder via 'python -m pytest'.
+import os
+
+import fsspec
+import numpy as np
+import zarr
+
+from download_example_data import download_n5_volume
+
+
+def _create_bucket(tmp_path):
+    # a local directory with the same layout as the s3 bucket
+    container = os.path.join(tmp_path, "bucket", "data.n5")
+    root = zarr.open(zarr.N5Store(container), mode="w")
+    data = np.random.default_rng(0).integers(0, 255, size=(40, 50, 60), dtype="uint8")
+    ds = root.create_dataset("setup0/timepoint0/s0", data=data, chunks=(16, 16, 16))
+    ds.attrs["downsamplingFactors"] = [1, 1, 1]
+    return data
+
+
+def _download(tmp_path, output_file):
+    download_n5_volume(None, os.path.join(tmp_path, "bucket"), "data.n5", "setup0/timepoint0/s0",
+                       output_file, "data", n_threads=4, fs=fsspec.filesystem("file"))
+
+
+def test_download_n5_volume(tmp_path):
+    data = _create_bucket(tmp_path)
+    output_file = os.path.join(tmp_path, "download.n5")
+    _download(tmp_path, output_file)
+    ds = zarr.open(zarr.N5Store(output_file), mode="r")["data"]
+    np.testing.assert_array_equal(ds[:], data)
+    assert ds.attrs["downsamplingFactors"] == [1, 1, 1]
+
+
+def test_download_n5_volume_resume(tmp_path):
+    data = _create_bucket(tmp_path)
+    output_file = os.path.join(tmp_path, "download.n5")
+    _download(tmp_path, output_file)
+    # simulate an interrupted download: one chunk is missing and one was only written partially
+    chunk_dir = os.path.join(output_file, "data")
+    chunk_paths = sorted(
+        os.path.join(root, name) for root, _, names in os.walk(chunk_dir) for name in names
+        if name != "attributes.json"
+    )
+    os.remove(chunk_paths[0])
+    with open(chunk_paths[1], "r+b") as f:
+        f.truncate(10)
+    _download(tmp_path, output_file)
+    np.testing.assert_array_equal(zarr.open(zarr.N5Store(output_file), mode="r")["data"][:], data)
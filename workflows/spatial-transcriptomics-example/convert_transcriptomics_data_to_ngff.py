@@ -1,11 +1,21 @@
 import argparse
+import itertools
+import json
 import os
+import time
+from concurrent import futures
+from contextlib import contextmanager
+from functools import partial
 from glob import glob
+from shutil import rmtree
 
-import imageio
+import dask
+import dask.array as da
+import numpy as np
 import ome_zarr
-import ome_zarr.scale
+import ome_zarr.io
 import ome_zarr.writer
+import tifffile
 import zarr
 from tqdm import tqdm
 
@@ -36,58 +46,246 @@ def get_storage_opts(axis_names):
     return {"chunks": chunks}
 
 
-def convert_image_data(in_path, group, resolution, units, name):
-    # load the input data from ome.tif
-    vol = imageio.volread(in_path)
-
-    # the data is stored as 'zcyx'. This is currently not allowed by ome.zarr, so we reorder to 'czyx'
-    vol = vol.transpose((1, 0, 2, 3))
-
-    # create scale pyramid
-    # how do we set options for the scaling?
-    # (in this case the defaults are fine, but it should be possible to over-ride this in general)
-    scaler = ome_zarr.scale.Scaler()
-    mip = scaler.local_mean(vol)
+@contextmanager
+def read_tif_lazy(in_path):
+    """Read the first series of a tif file lazily, each page (= yx plane) is only loaded when it is needed.
+
+    The file is opened once and stays open until the context is left, so the data must be written inside of it.
+    """
+    with tifffile.TiffFile(in_path) as tif:
+        # the pages are read by the dask threads via the same file handle, so the reads must be locked
+        tif.filehandle.set_lock(True)
+        series = tif.series[0]
+        plane_shape = series.shape[-2:]
+        pages = [
+            da.from_delayed(dask.delayed(page.asarray, pure=False)(), plane_shape, series.dtype)
+            for page in series.pages
+        ]
+        yield da.stack(pages).reshape(series.shape)
+
+
+def downscale_local_mean(vol, n_levels=4, factor=2):
+    # lazy version of ome_zarr.scale.Scaler().local_mean: average over factor x factor blocks in yx
+    # and pad with zeros at the border, like skimage.transform.downscale_local_mean
+    mip = [vol]
+    for _ in range(n_levels):
+        vol = mip[-1]
+        pad_width = [(0, 0)] * (vol.ndim - 2) + [(0, -sh % factor) for sh in vol.shape[-2:]]
+        if any(pw[1] > 0 for pw in pad_width):
+            vol = da.pad(vol, pad_width)
+        axes = {vol.ndim - 2: factor, vol.ndim - 1: factor}
+        mip.append(da.coarsen(np.mean, vol, axes).astype(vol.dtype))
+    return mip
+
+
+def _mode(x, axis=None):
+    # the most frequent value over the axes, ties are resolved in favor of the value that occurs first
+    axis = tuple(range(x.ndim)) if axis is None else axis
+    x = np.moveaxis(x, axis, tuple(range(-len(axis), 0)))
+    x = x.reshape(x.shape[:x.ndim - len(axis)] + (-1,))
+    counts = (x[..., :, None] == x[..., None, :]).sum(axis=-1)
+    return np.take_along_axis(x, counts.argmax(axis=-1)[..., None], axis=-1)[..., 0]
+
+
+def downscale_mode(vol, n_levels=4, factor=2):
+    # lazy mode (majority) pooling over factor x factor blocks in yx; unlike nearest neighbor downscaling
+    # this does not depend on the position in the block, so small objects are preserved more faithfully
+    mip = [vol]
+    for _ in range(n_levels):
+        vol = mip[-1]
+        pad_width = [(0, 0)] * (vol.ndim - 2) + [(0, -sh % factor) for sh in vol.shape[-2:]]
+        if any(pw[1] > 0 for pw in pad_width):
+            vol = da.pad(vol, pad_width, mode="edge")
+        axes = {vol.ndim - 2: factor, vol.ndim - 1: factor}
+        mip.append(da.coarsen(_mode, vol, axes))
+    return mip
+
+
+def _compute_block_table(block, offset):
+    # the voxel count, bounding box and the sum of the coordinates of each label id in the block
+    ids, inverse, counts = np.unique(block, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    coords = np.unravel_index(np.arange(block.size), block.shape)
+    bb_min = np.full((len(ids), block.ndim), np.iinfo("int64").max, dtype="int64")
+    bb_max = np.zeros((len(ids), block.ndim), dtype="int64")
+    coord_sum = np.zeros((len(ids), block.ndim), dtype="float64")
+    for axis, (coord, off) in enumerate(zip(coords, offset)):
+        coord = coord + off
+        np.minimum.at(bb_min[:, axis], inverse, coord)
+        np.maximum.at(bb_max[:, axis], inverse, coord)
+        coord_sum[:, axis] = np.bincount(inverse, weights=coord, minlength=len(ids))
+    return ids, counts, bb_min, bb_max, coord_sum
+
+
+def _merge_block_tables(block_tables):
+    ids, counts, bb_min, bb_max, coord_sum = [np.concatenate(values) for values in zip(*block_tables)]
+    label_ids, inverse = np.unique(ids, return_inverse=True)
+    n_labels, ndim = len(label_ids), bb_min.shape[1]
+    merged_counts = np.zeros(n_labels, dtype="int64")
+    np.add.at(merged_counts, inverse, counts)
+    merged_min = np.full((n_labels, ndim), np.iinfo("int64").max, dtype="int64")
+    np.minimum.at(merged_min, inverse, bb_min)
+    merged_max = np.zeros((n_labels, ndim), dtype="int64")
+    np.maximum.at(merged_max, inverse, bb_max)
+    merged_sum = np.zeros((n_labels, ndim), dtype="float64")
+    np.add.at(merged_sum, inverse, coord_sum)
+    # the background (0) is not part of the table
+    keep = label_ids != 0
+    return {
+        "label_id": label_ids[keep],
+        "count": merged_counts[keep],
+        # the bounding box is stored as [start, stop) in voxel coordinates of the full resolution level
+        "bb_start": merged_min[keep],
+        "bb_stop": merged_max[keep] + 1,
+        "centroid": merged_sum[keep] / merged_counts[keep][:, None],
+    }
+
+
+def write_label_table(group, label_name, table, axis_names):
+    """Write the label table to 'tables/<label_name>', next to the 'labels' group.
+    """
+    table_group = group.require_group(f"tables/{label_name}")
+    for key, values in table.items():
+        table_group.create_dataset(key, data=values, overwrite=True)
+    table_group.attrs.update({"region": f"labels/{label_name}", "instance_key": "label_id", "axes": list(axis_names)})
+
+
+def read_label_table(path, label_name):
+    """Read the label table of a converted position, returns a dict that maps the label ids to
+    their voxel count, bounding box ([start, stop) per axis) and centroid.
+    """
+    table_group = zarr.open(path, mode="r")[f"tables/{label_name}"]
+    table = {key: table_group[key][:] for key in ("label_id", "count", "bb_start", "bb_stop", "centroid")}
+    return {
+        int(label_id): {
+            "count": int(count),
+            "bounding_box": [(int(start), int(stop)) for start, stop in zip(bb_start, bb_stop)],
+            "centroid": centroid.tolist(),
+        }
+        for label_id, count, bb_start, bb_stop, centroid in zip(*table.values())
+    }
 
-    # specify the axis and transformation metadata
-    axis_names = tuple("czyx")
-    axes, trafos = get_axes_and_trafos(mip, axis_names, units, resolution)
 
-    # provide additional storage options for zarr
-    storage_opts = get_storage_opts(axis_names)
+def convert_image_data(in_path, group, resolution, units, name):
+    # load the input data from ome.tif lazily
+    with read_tif_lazy(in_path) as vol:
+        # the data is stored as 'zcyx'. This is currently not allowed by ome.zarr, so we reorder to 'czyx'
+        # (this is a lazy operation, the data is only transposed chunk by chunk when it is written)
+        vol = vol.transpose((1, 0, 2, 3))
 
-    # write the data to ome.zarr
-    ome_zarr.writer.write_multiscale(
-        mip, group,
-        axes=axes, coordinate_transformations=trafos,
-        storage_options=storage_opts, name=name
-    )
+        # create scale pyramid
+        mip = downscale_local_mean(vol)
 
+        # specify the axis and transformation metadata
+        axis_names = tuple("czyx")
+        axes, trafos = get_axes_and_trafos(mip, axis_names, units, resolution)
 
-def convert_label_data(in_path, group, resolution, units, label_name, colors=None):
-    # load the input data from ome.tif
-    vol = imageio.volread(in_path)
-    if vol.ndim != 3:
-        print("Labels have unexpected shape", vol.shape, "for", in_path, label_name)
-        print("Adding these labels will be skipped")
-        return
+        # provide additional storage options for zarr
+        storage_opts = get_storage_opts(axis_names)
+        mip = [level.rechunk(storage_opts["chunks"]) for level in mip]
 
-    # create scale pyramid
-    scaler = ome_zarr.scale.Scaler()
-    mip = scaler.nearest(vol)
+        # write the data to ome.zarr
+        ome_zarr.writer.write_multiscale(
+            mip, group,
+            axes=axes, coordinate_transformations=trafos,
+            storage_options=storage_opts, name=name
+        )
 
-    # specify the axis and transformation metadata
-    axis_names = tuple("zyx")
-    axes, trafos = get_axes_and_trafos(mip, axis_names, units, resolution)
 
-    # provide additional storage options for zarr
-    storage_opts = get_storage_opts(axis_names)
+def convert_label_data(in_path, group, resolution, units, label_name, colors=None):
+    # load the input data from ome.tif lazily
+    with read_tif_lazy(in_path) as vol:
+        if vol.ndim != 3:
+            print("Labels have unexpected shape", vol.shape, "for", in_path, label_name)
+            print("Adding these labels will be skipped")
+            return
+
+        # create scale pyramid
+        mip = downscale_mode(vol)
+
+        # specify the axis and transformation metadata
+        axis_names = tuple("zyx")
+        axes, trafos = get_axes_and_trafos(mip, axis_names, units, resolution)
+
+        # provide additional storage options for zarr
+        storage_opts = get_storage_opts(axis_names)
+        mip = [level.rechunk(storage_opts["chunks"]) for level in mip]
+
+        # the labels are mostly background, so we create the arrays ourselves in order to not store the chunks
+        # that only contain zeros (ome_zarr.writer.write_multiscale_labels writes all chunks)
+        label_group = group.require_group(f"labels/{label_name}")
+        arrays = [
+            label_group.create_dataset(str(ii), shape=level.shape, dtype=level.dtype, chunks=storage_opts["chunks"],
+                                       write_empty_chunks=False)
+            for ii, level in enumerate(mip)
+        ]
+        store_task = da.store(mip, arrays, lock=False, compute=False)
+
+        # the label table is computed from the same blocks of s0 that are written, so the data is only read once
+        offsets = itertools.product(*[np.cumsum((0,) + chunks[:-1]) for chunks in mip[0].chunks])
+        table_tasks = [
+            dask.delayed(_compute_block_table)(block, offset)
+            for block, offset in zip(mip[0].to_delayed().ravel(), offsets)
+        ]
+        _, block_tables = dask.compute(store_task, table_tasks)
+        write_label_table(group, label_name, _merge_block_tables(block_tables), axis_names)
+
+        datasets = [{"path": str(ii), "coordinateTransformations": trafo} for ii, trafo in enumerate(trafos)]
+        ome_zarr.writer.write_multiscales_metadata(label_group, datasets, axes=axes, name=label_name)
+        ome_zarr.writer.write_label_metadata(group["labels"], label_name, colors=colors)
+
+
+def convert_position(image, output_folder, cell_folder, nucleus_folder, resolution, label_resolution, units):
+    name = os.path.basename(image)
+    out_name = name.replace(".ome.tif", ".ome.zarr")
+    out_path = os.path.join(output_folder, out_name)
+
+    # the position is written to a temporary path and moved to the output path once it is complete,
+    # so that positions from an interrupted run are converted again
+    tmp_path = out_path + ".tmp"
+    if os.path.exists(tmp_path):
+        rmtree(tmp_path)
+
+    timings = {"position": name}
+    t0 = time.time()
+    loc = ome_zarr.io.parse_url(tmp_path, mode="w")
+    group = zarr.group(loc.store)
+    convert_image_data(image, group, resolution, units, name="image")
+    timings["image"] = time.time() - t0
+
+    t0 = time.time()
+    cell_segmentation = os.path.join(cell_folder, name)
+    assert os.path.exists(cell_segmentation)
+    convert_label_data(cell_segmentation, group, label_resolution, units, label_name="cells")
+    timings["cells"] = time.time() - t0
+
+    t0 = time.time()
+    nucleus_segmentation = os.path.join(nucleus_folder, name)
+    assert os.path.exists(nucleus_segmentation)
+    colors = [{"label-value": 1, "rgba": [0, 0, 255, 255]}]
+    convert_label_data(nucleus_segmentation, group, label_resolution, units, label_name="nuclei", colors=colors)
+    timings["nuclei"] = time.time() - t0
+
+    os.rename(tmp_path, out_path)
+    timings["total"] = timings["image"] + timings["cells"] + timings["nuclei"]
+    return timings
+
+
+def write_timing_summary(timings, output_folder):
+    summary_path = os.path.join(output_folder, "conversion_timings.json")
+    # keep the timings of positions that were converted in a previous run
+    if os.path.exists(summary_path):
+        with open(summary_path) as f:
+            summary = json.load(f)
+    else:
+        summary = {}
+    summary.update({timing.pop("position"): timing for timing in timings})
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
 
-    ome_zarr.writer.write_multiscale_labels(
-        mip, group, label_name,
-        axes=axes, coordinate_transformations=trafos,
-        storage_options=storage_opts, colors=colors
-    )
+    print("Conversion time per position [s]:")
+    for name, timing in sorted(summary.items()):
+        print(name, ", ".join(f"{key}: {val:.1f}" for key, val in timing.items()))
 
 
 def main():
@@ -95,6 +293,9 @@ def main():
     parser.add_argument("--input_folder", "-i", default="./example_data")
     parser.add_argument("--output_folder", "-o", default="./data")
     parser.add_argument("--embryo", default="embryo3")
+    # the number of positions that are converted in parallel,
+    # this also bounds the number of volumes that are loaded at the same time
+    parser.add_argument("--n_workers", "-n", type=int, default=1)
     args = parser.parse_args()
 
     input_folder, output_folder = args.input_folder, args.output_folder
@@ -107,6 +308,15 @@ def main():
     os.makedirs(output_folder, exist_ok=True)
     images = glob(os.path.join(image_folder, "*.ome.tif"))
 
+    # skip the positions that have already been converted
+    n_images = len(images)
+    images = [
+        image for image in images
+        if not os.path.exists(os.path.join(output_folder, os.path.basename(image).replace(".ome.tif", ".ome.zarr")))
+    ]
+    if len(images) < n_images:
+        print("Skipping", n_images - len(images), "positions that have already been converted")
+
     # the xy-resolution is different for the two embryos
     if embryo == "embryo3":
         resolution = {"c": 1.0, "z": 4.0, "y": 0.17, "x": 0.17}
@@ -118,23 +328,19 @@ def main():
     units = {"c": None, "z": "micrometer", "y": "micrometer", "x": "micrometer"}
 
     # do we store each position as a single ome.zarr
-    for image in tqdm(images, desc=f"Convert images from {input_folder} to ngff"):
-        name = os.path.basename(image)
-        out_name = name.replace(".ome.tif", ".ome.zarr")
-        out_path = os.path.join(output_folder, out_name)
-
-        loc = ome_zarr.io.parse_url(out_path, mode="w")
-        group = zarr.group(loc.store)
-        convert_image_data(image, group, resolution, units, name="image")
-
-        cell_segmentation = os.path.join(cell_folder, name)
-        assert os.path.exists(cell_segmentation)
-        convert_label_data(cell_segmentation, group, label_resolution, units, label_name="cells")
-
-        nucleus_segmentation = os.path.join(nucleus_folder, name)
-        assert os.path.exists(nucleus_segmentation)
-        colors = [{"label-value": 1, "rgba": [0, 0, 255, 255]}]
-        convert_label_data(nucleus_segmentation, group, label_resolution, units, label_name="nuclei", colors=colors)
+    convert = partial(convert_position, output_folder=output_folder, cell_folder=cell_folder,
+                      nucleus_folder=nucleus_folder, resolution=resolution,
+                      label_resolution=label_resolution, units=units)
+    desc = f"Convert images from {input_folder} to ngff"
+    if args.n_workers > 1:
+        with futures.ProcessPoolExecutor(args.n_workers) as pp:
+            tasks = [pp.submit(convert, image) for image in images]
+            timings = [task.result() for task in tqdm(futures.as_completed(tasks), total=len(tasks), desc=desc)]
+    else:
+        timings = [convert(image) for image in tqdm(images, desc=desc)]
+
+    if timings:
+        write_timing_summary(timings, output_folder)
 
 
 if __name__ == "__main__":